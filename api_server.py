@@ -0,0 +1,311 @@
+"""
+llm_chatbot的HTTP接口，和streamlit页面共用create_qa_chain（会话记忆、模型选择、回答缓存、性能记录）
+
+    python api_server.py --port 8000
+    python api_server.py --stub-llm    # 用固定输出的stub LLM代替真实模型，用于压测（检索仍然是真实的）
+
+POST /v1/chat  {"question": ..., "model": ..., "session_id": 可选, "k": 4, "lambda_mult": 0.25}
+    返回application/x-ndjson流，每行一个事件：
+    {"type": "session", "session_id": ...}
+    {"type": "llm_start"}           每次LLM调用开始，多轮对话改写问题时会有两次，客户端收到后应清空已收到的token
+    {"type": "token", "text": ...}
+    {"type": "done", "answer": ..., "from_cache": ..., "sources": [...], "metrics": {...}}
+    {"type": "error", "error": ...}
+DELETE /v1/sessions/{session_id}?model=...    清除会话记忆
+GET /v1/models, /v1/stats, /healthz
+
+同时运行的问答链不超过max_concurrency个；排队的请求达到max_queue时直接返回429，排队超过queue_timeout秒返回503。
+同一个会话同一时间只能有一个问题，重复提交返回409。
+客户端断开后，下一个token到达时中止生成，本地模型在推理线程中的请求也随之取消
+"""
+import argparse
+import asyncio
+import json
+import logging
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Iterator, List, Optional
+
+from aiohttp import web
+from langchain_core.callbacks import BaseCallbackHandler, CallbackManagerForLLMRun
+from langchain_core.language_models import LLM
+from langchain_core.outputs import GenerationChunk
+
+from func.llm_chatbot.llm_chatbot import OLLAMA_MODELS, create_qa_chain, create_vectordb, get_metrics_store, \
+    get_model_registry
+from settings import MODEL_PATH, API_HOST, API_PORT, API_MAX_CONCURRENCY, API_MAX_QUEUE, API_QUEUE_TIMEOUT, \
+    API_MAX_K
+
+logger = logging.getLogger(__name__)
+
+
+class StubLLM(LLM):
+    """
+    固定输出n_tokens个token，每个token之间sleep token_delay秒，模拟模型的生成速度
+    """
+    n_tokens: int = 64
+    token_delay: float = 0.02
+
+    def _call(self, prompt: str, stop: Optional[List[str]] = None,
+              run_manager: Optional[CallbackManagerForLLMRun] = None,
+              **kwargs: Any):
+        return "".join(chunk.text for chunk in self._stream(prompt, stop, run_manager, **kwargs))
+
+    def _stream(self, prompt: str, stop: Optional[List[str]] = None,
+                run_manager: Optional[CallbackManagerForLLMRun] = None,
+                **kwargs: Any) -> Iterator[GenerationChunk]:
+        for i in range(self.n_tokens):
+            time.sleep(self.token_delay)
+            chunk = GenerationChunk(text=f"tok{i} ")
+            if run_manager:
+                run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+            yield chunk
+
+    @property
+    def _llm_type(self) -> str:
+        return "stub"
+
+
+class ClientGone(Exception):
+    pass
+
+
+class StreamBridge(BaseCallbackHandler):
+    """
+    在问答链的线程中把LLM事件转发到asyncio队列；客户端断开后下一个事件抛出ClientGone，中止生成
+    """
+    raise_error = True
+
+    def __init__(self, loop, queue):
+        self.loop = loop
+        self.queue = queue
+        self.cancelled = threading.Event()
+
+    def put(self, event):
+        if self.cancelled.is_set():
+            raise ClientGone()
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, event)
+
+    def on_llm_start(self, serialized, prompts, **kwargs: Any) -> None:
+        self.put({'type': 'llm_start'})
+
+    def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        self.put({'type': 'token', 'text': token})
+
+
+class QueueFull(Exception):
+    pass
+
+
+class Admission:
+    """
+    限制同时运行的问答链数，排队数达到max_queue时拒绝新请求
+    """
+
+    def __init__(self, max_concurrency, max_queue):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.waiting = 0
+        self.running = 0
+        self._sem = asyncio.Semaphore(max_concurrency)
+
+    async def acquire(self, timeout):
+        if self.waiting >= self.max_queue:
+            raise QueueFull()
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self._sem.acquire(), timeout)
+        finally:
+            self.waiting -= 1
+        self.running += 1
+
+    def release(self):
+        self.running -= 1
+        self._sem.release()
+
+
+def _json_line(event):
+    return (json.dumps(event, ensure_ascii=False, default=str) + "\n").encode('utf-8')
+
+
+def run_chain(model, session_id, question, k, lambda_mult, llm, bridge):
+    """
+    在线程池中运行，结束时放入done/error事件和None
+    """
+    try:
+        qa_chain, _ = create_qa_chain(model, session_id, k, lambda_mult, llm=llm)
+        res = qa_chain({'question': question}, callbacks=[bridge])
+        bridge.put({
+            'type': 'done',
+            'answer': res['answer'],
+            'from_cache': res.get('from_cache', False),
+            'sources': [{'content': doc.page_content, 'metadata': doc.metadata}
+                        for doc in res['source_documents']],
+            'metrics': res.get('metrics'),
+        })
+    except ClientGone:
+        logger.info("client disconnected, generation aborted (session %s)", session_id)
+    except Exception as e:
+        logger.exception("qa chain failed")
+        if not bridge.cancelled.is_set():
+            bridge.put({'type': 'error', 'error': str(e)})
+    finally:
+        bridge.loop.call_soon_threadsafe(bridge.queue.put_nowait, None)
+
+
+async def chat(request: web.Request):
+    app = request.app
+    try:
+        body = await request.json()
+    except json.JSONDecodeError:
+        raise web.HTTPBadRequest(text="invalid json")
+    question = (body.get('question') or "").strip()
+    model = body.get('model') or app['default_model']
+    if not question:
+        raise web.HTTPBadRequest(text="question is required")
+    if app['stub_llm'] is None and model not in app['models']:
+        raise web.HTTPBadRequest(text=f"unknown model {model}")
+    session_id = body.get('session_id') or str(uuid.uuid4())
+    try:
+        k = int(body.get('k', 4))
+        lambda_mult = float(body.get('lambda_mult', 0.25))
+    except (TypeError, ValueError):
+        raise web.HTTPBadRequest(text="k must be an integer and lambda_mult a number")
+    if not 1 <= k <= API_MAX_K:
+        raise web.HTTPBadRequest(text=f"k must be between 1 and {API_MAX_K}")
+    if not 0 <= lambda_mult <= 1:
+        raise web.HTTPBadRequest(text="lambda_mult must be between 0 and 1")
+
+    session_key = (session_id, model)
+    if session_key in app['busy_sessions']:
+        raise web.HTTPConflict(text="session is busy")
+    admission: Admission = app['admission']
+    app['busy_sessions'].add(session_key)
+    try:
+        await admission.acquire(app['queue_timeout'])
+    except QueueFull:
+        app['busy_sessions'].discard(session_key)
+        raise web.HTTPTooManyRequests(text="too many queued requests", headers={'Retry-After': "1"})
+    except asyncio.TimeoutError:
+        app['busy_sessions'].discard(session_key)
+        raise web.HTTPServiceUnavailable(text="queue timeout", headers={'Retry-After': "1"})
+    except asyncio.CancelledError:
+        app['busy_sessions'].discard(session_key)
+        raise
+
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    bridge = StreamBridge(loop, queue)
+    future = loop.run_in_executor(app['executor'], run_chain, model, session_id, question, k, lambda_mult,
+                                  app['stub_llm'], bridge)
+
+    def finished(_):
+        # 线程真正结束后才释放名额，客户端断开时生成还要跑到下一个token
+        admission.release()
+        app['busy_sessions'].discard(session_key)
+
+    future.add_done_callback(finished)
+    try:
+        resp = web.StreamResponse(headers={'Content-Type': 'application/x-ndjson', 'X-Session-Id': session_id})
+        await resp.prepare(request)
+        await resp.write(_json_line({'type': 'session', 'session_id': session_id}))
+        while (event := await queue.get()) is not None:
+            await resp.write(_json_line(event))
+        await resp.write_eof()
+        return resp
+    except (asyncio.CancelledError, ConnectionResetError):
+        bridge.cancelled.set()
+        raise
+
+
+async def clear_session(request: web.Request):
+    session_id = request.match_info['session_id']
+    model = request.query.get('model', request.app['default_model'])
+
+    def clear():
+        qa_chain, mem = create_qa_chain(model, session_id, llm=request.app['stub_llm'])
+        mem.clear()
+
+    await asyncio.get_running_loop().run_in_executor(request.app['executor'], clear)
+    return web.json_response({'session_id': session_id, 'cleared': True})
+
+
+async def models(request: web.Request):
+    return web.json_response({'models': request.app['models'], 'default': request.app['default_model']})
+
+
+async def stats(request: web.Request):
+    admission: Admission = request.app['admission']
+    workers = {}
+    for name in MODEL_PATH:
+        worker = getattr(get_model_registry().peek(name), 'worker', None)
+        if worker is not None:
+            workers[name] = worker.stats()
+    return web.json_response({
+        'running': admission.running,
+        'waiting': admission.waiting,
+        'max_concurrency': admission.max_concurrency,
+        'max_queue': admission.max_queue,
+        'workers': workers,
+        'metrics': get_metrics_store().summary(),
+    }, dumps=lambda obj: json.dumps(obj, ensure_ascii=False, default=str))
+
+
+async def healthz(request: web.Request):
+    return web.json_response({'ok': request.app['ready']})
+
+
+def create_app(max_concurrency=API_MAX_CONCURRENCY, max_queue=API_MAX_QUEUE, queue_timeout=API_QUEUE_TIMEOUT,
+               default_model='qwen:0.5b', stub_llm=None):
+    app = web.Application()
+    app['models'] = OLLAMA_MODELS + list(MODEL_PATH)
+    app['default_model'] = default_model
+    app['stub_llm'] = stub_llm
+    app['queue_timeout'] = queue_timeout
+    app['busy_sessions'] = set()
+    app['ready'] = False
+    app['executor'] = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="qa-chain")
+
+    async def on_startup(app):
+        app['admission'] = Admission(max_concurrency, max_queue)
+        # 第一次请求前加载好知识库，避免第一个请求等待建库；和streamlit页面同时重载时由create_vectordb的文件锁依次进行
+        await asyncio.get_running_loop().run_in_executor(app['executor'], create_vectordb)
+        app['ready'] = True
+
+    async def on_cleanup(app):
+        app['executor'].shutdown(wait=False, cancel_futures=True)
+
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    app.router.add_post('/v1/chat', chat)
+    app.router.add_delete('/v1/sessions/{session_id}', clear_session)
+    app.router.add_get('/v1/models', models)
+    app.router.add_get('/v1/stats', stats)
+    app.router.add_get('/healthz', healthz)
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default=API_HOST)
+    parser.add_argument('--port', type=int, default=API_PORT)
+    parser.add_argument('--max-concurrency', type=int, default=API_MAX_CONCURRENCY)
+    parser.add_argument('--max-queue', type=int, default=API_MAX_QUEUE)
+    parser.add_argument('--queue-timeout', type=float, default=API_QUEUE_TIMEOUT)
+    parser.add_argument('--default-model', default='qwen:0.5b')
+    parser.add_argument('--stub-llm', action='store_true', help="用stub LLM代替真实模型")
+    parser.add_argument('--stub-tokens', type=int, default=64)
+    parser.add_argument('--stub-token-delay', type=float, default=0.02)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    stub_llm = StubLLM(n_tokens=args.stub_tokens, token_delay=args.stub_token_delay) if args.stub_llm else None
+    app = create_app(args.max_concurrency, args.max_queue, args.queue_timeout, args.default_model, stub_llm)
+    # handler_cancellation: 客户端断开时取消handler，排队中的请求直接放弃，生成中的请求在下一个token时中止
+    web.run_app(app, host=args.host, port=args.port, handler_cancellation=True)
+
+
+if __name__ == "__main__":
+    main()
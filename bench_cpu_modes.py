@@ -0,0 +1,152 @@
+"""
+对比本地模型在CPU上不同加载模式（fp32/bf16/int8）的加载时间、内存占用和生成速度，结果以JSON输出
+
+    python bench_cpu_modes.py --model Qwen1.5-1.8b-chat --threads 16
+    python bench_cpu_modes.py --tiny   # 随机权重的小Qwen2模型，只检查流程
+
+每种模式在单独的子进程中运行，RSS互不影响；int8会再跑一次，测量命中量化缓存后的加载时间
+"""
+import argparse
+import json
+import multiprocessing
+import platform
+import tempfile
+import time
+from pathlib import Path
+from queue import Empty
+
+import torch
+from transformers import AutoModel, AutoModelForCausalLM, AutoTokenizer, Qwen2Config, Qwen2ForCausalLM
+
+from func.llm_chatbot.cpu_inference import CPU_MODES, load_cpu_model, set_cpu_threads
+from func.llm_chatbot.model_registry import model_memory
+from settings import MODEL_PATH, QUANTIZED_MODEL_CACHE
+
+
+def rss_mb():
+    """
+    当前和峰值RSS（MB），读/proc/self/status，只支持Linux
+    """
+    usage = {}
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(('VmRSS:', 'VmHWM:')):
+                key, value, _ = line.split()
+                usage[key[:-1]] = int(value) / 1024
+    return usage.get('VmRSS'), usage.get('VmHWM')
+
+
+def run_mode(model_path, mode, cache_dir, args, queue):
+    set_cpu_threads(args.threads, args.interop_threads)
+    model_cls = AutoModel if 'chatglm' in Path(model_path).name else AutoModelForCausalLM
+    start = time.perf_counter()
+    model = load_cpu_model(model_cls, model_path, mode, cache_dir)
+    load_s = time.perf_counter() - start
+    rss_after_load, _ = rss_mb()
+
+    if args.tiny:
+        iids = list(range(1, 33))
+    else:
+        tok = AutoTokenizer.from_pretrained(model_path, trust_remote_code=True)
+        iids = tok.apply_chat_template([{'role': 'user', 'content': args.prompt}], add_generation_prompt=True)
+    inputs = torch.tensor([iids])
+    with torch.no_grad():
+        model.generate(inputs, max_new_tokens=4, min_new_tokens=4, do_sample=False)
+        start = time.perf_counter()
+        out = model.generate(inputs, max_new_tokens=args.max_new_tokens, min_new_tokens=args.max_new_tokens,
+                             do_sample=False)
+        gen_s = time.perf_counter() - start
+    new_tokens = out.shape[1] - len(iids)
+    rss, peak_rss = rss_mb()
+    queue.put({
+        'mode': mode,
+        'load_s': load_s,
+        'model_mb': {device: n / 1024 ** 2 for device, n in model_memory(model).items()},
+        'rss_after_load_mb': rss_after_load,
+        'rss_mb': rss,
+        'peak_rss_mb': peak_rss,
+        'prompt_tokens': len(iids),
+        'new_tokens': new_tokens,
+        'tokens_per_s': new_tokens / gen_s,
+        'output_ids': out[0, len(iids):].tolist()[:16],
+    })
+
+
+def wait_result(proc, queue, mode, poll=1.0):
+    """
+    等子进程的结果；子进程崩溃（比如OOM被kill）时不会一直等下去，返回带error的结果
+    """
+    while True:
+        try:
+            return queue.get(timeout=poll)
+        except Empty:
+            if proc.is_alive():
+                continue
+        # 子进程退出前可能刚放入结果
+        try:
+            return queue.get(timeout=poll)
+        except Empty:
+            return {'mode': mode, 'error': f"子进程异常退出，exitcode={proc.exitcode}"}
+
+
+def make_tiny_model(dir_path):
+    config = Qwen2Config(vocab_size=32000, hidden_size=512, intermediate_size=1408, num_hidden_layers=4,
+                         num_attention_heads=8, num_key_value_heads=8, max_position_embeddings=1024)
+    torch.manual_seed(0)
+    Qwen2ForCausalLM(config).save_pretrained(dir_path)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', default='Qwen1.5-0.5b-chat', help="MODEL_PATH中的模型名或模型目录")
+    parser.add_argument('--tiny', action='store_true', help="用随机权重的小模型代替--model")
+    parser.add_argument('--modes', default=",".join(CPU_MODES))
+    parser.add_argument('--threads', type=int)
+    parser.add_argument('--interop-threads', type=int)
+    parser.add_argument('--max-new-tokens', type=int, default=64)
+    parser.add_argument('--prompt', default="请介绍一下大语言模型的量化方法。")
+    parser.add_argument('--cache-dir', default=str(QUANTIZED_MODEL_CACHE))
+    parser.add_argument('--output', help="结果JSON文件，默认输出到stdout")
+    args = parser.parse_args()
+
+    ctx = multiprocessing.get_context('spawn')
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if args.tiny:
+            model_path = Path(tmp_dir) / 'tiny-qwen2'
+            make_tiny_model(model_path)
+            cache_dir = Path(tmp_dir) / 'cache'
+        else:
+            model_path = MODEL_PATH.get(args.model, args.model)
+            cache_dir = Path(args.cache_dir)
+        runs = []
+        modes = args.modes.split(",")
+        for mode in modes + (['int8'] if 'int8' in modes else []):
+            queue = ctx.Queue()
+            proc = ctx.Process(target=run_mode, args=(str(model_path), mode, cache_dir, args, queue))
+            proc.start()
+            res = wait_result(proc, queue, mode)
+            proc.join()
+            if mode == 'int8' and any(r['mode'] == 'int8' for r in runs):
+                res['mode'] = 'int8 (cached)'
+            runs.append(res)
+
+    baseline = next((r for r in runs if r['mode'] == 'fp32' and 'error' not in r), None)
+    for r in runs:
+        if baseline is not None and 'error' not in r:
+            r['speedup_vs_fp32'] = r['tokens_per_s'] / baseline['tokens_per_s']
+            r['same_output_as_fp32'] = r['output_ids'] == baseline['output_ids']
+    result = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'platform': platform.platform(),
+        'torch': torch.__version__,
+        'params': vars(args),
+        'runs': runs,
+    }
+    out = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.output:
+        Path(args.output).write_text(out, encoding='utf-8')
+    print(out)
+
+
+if __name__ == "__main__":
+    main()
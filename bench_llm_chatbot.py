@@ -0,0 +1,197 @@
+"""
+llm_chatbot知识库流水线的基准测试，不需要GPU和网络，结果以JSON输出，方便对比不同参数/版本
+
+    python bench_llm_chatbot.py --files 200 --chunk-size 500 --chunk-overlap 150 --output bench.json
+    python bench_llm_chatbot.py --embedding fake --retriever hybrid
+    python bench_llm_chatbot.py --embedding fake --vector-store mmap --ivf-nlist 64
+
+阶段：生成语料 -> get_text -> 分块 -> embedding -> 建向量库(Chroma/mmap) -> 检索延迟 -> 问答链(stub LLM)延迟；
+--retriever hybrid时另外按文件增量建BM25倒排索引，并单独统计倒排索引的查询延迟（lexical_lookup）
+"""
+import argparse
+import json
+import platform
+import random
+import statistics
+import tempfile
+import time
+from pathlib import Path
+
+from langchain_community.embeddings.fake import DeterministicFakeEmbedding
+from langchain_community.embeddings.huggingface import HuggingFaceEmbeddings
+from langchain_community.llms.fake import FakeListLLM
+from langchain_community.vectorstores.chroma import Chroma
+from langchain_core.embeddings import Embeddings
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+from func.llm_chatbot.lexical_index import LexicalIndex
+from func.llm_chatbot.llm_chatbot import get_text, create_retriever
+from func.llm_chatbot.manifest import make_chunk_ids
+from func.llm_chatbot.mmap_vectorstore import MmapVectorStore
+from func.llm_chatbot.qa_chain import QAChain
+from settings import EMBEDDING_PATH, KG_CHUNK_SIZE, KG_CHUNK_OVERLAP, KG_LOAD_WORKERS
+
+ZH_VOCAB = list("的一是在不了有和人这中大为上个国我以要他时来用们生到作地于出就分对成会可主发年动同工也能下过子说产种面而方后多定行学法所民得经十三之进着等部度家电力里如水化高自二理起小物现实加量都两体制机当使点从业本去把性好应开它合还因由其些然前外天政四日那社义事平形相全表间样与关各重新线内数正心反你明看原又么利比或但质气第向道命此变条只没结解问意建月公无系军很情者最立代想已通并提直题党程展五果料象员革位入常文总次品式活设及管特件长求老头基资边流路级少图山统接知较将组见计别她手角期根论运农指几九区强放决西被干做必战先回则任取据处理")
+EN_VOCAB = ["error", "code", "E1024", "timeout", "config", "server", "deploy", "model", "token", "cache",
+            "retry", "index", "vector", "qwen", "chatglm", "streamlit", "python", "docker", "gateway", "latency"]
+LEXICAL_LOOKUP_TARGET_MS = 10
+
+
+class PrecomputedEmbeddings(Embeddings):
+    """
+    返回已经算好的embedding，用于把向量库建库时间和embedding时间分开统计
+    """
+
+    def __init__(self, embeddings, vectors):
+        self.embeddings = embeddings
+        self.vectors = vectors
+
+    def embed_documents(self, texts):
+        return [self.vectors[text] if text in self.vectors else self.embeddings.embed_query(text) for text in texts]
+
+    def embed_query(self, text):
+        return self.embeddings.embed_query(text)
+
+
+def make_corpus(dir_path, n_files, paragraphs, seed):
+    rng = random.Random(seed)
+
+    def sentence():
+        words = [rng.choice(ZH_VOCAB) for _ in range(rng.randint(10, 40))]
+        words.insert(rng.randrange(len(words)), rng.choice(EN_VOCAB))
+        return "".join(words) + "。"
+
+    for i in range(n_files):
+        body = "\n\n".join("".join(sentence() for _ in range(rng.randint(2, 6))) for _ in range(paragraphs))
+        if i % 2:
+            (dir_path / f"doc_{i}.md").write_text(f"# 文档{i}\n\n{body}\n", encoding='utf-8')
+        else:
+            (dir_path / f"doc_{i}.txt").write_text(body, encoding='utf-8')
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+    qs = statistics.quantiles(samples, n=100, method='inclusive') if len(samples) > 1 else samples * 99
+    return {
+        'n': len(samples),
+        'mean_ms': statistics.fmean(samples) * 1000,
+        'p50_ms': qs[49] * 1000,
+        'p95_ms': qs[94] * 1000,
+        'p99_ms': qs[98] * 1000,
+        'max_ms': samples[-1] * 1000,
+    }
+
+
+def timed(fn):
+    start = time.perf_counter()
+    res = fn()
+    return res, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--files', type=int, default=100)
+    parser.add_argument('--paragraphs', type=int, default=20)
+    parser.add_argument('--chunk-size', type=int, default=KG_CHUNK_SIZE)
+    parser.add_argument('--chunk-overlap', type=int, default=KG_CHUNK_OVERLAP)
+    parser.add_argument('--workers', type=int, default=KG_LOAD_WORKERS)
+    parser.add_argument('--embedding', default=str(EMBEDDING_PATH),
+                        help="本地embedding模型路径，或fake（按文本hash生成的随机向量）")
+    parser.add_argument('--retriever', default='mmr', choices=['mmr', 'hybrid'])
+    parser.add_argument('--vector-store', default='chroma', choices=['chroma', 'mmap'])
+    parser.add_argument('--ivf-nlist', type=int, default=0)
+    parser.add_argument('--ivf-nprobe', type=int, default=8)
+    parser.add_argument('--k', type=int, default=4)
+    parser.add_argument('--lambda-mult', type=float, default=0.25)
+    parser.add_argument('--queries', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="结果JSON文件，默认输出到stdout")
+    args = parser.parse_args()
+
+    if args.embedding == 'fake':
+        embeddings = DeterministicFakeEmbedding(size=768)
+    else:
+        embeddings = HuggingFaceEmbeddings(model_name=args.embedding, model_kwargs={'device': 'cpu'})
+
+    stages = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp_dir = Path(tmp_dir)
+        corpus_dir = tmp_dir / 'kg_data'
+        corpus_dir.mkdir()
+        _, stages['make_corpus_s'] = timed(lambda: make_corpus(corpus_dir, args.files, args.paragraphs, args.seed))
+
+        docs, stages['get_text_s'] = timed(lambda: get_text(corpus_dir, workers=args.workers))
+        splitter = RecursiveCharacterTextSplitter(chunk_size=args.chunk_size, chunk_overlap=args.chunk_overlap)
+        split_docs, stages['split_s'] = timed(lambda: splitter.split_documents(docs))
+        texts = [doc.page_content for doc in split_docs]
+        vectors, stages['embed_s'] = timed(lambda: embeddings.embed_documents(texts))
+
+        precomputed = PrecomputedEmbeddings(embeddings, dict(zip(texts, vectors)))
+        if args.vector_store == 'mmap':
+            vectordb, stages['vectordb_build_s'] = timed(lambda: MmapVectorStore.from_documents(
+                documents=split_docs, embedding=precomputed, path=tmp_dir / 'vectordb_mmap',
+                nlist=args.ivf_nlist, nprobe=args.ivf_nprobe))
+            _, stages['vectordb_open_s'] = timed(lambda: MmapVectorStore(tmp_dir / 'vectordb_mmap', precomputed))
+        else:
+            vectordb, stages['vectordb_build_s'] = timed(lambda: Chroma.from_documents(
+                documents=split_docs, embedding=precomputed, persist_directory=str(tmp_dir / 'vectordb')))
+        lexical_index = None
+        if args.retriever == 'hybrid':
+            lexical_index = LexicalIndex(tmp_dir / 'lexical_index.sqlite')
+            chunk_ids = make_chunk_ids('bench', 'bench', len(split_docs))
+            # 和create_vectordb一样每个文件add一次
+            by_source = {}
+            for chunk_id, doc in zip(chunk_ids, split_docs):
+                by_source.setdefault(doc.metadata.get('source'), []).append((chunk_id, doc))
+            _, stages['lexical_index_s'] = timed(lambda: [lexical_index.add(*zip(*items))
+                                                          for items in by_source.values()])
+
+        retriever = create_retriever(vectordb, k=args.k, lambda_mult=args.lambda_mult, mode=args.retriever,
+                                     lexical_index=lexical_index)
+        rng = random.Random(args.seed)
+        queries = []
+        for _ in range(args.queries):
+            text = rng.choice(texts)
+            start = rng.randrange(max(1, len(text) - 30))
+            queries.append(text[start:start + 30])
+
+        lexical_latency = []
+        if lexical_index is not None:
+            for query in queries:
+                _, cost = timed(lambda: lexical_index.search(query, k=20))
+                lexical_latency.append(cost)
+
+        retrieval_latency = []
+        for query in queries:
+            _, cost = timed(lambda: retriever.get_relevant_documents(query))
+            retrieval_latency.append(cost)
+
+        qa_chain = QAChain.from_llm(llm=FakeListLLM(responses=["stub answer"]), retriever=retriever,
+                                    return_source_documents=True)
+        chain_latency = []
+        for query in queries:
+            _, cost = timed(lambda: qa_chain({'question': query, 'chat_history': []}))
+            chain_latency.append(cost)
+
+    result = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'platform': platform.platform(),
+        'params': vars(args),
+        'corpus': {'files': args.files, 'docs': len(docs), 'chunks': len(split_docs),
+                   'chars': sum(len(t) for t in texts)},
+        'stages': stages,
+        'embed_chunks_per_s': len(texts) / stages['embed_s'] if stages['embed_s'] else None,
+        'retrieval': percentiles(retrieval_latency),
+        # BM25倒排索引单独的查询延迟，目标p95 < LEXICAL_LOOKUP_TARGET_MS
+        'lexical_lookup': percentiles(lexical_latency) if lexical_latency else None,
+        'lexical_lookup_target_ms': LEXICAL_LOOKUP_TARGET_MS,
+        'qa_chain_stub_llm': percentiles(chain_latency),
+    }
+    out = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.output:
+        Path(args.output).write_text(out, encoding='utf-8')
+    print(out)
+
+
+if __name__ == "__main__":
+    main()
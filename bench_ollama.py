@@ -0,0 +1,135 @@
+"""
+对比langchain自带的Ollama和连接池版PooledOllama，默认在进程内启动fake Ollama服务，不需要真实模型
+
+    python bench_ollama.py --requests 50 --concurrency 8
+    python bench_ollama.py --base-url http://localhost:11434 --model qwen:0.5b   # 真实的Ollama服务
+
+- sequential: 逐个请求，统计首token时间、总耗时
+- concurrent: 用异步接口并发请求
+- idle gap: 每两个请求之间空闲--idle-gap秒，fake服务的模型空闲--server-keep-alive秒后卸载，
+  对比带keep_alive的请求是否避免了重新加载
+fake服务会统计新建连接数和模型加载次数
+"""
+import argparse
+import asyncio
+import json
+import platform
+import statistics
+import time
+from pathlib import Path
+
+import requests
+from langchain_community.llms.ollama import Ollama
+from langchain_core.callbacks import BaseCallbackHandler
+
+from func.llm_chatbot.fake_ollama import FakeOllama, start_in_thread
+from func.llm_chatbot.ollama_client import PooledOllama
+
+
+class FirstToken(BaseCallbackHandler):
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.first_token = None
+
+    def on_llm_new_token(self, token, **kwargs):
+        if self.first_token is None and token:
+            self.first_token = time.perf_counter()
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+    if not samples:
+        return None
+    qs = statistics.quantiles(samples, n=100, method='inclusive') if len(samples) > 1 else samples * 99
+    return {'n': len(samples), 'mean_ms': statistics.fmean(samples) * 1000, 'p50_ms': qs[49] * 1000,
+            'p95_ms': qs[94] * 1000, 'max_ms': samples[-1] * 1000}
+
+
+def server_stats(base_url):
+    try:
+        return requests.get(f"{base_url}/stats", timeout=5).json()
+    except (requests.RequestException, ValueError):
+        return None
+
+
+def diff_stats(before, after):
+    if before is None or after is None:
+        return None
+    return {key: after[key] - before[key] for key in after}
+
+
+def sequential(llm, n, idle_gap, base_url):
+    before = server_stats(base_url)
+    ttft, total = [], []
+    for i in range(n):
+        if i and idle_gap:
+            time.sleep(idle_gap)
+        handler = FirstToken()
+        llm.invoke(f"问题{i}", config={'callbacks': [handler]})
+        end = time.perf_counter()
+        total.append(end - handler.start)
+        if handler.first_token is not None:
+            ttft.append(handler.first_token - handler.start)
+    return {'ttft': percentiles(ttft), 'latency': percentiles(total),
+            'server': diff_stats(before, server_stats(base_url))}
+
+
+async def concurrent(llm, n, concurrency, base_url):
+    before = server_stats(base_url)
+    sem = asyncio.Semaphore(concurrency)
+    latency = []
+
+    async def one(i):
+        async with sem:
+            start = time.perf_counter()
+            await llm.ainvoke(f"问题{i}")
+            latency.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[one(i) for i in range(n)])
+    elapsed = time.perf_counter() - start
+    if isinstance(llm, PooledOllama):
+        await llm.client.aclose()
+    return {'throughput_rps': n / elapsed, 'latency': percentiles(latency),
+            'server': diff_stats(before, server_stats(base_url))}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--base-url', help="Ollama服务地址，默认启动进程内的fake服务")
+    parser.add_argument('--model', default='qwen:0.5b')
+    parser.add_argument('--requests', type=int, default=30)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--token-delay', type=float, default=0.005)
+    parser.add_argument('--load-time', type=float, default=0.5)
+    parser.add_argument('--idle-gap', type=float, default=1.0)
+    parser.add_argument('--idle-requests', type=int, default=4)
+    parser.add_argument('--server-keep-alive', type=float, default=0.5)
+    parser.add_argument('--keep-alive', default="30m")
+    parser.add_argument('--output', help="结果JSON文件，默认输出到stdout")
+    args = parser.parse_args()
+
+    base_url = args.base_url or start_in_thread(FakeOllama(token_delay=args.token_delay, load_time=args.load_time,
+                                                           default_keep_alive=args.server_keep_alive))
+    clients = {
+        'langchain_ollama': lambda: Ollama(model=args.model, base_url=base_url),
+        'pooled_ollama': lambda: PooledOllama(model=args.model, base_url=base_url, keep_alive=args.keep_alive),
+    }
+    result = {'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'), 'platform': platform.platform(),
+              'params': vars(args), 'runs': {}}
+    for name, make in clients.items():
+        llm = make()
+        llm.invoke("warmup")
+        result['runs'][name] = {
+            'sequential': sequential(llm, args.requests, 0, base_url),
+            'concurrent': asyncio.run(concurrent(llm, args.requests, args.concurrency, base_url)),
+            'idle_gap': sequential(llm, args.idle_requests, args.idle_gap, base_url),
+        }
+    out = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.output:
+        Path(args.output).write_text(out, encoding='utf-8')
+    print(out)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+"""
+进程间的文件锁：POSIX上用flock，Windows上用msvcrt锁住文件的第一个字节
+"""
+import os
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    # Windows没有fcntl
+    fcntl = None
+    import msvcrt
+
+
+@contextmanager
+def locked(f):
+    """
+    进程间互斥地写已经打开的文件f
+    """
+    if fcntl is not None:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+        return
+    fd = f.fileno()
+    os.lseek(fd, 0, os.SEEK_SET)
+    while True:
+        try:
+            msvcrt.locking(fd, msvcrt.LK_LOCK, 1)
+            break
+        except OSError:
+            # LK_LOCK重试10次（约10秒）后仍拿不到锁会报错，继续等
+            pass
+    try:
+        yield
+    finally:
+        os.lseek(fd, 0, os.SEEK_SET)
+        msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+
+
+@contextmanager
+def file_lock(path):
+    """
+    锁住单独的锁文件path，保护一组文件的写入；同一个进程里的多个线程也要各自拿锁
+    """
+    with open(path, 'a+b') as f, locked(f):
+        yield
@@ -1,12 +1,175 @@
+import csv
+import io
+import os
+import threading
+from collections import Counter, deque
+
+import openpyxl
 import pandas as pd
 import streamlit as st
 
-from settings import TABLE_PATH
+from func.file_lock import locked
+from settings import TABLE_PATH, TABLE_EXCEL_PATH, GATHER_INFO_TAIL_ROWS, GATHER_INFO_EXPORT_MAX_BYTES
+
+FIELDS = ['name', 'gender', 'weight', 'age', 'birthday']
+NUMERIC_FIELDS = {'weight', 'age'}
+# xlsx每个sheet最多1048576行，留一行给表头
+EXCEL_MAX_ROWS = 1048575
+
+
+def _to_number(value):
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+class SubmissionLog:
+    """
+    填报记录只追加写到CSV，不再整表读出来再写回
+
+    - append: 加文件锁（flock，Windows上用msvcrt）后追加一行，多个会话/进程同时提交不会丢数据，耗时和已有行数无关
+    - refresh: 从上次读到的位置继续读新追加的行，增量更新汇总和最近几条记录
+    """
+
+    def __init__(self, path, tail_rows=100):
+        self.path = path
+        self._lock = threading.Lock()
+        self._offset = 0
+        self._header = None
+        self.count = 0
+        self.gender = Counter()
+        self._sums = Counter()
+        self._valid = Counter()
+        self.tail = deque(maxlen=tail_rows)
+
+    def append(self, row):
+        buf = io.StringIO()
+        writer = csv.writer(buf, lineterminator="\n")
+        writer.writerow([row[field] for field in FIELDS])
+        with open(self.path, 'a', encoding='utf-8', newline='') as f, locked(f):
+            data = buf.getvalue()
+            if os.fstat(f.fileno()).st_size == 0:
+                data = ",".join(FIELDS) + "\n" + data
+            # 一次write，读的一方不会看到半行以外的东西；追加模式下总是写到文件末尾
+            f.write(data)
+            f.flush()
+
+    def _reset(self):
+        self._offset = 0
+        self._header = None
+        self.count = 0
+        self.gender.clear()
+        self._sums.clear()
+        self._valid.clear()
+        self.tail.clear()
+
+    def _consume(self, lines):
+        rows = csv.reader(lines)
+        if self._header is None:
+            self._header = next(rows, None)
+        for values in rows:
+            record = dict(zip(self._header, values))
+            self.count += 1
+            self.gender[record.get('gender')] += 1
+            for field in NUMERIC_FIELDS:
+                value = _to_number(record.get(field, ""))
+                if value is not None:
+                    self._sums[field] += value
+                    self._valid[field] += 1
+            self.tail.append(record)
+
+    def refresh(self, block_size=1 << 20):
+        with self._lock:
+            if not self.path.exists():
+                self._reset()
+                return
+            if self.path.stat().st_size < self._offset:
+                # 文件被清空或替换，从头读
+                self._reset()
+            with open(self.path, 'rb') as f:
+                f.seek(self._offset)
+                rest = b""
+                while block := f.read(block_size):
+                    block = rest + block
+                    # 只处理完整的行，正在写入的最后一行留到下次
+                    end = block.rfind(b"\n") + 1
+                    rest = block[end:]
+                    if end:
+                        self._consume(block[:end].decode('utf-8').splitlines())
+                        self._offset += end
+
+    def mean(self, field):
+        return self._sums[field] / self._valid[field] if self._valid[field] else None
+
+    def tail_frame(self):
+        """
+        最近的记录，最新的在最前面
+        """
+        with self._lock:
+            return pd.DataFrame(list(reversed(self.tail)), columns=self._header or FIELDS)
+
+
+def export_excel(csv_path, xlsx_path):
+    """
+    逐行读CSV写到write_only模式的xlsx，内存占用和行数无关；xlsx比CSV新时直接复用
+    """
+    if xlsx_path.exists() and xlsx_path.stat().st_mtime >= csv_path.stat().st_mtime:
+        return xlsx_path
+    wb = openpyxl.Workbook(write_only=True)
+    ws = None
+    with open(csv_path, encoding='utf-8', newline='') as f:
+        rows = csv.reader(f)
+        header = next(rows)
+        numeric = [field in NUMERIC_FIELDS for field in header]
+        for i, values in enumerate(rows):
+            if i % EXCEL_MAX_ROWS == 0:
+                ws = wb.create_sheet(f"Sheet{i // EXCEL_MAX_ROWS + 1}")
+                ws.append(header)
+            ws.append([_to_number(v) if is_num else v for v, is_num in zip(values, numeric)])
+    if ws is None:
+        wb.create_sheet("Sheet1").append(header)
+    # 先写临时文件再替换，同时导出时不会读到写了一半的文件
+    tmp_path = xlsx_path.with_name(f"{xlsx_path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    wb.save(tmp_path)
+    os.replace(tmp_path, xlsx_path)
+    return xlsx_path
+
+
+@st.cache_resource
+def get_submission_log():
+    return SubmissionLog(TABLE_PATH, tail_rows=GATHER_INFO_TAIL_ROWS)
+
+
+def _download(label, path, mime):
+    """
+    streamlit 1.33的download_button只能接收内存里的数据，静态文件服务只能放在static目录、不做鉴权，
+    填报记录也不该公开，所以没法直接从磁盘提供下载。这里只在点了导出的那次运行里读文件，不存session_state，
+    页面再重新运行一两次后streamlit就释放这份数据，每个会话最多占用一份；文件过大时只提示服务器上的路径
+    """
+    size = path.stat().st_size
+    if size > GATHER_INFO_EXPORT_MAX_BYTES:
+        st.warning(f"文件有{size / 1024 / 1024:.0f}MB，超过页面下载上限，请到服务器上获取：{path}")
+        return
+    st.download_button(label, path.read_bytes(), file_name=path.name, mime=mime)
+
+
+def _export_buttons():
+    col1, col2 = st.columns(2)
+    with col1:
+        if st.button("导出CSV"):
+            _download("下载CSV", TABLE_PATH, 'text/csv')
+    with col2:
+        if st.button("导出Excel"):
+            with st.spinner("正在导出"):
+                xlsx_path = export_excel(TABLE_PATH, TABLE_EXCEL_PATH)
+            _download("下载Excel", xlsx_path, 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
 
 
 def gather_info_page():
     st.title("信息填报")
     st.markdown("信息填报，然后汇总，生成excel表单")
+    log = get_submission_log()
     form = st.form("信息填报")
     with form:
         col1, col2 = st.columns(2)
@@ -19,32 +182,23 @@ def gather_info_page():
             birthday = st.date_input("生日")
         submitted = st.form_submit_button("提交")
         if submitted:
-            if not TABLE_PATH.exists():
-                data = {
-                    'name': [name],
-                    'gender': [gender],
-                    'weight': [weight],
-                    'age': [age],
-                    'birthday': [birthday],
-                }
-                df = pd.DataFrame(data)
-                df.to_csv(TABLE_PATH, index=False)
-            else:
-                df = pd.read_csv(TABLE_PATH)
-                data = {
-                    'name': name,
-                    'gender': gender,
-                    'weight': weight,
-                    'age': age,
-                    'birthday': birthday,
-                }
-                df.loc[len(df)] = data
-                df.to_csv(TABLE_PATH, index=False)
+            log.append({
+                'name': name,
+                'gender': gender,
+                'weight': weight,
+                'age': age,
+                'birthday': birthday,
+            })
             st.toast("成功填报一条记录", icon='😍')
             st.balloons()
-    if TABLE_PATH.exists():
-        df = pd.read_csv(TABLE_PATH)
-        st.write(df)
-
-
+    log.refresh()
+    if log.count:
+        col1, col2, col3, col4 = st.columns(4)
+        col1.metric("记录数", log.count)
+        col2.metric("男/女", f"{log.gender['男']}/{log.gender['女']}")
+        col3.metric("平均体重", f"{log.mean('weight'):.1f}" if log.mean('weight') is not None else "-")
+        col4.metric("平均年龄", f"{log.mean('age'):.1f}" if log.mean('age') is not None else "-")
+        st.markdown(f"最近{len(log.tail)}条记录")
+        st.write(log.tail_frame())
+        _export_buttons()
 
@@ -0,0 +1,75 @@
+import threading
+import time
+
+import numpy as np
+
+
+class SemanticAnswerCache:
+    """
+    以standalone question的embedding为key的回答缓存
+
+    - 按namespace（模型名）隔离，不同模型的回答互不复用
+    - 余弦相似度 >= threshold 视为命中，超过ttl秒的条目失效
+    - 每个namespace最多max_entries条，超出时淘汰最早写入的
+    - 知识库重载时调用invalidate()清空；重载前开始生成的回答带着旧的generation写入时会被丢弃
+    """
+
+    def __init__(self, threshold=0.95, ttl=3600, max_entries=1000):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._spaces = {}
+        self.generation = 0
+
+    def invalidate(self):
+        with self._lock:
+            self._spaces = {}
+            self.generation += 1
+
+    def lookup(self, namespace, vec):
+        """
+        返回(answer, source_documents)，未命中返回None
+        """
+        vec = _normalize(vec)
+        with self._lock:
+            space = self._spaces.get(namespace)
+            if space is None:
+                return None
+            self._expire(space)
+            if not space['entries']:
+                return None
+            scores = space['vecs'] @ vec
+            i = int(np.argmax(scores))
+            if scores[i] < self.threshold:
+                return None
+            _, answer, docs = space['entries'][i]
+            return answer, docs
+
+    def put(self, namespace, vec, answer, docs, generation=None):
+        """
+        generation: 开始生成时读取的self.generation，之后调用过invalidate()的话不写入
+        """
+        vec = _normalize(vec)
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            space = self._spaces.setdefault(namespace, {'vecs': np.zeros((0, len(vec)), dtype=np.float32),
+                                                        'entries': []})
+            space['vecs'] = np.vstack([space['vecs'], vec[None, :]])[-self.max_entries:]
+            space['entries'] = (space['entries'] + [(time.time(), answer, list(docs))])[-self.max_entries:]
+
+    def _expire(self, space):
+        deadline = time.time() - self.ttl
+        n = 0
+        while n < len(space['entries']) and space['entries'][n][0] < deadline:
+            n += 1
+        if n:
+            space['vecs'] = space['vecs'][n:]
+            space['entries'] = space['entries'][n:]
+
+
+def _normalize(vec):
+    vec = np.asarray(vec, dtype=np.float32)
+    norm = np.linalg.norm(vec)
+    return vec / norm if norm > 0 else vec
@@ -0,0 +1,101 @@
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+
+import torch
+import transformers
+from transformers import AutoConfig
+from transformers.dynamic_module_utils import get_class_from_dynamic_module
+
+logger = logging.getLogger(__name__)
+
+CPU_MODES = ['fp32', 'bf16', 'int8']
+
+
+def set_cpu_threads(num_threads=None, interop_threads=None):
+    """
+    设置torch的计算线程数；interop线程数只能在第一次并行计算之前设置
+    """
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    if interop_threads:
+        try:
+            torch.set_interop_threads(interop_threads)
+        except RuntimeError:
+            logger.warning("torch interop threads already in use, keep %d", torch.get_num_interop_threads())
+
+
+def _weight_files(model_path):
+    return sorted(f for suffix in ['safetensors', 'bin'] for f in Path(model_path).glob(f"*.{suffix}"))
+
+
+def quantized_cache_file(model_path, cache_dir):
+    """
+    量化后模型的缓存文件。缓存是整个模型pickle的结果，权重文件、模型类、torch或transformers版本变化后
+    文件名随之变化，旧缓存不再使用
+    """
+    config_path = Path(model_path) / 'config.json'
+    architectures = json.loads(config_path.read_text(encoding='utf-8')).get('architectures') \
+        if config_path.exists() else None
+    h = hashlib.md5(f"{torch.__version__}|{transformers.__version__}|{architectures}".encode('utf-8'))
+    for f in _weight_files(model_path):
+        stat = f.stat()
+        h.update(f"{f.name}|{stat.st_size}|{stat.st_mtime}".encode('utf-8'))
+    return Path(cache_dir) / f"{Path(model_path).name}-int8-{h.hexdigest()[:12]}.pt"
+
+
+def estimate_cpu_model_memory(model_path, mode, cache_dir=None):
+    """
+    加载前估算CPU模式下的内存占用：有量化缓存时用缓存文件大小，否则按权重文件大小和dtype换算
+    """
+    if mode == 'int8' and cache_dir is not None:
+        cache_file = quantized_cache_file(model_path, cache_dir)
+        if cache_file.exists():
+            return {'cpu': cache_file.stat().st_size}
+    size = sum(f.stat().st_size for f in _weight_files(model_path))
+    # 权重文件一般是fp16/bf16，fp32翻倍，int8的Linear减半
+    scale = {'fp32': 2, 'bf16': 1, 'int8': 0.5}[mode]
+    return {'cpu': int(size * scale)}
+
+
+def _import_remote_code(model_path):
+    # trust_remote_code的模型类在transformers_modules下动态生成，反序列化之前要先导入
+    config = AutoConfig.from_pretrained(model_path, trust_remote_code=True)
+    for class_ref in (getattr(config, 'auto_map', None) or {}).values():
+        if isinstance(class_ref, str):
+            get_class_from_dynamic_module(class_ref, model_path)
+
+
+def load_cpu_model(model_cls, model_path, mode='int8', cache_dir=None):
+    """
+    在CPU上加载模型：
+
+    - fp32: 全精度
+    - bf16: 权重和计算都用bfloat16，内存减半，需要CPU支持avx512_bf16/amx才有速度优势
+    - int8: 所有nn.Linear做动态int8量化（权重int8，激活在计算时量化），其余层保持fp32
+
+    int8第一次加载时需要先按fp32加载再量化，量化后的整个模型序列化到cache_dir，之后直接反序列化
+    """
+    if mode not in CPU_MODES:
+        raise ValueError(f"unknown cpu mode {mode}, expected one of {CPU_MODES}")
+    if mode != 'int8':
+        dtype = torch.bfloat16 if mode == 'bf16' else torch.float32
+        return model_cls.from_pretrained(model_path, trust_remote_code=True, torch_dtype=dtype).eval()
+
+    cache_file = quantized_cache_file(model_path, cache_dir) if cache_dir is not None else None
+    if cache_file is not None and cache_file.exists():
+        _import_remote_code(model_path)
+        try:
+            return torch.load(cache_file, weights_only=False).eval()
+        except Exception:
+            logger.exception("failed to load quantized cache %s, re-quantizing", cache_file)
+    model = model_cls.from_pretrained(model_path, trust_remote_code=True, torch_dtype=torch.float32).eval()
+    model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    if cache_file is not None:
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = cache_file.with_suffix('.tmp')
+        torch.save(model, tmp_file)
+        os.replace(tmp_file, cache_file)
+    return model
@@ -0,0 +1,182 @@
+import hashlib
+import re
+import sqlite3
+import threading
+from typing import List
+
+import numpy as np
+from langchain_core.documents import Document
+
+_space_re = re.compile(r"\s+")
+
+
+def normalize_text(text):
+    return _space_re.sub(" ", text).strip().lower()
+
+
+def exact_hash(text):
+    return hashlib.sha1(normalize_text(text).encode('utf-8')).hexdigest()
+
+
+class MinHasher:
+    """
+    字符n-gram的MinHash签名，整个chunk用NumPy一次算完：
+    码点数组上做滚动多项式hash得到每个shingle的hash，再用num_perm个multiply-shift hash（(a*x+b)溢出后取高32位）取最小值
+    """
+
+    def __init__(self, num_perm=128, shingle=5, seed=1):
+        rng = np.random.default_rng(seed)
+        self.num_perm = num_perm
+        self.shingle = shingle
+        self._a = (rng.integers(0, 1 << 63, num_perm, dtype=np.uint64) | np.uint64(1))[:, None]
+        self._b = rng.integers(0, 1 << 63, num_perm, dtype=np.uint64)[:, None]
+
+    def signature(self, text):
+        text = normalize_text(text)
+        codes = np.frombuffer(text.encode('utf-32-le'), dtype=np.uint32).astype(np.uint64)
+        n = max(len(codes) - self.shingle + 1, 1)
+        h = np.zeros(n, dtype=np.uint64)
+        for j in range(min(self.shingle, len(codes))):
+            h = h * np.uint64(1000003) + codes[j:j + n]
+        h ^= h >> np.uint64(29)
+        with np.errstate(over='ignore'):
+            return ((self._a * h + self._b) >> np.uint64(32)).min(axis=1).astype(np.uint32)
+
+
+class ChunkDeduper:
+    """
+    分块之后、embedding之前去掉重复chunk，状态存在sqlite中，支持增量重载：
+
+    - chunk: 保留下来的chunk，包括规范化文本的sha1、MinHash签名和来源文件
+    - band: LSH分桶，签名切成bands段，每段的hash作为桶号，只和同桶的chunk比较签名
+    - dup: 被去掉的chunk，记录它重复的是哪个保留chunk以及来源文件，用于展示出处和级联重载
+
+    每个chunk只查bands次索引，总耗时随chunk数线性增长
+    """
+
+    def __init__(self, path, threshold=0.85, num_perm=128, bands=16, max_candidates=50):
+        assert num_perm % bands == 0
+        self.threshold = threshold
+        self.bands = bands
+        self.max_candidates = max_candidates
+        self.hasher = MinHasher(num_perm)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(path), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS chunk (chunk_id TEXT PRIMARY KEY, exact TEXT, sig BLOB, "
+                           "source TEXT)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS chunk_exact ON chunk (exact)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS band (key INTEGER, chunk_id TEXT)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS band_key ON band (key)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS band_chunk ON band (chunk_id)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS dup (chunk_id TEXT PRIMARY KEY, canonical_id TEXT, "
+                           "source TEXT)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS dup_canonical ON dup (canonical_id)")
+        self._conn.commit()
+
+    def __len__(self):
+        return self._conn.execute("SELECT COUNT(*) FROM chunk").fetchone()[0]
+
+    def _band_keys(self, sig):
+        rows = len(sig) // self.bands
+        return [int.from_bytes(hashlib.blake2b(bytes([i]) + sig[i * rows:(i + 1) * rows].tobytes(),
+                                               digest_size=8).digest(), 'little', signed=True)
+                for i in range(self.bands)]
+
+    def _find(self, chunk_id, exact, sig, keys):
+        # 跳过chunk自己：上次导入中途失败时，这个chunk可能已经登记过
+        row = self._conn.execute("SELECT chunk_id FROM chunk WHERE exact = ? AND chunk_id != ?",
+                                 (exact, chunk_id)).fetchone()
+        if row:
+            return row[0], 'exact'
+        candidates = []
+        for key in keys:
+            candidates.extend(r[0] for r in self._conn.execute(
+                "SELECT chunk_id FROM band WHERE key = ? AND chunk_id != ?", (key, chunk_id)))
+        best, best_sim = None, self.threshold
+        for other_id in dict.fromkeys(candidates[:self.max_candidates]):
+            other = np.frombuffer(self._conn.execute("SELECT sig FROM chunk WHERE chunk_id = ?",
+                                                     (other_id,)).fetchone()[0], dtype=np.uint32)
+            sim = float((other == sig).mean())
+            if sim >= best_sim:
+                best, best_sim = other_id, sim
+        return (best, 'near') if best else (None, None)
+
+    def add(self, chunk_ids, docs: List[Document], source, register_only=False):
+        """
+        依次检查每个chunk，和已保留的chunk（包括同一批中排在前面的）完全相同或相似度不低于threshold时记为重复
+
+        返回每个chunk的判定：None表示保留，'exact'/'near'表示被去掉；register_only=True时全部保留，用于补建索引
+        同一个chunk_id重复add时先清掉旧的登记，结果和第一次add相同
+        """
+        kinds = []
+        with self._lock:
+            self._delete(chunk_ids)
+            for chunk_id, doc in zip(chunk_ids, docs):
+                exact = exact_hash(doc.page_content)
+                sig = self.hasher.signature(doc.page_content)
+                keys = self._band_keys(sig)
+                canonical, kind = (None, None) if register_only else self._find(chunk_id, exact, sig, keys)
+                if canonical is None:
+                    self._conn.execute("INSERT OR REPLACE INTO chunk VALUES (?, ?, ?, ?)",
+                                       (chunk_id, exact, sig.tobytes(), source))
+                    self._conn.executemany("INSERT INTO band VALUES (?, ?)", [(key, chunk_id) for key in keys])
+                else:
+                    self._conn.execute("INSERT OR REPLACE INTO dup VALUES (?, ?, ?)", (chunk_id, canonical, source))
+                kinds.append(kind)
+            self._conn.commit()
+        return kinds
+
+    def orphans(self, chunk_ids):
+        """
+        返回重复chunk指向这些chunk的来源文件：这些chunk被删除后，对应文件需要重新导入
+        """
+        sources = set()
+        with self._lock:
+            for i in range(0, len(chunk_ids), 500):
+                batch = list(chunk_ids[i:i + 500])
+                marks = ",".join("?" * len(batch))
+                sources.update(r[0] for r in self._conn.execute(
+                    f"SELECT source FROM dup WHERE canonical_id IN ({marks})", batch))
+        return sources
+
+    def _delete(self, chunk_ids):
+        for i in range(0, len(chunk_ids), 500):
+            batch = list(chunk_ids[i:i + 500])
+            marks = ",".join("?" * len(batch))
+            self._conn.execute(f"DELETE FROM chunk WHERE chunk_id IN ({marks})", batch)
+            self._conn.execute(f"DELETE FROM band WHERE chunk_id IN ({marks})", batch)
+            self._conn.execute(f"DELETE FROM dup WHERE chunk_id IN ({marks})", batch)
+
+    def delete(self, chunk_ids):
+        with self._lock:
+            self._delete(chunk_ids)
+            self._conn.commit()
+
+    def clear(self):
+        with self._lock:
+            for table in ('chunk', 'band', 'dup'):
+                self._conn.execute(f"DELETE FROM {table}")
+            self._conn.commit()
+
+    def sources(self, text):
+        """
+        按文本找到保留的chunk，返回它自己和所有重复chunk的来源文件
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT chunk_id, source FROM chunk WHERE exact = ?",
+                                     (exact_hash(text),)).fetchone()
+            if row is None:
+                return []
+            dups = self._conn.execute("SELECT source FROM dup WHERE canonical_id = ?", (row[0],)).fetchall()
+        return list(dict.fromkeys([row[1]] + [r[0] for r in dups]))
+
+    def annotate(self, docs: List[Document]):
+        """
+        在检索结果的metadata中加上duplicate_sources，列出内容相同/相似的其他文件
+        """
+        for doc in docs:
+            sources = self.sources(doc.page_content)
+            if len(sources) > 1:
+                doc.metadata['duplicate_sources'] = sources
+        return docs
@@ -0,0 +1,107 @@
+import hashlib
+import sqlite3
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from typing import List
+
+from langchain_core.embeddings import Embeddings
+
+
+def _to_blob(vec):
+    return array('f', vec).tobytes()
+
+
+def _from_blob(blob):
+    vec = array('f')
+    vec.frombytes(blob)
+    return vec.tolist()
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    给embedding模型加一层缓存，key为 模型路径+chunk文本的sha256
+
+    embed_documents: 落盘到sqlite，条目数超过max_entries时按最近使用时间淘汰；条目数在内存里计数，
+        超过上限时才用COUNT(*)校正一次（其他进程也可能写入）再淘汰
+    embed_query: 进程内LRU，重复的问题不再跑模型；返回副本，调用方修改结果不会影响缓存
+    """
+
+    def __init__(self, embeddings: Embeddings, model_path, cache_path, max_entries=500000, query_cache_size=1024):
+        self.embeddings = embeddings
+        self.model_path = str(model_path)
+        self.max_entries = max_entries
+        self.query_cache_size = query_cache_size
+        self._query_cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(cache_path), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embedding ("
+            "key TEXT PRIMARY KEY, vec BLOB NOT NULL, last_used REAL NOT NULL)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS embedding_last_used ON embedding(last_used)")
+        self._conn.commit()
+        self._count = self._conn.execute("SELECT COUNT(*) FROM embedding").fetchone()[0]
+
+    def _key(self, text):
+        return hashlib.sha256(f"{self.model_path}\0{text}".encode('utf-8')).hexdigest()
+
+    def _lookup(self, keys):
+        found = {}
+        for i in range(0, len(keys), 500):
+            batch = keys[i:i + 500]
+            rows = self._conn.execute(
+                f"SELECT key, vec FROM embedding WHERE key IN ({','.join('?' * len(batch))})", batch)
+            for key, blob in rows:
+                found[key] = _from_blob(blob)
+        return found
+
+    def _evict(self):
+        if self._count <= self.max_entries:
+            return
+        # 内存计数把INSERT OR REPLACE覆盖的行也算作新增，也看不到其他进程的写入，淘汰前校正
+        self._count = self._conn.execute("SELECT COUNT(*) FROM embedding").fetchone()[0]
+        if self._count > self.max_entries:
+            self._conn.execute(
+                "DELETE FROM embedding WHERE key IN "
+                "(SELECT key FROM embedding ORDER BY last_used LIMIT ?)", (self._count - self.max_entries,))
+            self._count = self.max_entries
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys = [self._key(text) for text in texts]
+        with self._lock:
+            found = self._lookup(list(set(keys)))
+        hits = list(found)
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in found and key not in missing:
+                missing[key] = text
+        if missing:
+            vecs = self.embeddings.embed_documents(list(missing.values()))
+            found.update(zip(missing.keys(), vecs))
+        now = time.time()
+        with self._lock:
+            self._conn.executemany("UPDATE embedding SET last_used = ? WHERE key = ?",
+                                   [(now, key) for key in hits])
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embedding (key, vec, last_used) VALUES (?, ?, ?)",
+                [(key, _to_blob(found[key]), now) for key in missing])
+            if missing:
+                self._count += len(missing)
+                self._evict()
+            self._conn.commit()
+        return [found[key] for key in keys]
+
+    def embed_query(self, text: str) -> List[float]:
+        with self._lock:
+            vec = self._query_cache.get(text)
+            if vec is not None:
+                self._query_cache.move_to_end(text)
+                return list(vec)
+        vec = self.embeddings.embed_query(text)
+        with self._lock:
+            self._query_cache[text] = vec
+            if len(self._query_cache) > self.query_cache_size:
+                self._query_cache.popitem(last=False)
+        return list(vec)
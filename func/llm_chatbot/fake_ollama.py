@@ -0,0 +1,167 @@
+"""
+模拟Ollama HTTP接口的本地服务，用于离线测试和压测Ollama客户端
+
+    python -m func.llm_chatbot.fake_ollama --port 11434 --token-delay 0.02 --load-time 1.0 --fail-rate 0.1
+
+- POST /api/generate: 按token_delay逐个输出固定的token，支持stream=false；不带prompt时只加载模型
+- 模型第一次使用或空闲超过keep_alive（请求不带时为default_keep_alive）后重新加载，耗时load_time秒
+- fail_rate的概率返回503，用于测试重试
+- GET /api/tags, /api/ps; GET /stats 返回请求数、新建连接数和模型加载次数，用于验证连接复用和keep-alive
+"""
+import argparse
+import asyncio
+import json
+import random
+import re
+import threading
+import time
+
+from aiohttp import web
+
+_duration_re = re.compile(r"^(-?\d+(?:\.\d+)?)(ms|s|m|h)?$")
+
+
+def parse_keep_alive(value, default=300.0):
+    """
+    Ollama的keep_alive可以是秒数或"5m"/"1h"这样的字符串，负数表示一直保留
+    """
+    if value is None:
+        return default
+    if isinstance(value, (int, float)):
+        seconds = float(value)
+    else:
+        match = _duration_re.match(str(value).strip())
+        if not match:
+            return default
+        seconds = float(match.group(1)) * {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600, None: 1}[match.group(2)]
+    return float('inf') if seconds < 0 else seconds
+
+
+class FakeOllama:
+    def __init__(self, token_delay=0.02, n_tokens=32, load_time=0.5, fail_rate=0.0, default_keep_alive=300.0,
+                 seed=0):
+        self.token_delay = token_delay
+        self.default_keep_alive = default_keep_alive
+        self.n_tokens = n_tokens
+        self.load_time = load_time
+        self.fail_rate = fail_rate
+        self.rng = random.Random(seed)
+        # model -> 卸载时间
+        self.loaded = {}
+        self.stats = {'requests': 0, 'connections': 0, 'loads': 0, 'failures': 0, 'cancelled': 0}
+        self._transports = set()
+
+    def _track_connection(self, request):
+        transport = request.transport
+        if transport is not None and id(transport) not in self._transports:
+            self._transports.add(id(transport))
+            self.stats['connections'] += 1
+
+    async def _ensure_loaded(self, model, keep_alive):
+        now = time.time()
+        if self.loaded.get(model, 0) < now:
+            self.stats['loads'] += 1
+            await asyncio.sleep(self.load_time)
+        self.loaded[model] = time.time() + parse_keep_alive(keep_alive, self.default_keep_alive)
+
+    async def generate(self, request: web.Request):
+        self._track_connection(request)
+        self.stats['requests'] += 1
+        body = await request.json()
+        model = body.get('model')
+        if not model:
+            return web.json_response({'error': "model is required"}, status=400)
+        if self.rng.random() < self.fail_rate:
+            self.stats['failures'] += 1
+            return web.json_response({'error': "injected failure"}, status=503)
+        start = time.perf_counter()
+        await self._ensure_loaded(model, body.get('keep_alive'))
+        load_duration = time.perf_counter() - start
+        prompt = body.get('prompt')
+        n_tokens = int((body.get('options') or {}).get('num_predict') or self.n_tokens)
+        if not prompt:
+            return web.json_response({'model': model, 'response': "", 'done': True, 'done_reason': 'load'})
+        tokens = [f"tok{i} " for i in range(n_tokens)]
+        final = {
+            'model': model, 'response': "", 'done': True,
+            'prompt_eval_count': len(prompt.split()), 'eval_count': n_tokens,
+            'load_duration': int(load_duration * 1e9),
+        }
+        if body.get('stream') is False:
+            await asyncio.sleep(self.token_delay * n_tokens)
+            return web.json_response({**final, 'response': "".join(tokens)})
+
+        resp = web.StreamResponse(headers={'Content-Type': 'application/x-ndjson'})
+        await resp.prepare(request)
+        try:
+            for tok in tokens:
+                await asyncio.sleep(self.token_delay)
+                await resp.write((json.dumps({'model': model, 'response': tok, 'done': False}) + "\n").encode())
+            await resp.write((json.dumps(final) + "\n").encode())
+            await resp.write_eof()
+        except (ConnectionResetError, asyncio.CancelledError):
+            self.stats['cancelled'] += 1
+            raise
+        finally:
+            self.loaded[model] = time.time() + parse_keep_alive(body.get('keep_alive'), self.default_keep_alive)
+        return resp
+
+    async def tags(self, request: web.Request):
+        return web.json_response({'models': [{'name': name} for name in self.loaded]})
+
+    async def ps(self, request: web.Request):
+        now = time.time()
+        return web.json_response({'models': [{'name': name, 'expires_in': until - now}
+                                             for name, until in self.loaded.items() if until > now]})
+
+    async def get_stats(self, request: web.Request):
+        return web.json_response(self.stats)
+
+    def app(self):
+        app = web.Application()
+        app.router.add_post('/api/generate', self.generate)
+        app.router.add_get('/api/tags', self.tags)
+        app.router.add_get('/api/ps', self.ps)
+        app.router.add_get('/stats', self.get_stats)
+        return app
+
+
+def start_in_thread(fake: FakeOllama, host='127.0.0.1', port=0):
+    """
+    在后台线程中启动服务，返回base_url，用于测试和压测脚本
+    """
+    started = threading.Event()
+    state = {}
+
+    def run():
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        runner = web.AppRunner(fake.app(), handler_cancellation=True)
+        loop.run_until_complete(runner.setup())
+        site = web.TCPSite(runner, host, port)
+        loop.run_until_complete(site.start())
+        state['port'] = site._server.sockets[0].getsockname()[1]
+        started.set()
+        loop.run_forever()
+
+    threading.Thread(target=run, daemon=True, name="fake-ollama").start()
+    started.wait()
+    return f"http://{host}:{state['port']}"
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=11434)
+    parser.add_argument('--token-delay', type=float, default=0.02)
+    parser.add_argument('--n-tokens', type=int, default=32)
+    parser.add_argument('--load-time', type=float, default=0.5)
+    parser.add_argument('--fail-rate', type=float, default=0.0)
+    parser.add_argument('--default-keep-alive', type=float, default=300.0, help="请求不带keep_alive时模型保留的秒数")
+    args = parser.parse_args()
+    fake = FakeOllama(args.token_delay, args.n_tokens, args.load_time, args.fail_rate, args.default_keep_alive)
+    web.run_app(fake.app(), host=args.host, port=args.port, handler_cancellation=True)
+
+
+if __name__ == "__main__":
+    main()
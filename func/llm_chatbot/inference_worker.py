@@ -0,0 +1,511 @@
+import logging
+import queue
+import threading
+import time
+from collections import OrderedDict, deque
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+logger = logging.getLogger(__name__)
+
+
+class GenerationRequest:
+    """
+    一次生成请求，worker产出的token id通过tokens队列交给调用方，None表示结束
+    """
+
+    def __init__(self, input_ids, max_new_tokens=512):
+        self.input_ids = list(input_ids)
+        self.max_new_tokens = max_new_tokens
+        self.output_ids = []
+        self.tokens = queue.Queue()
+        self.submit_time = time.perf_counter()
+        self.start_time = None
+        self.prefill_tokens = None
+        self.cancelled = False
+        # 投机解码的统计：draft猜测/被接受的token数，投机解码阶段的耗时和产出token数
+        self.speculative = True
+        self.draft_tokens = 0
+        self.accepted_tokens = 0
+        self.target_steps = 0
+        self.spec_time = 0.0
+        self.spec_output_tokens = 0
+
+    @property
+    def acceptance_rate(self):
+        return self.accepted_tokens / self.draft_tokens if self.draft_tokens else None
+
+    @property
+    def wait_time(self):
+        if self.start_time is None:
+            return time.perf_counter() - self.submit_time
+        return self.start_time - self.submit_time
+
+    def cancel(self):
+        self.cancelled = True
+
+    def __iter__(self):
+        while True:
+            tok = self.tokens.get()
+            if tok is None:
+                return
+            if isinstance(tok, BaseException):
+                raise tok
+            yield tok
+
+
+def kv_nbytes(past):
+    return sum(t.numel() * t.element_size() for layer in past for t in layer)
+
+
+class PrefixCache:
+    """
+    按token前缀缓存prefill得到的KV cache（batch=1），新请求复用和已缓存序列最长的公共前缀，只prefill剩余的token
+
+    多轮对话中同一会话的prompt（改写问题时带上的历史）和不同会话共用的prompt模板都会命中。
+    按KV张量的实际字节数计算占用，总量不超过max_bytes，超出时按LRU淘汰；
+    单条超过max_bytes * max_entry_fraction的prompt不缓存，避免一个长prompt把其他条目全部挤掉
+    """
+
+    def __init__(self, max_bytes=1024 ** 3, min_prefix=16, max_entry_fraction=0.25):
+        self.max_bytes = max_bytes
+        self.min_prefix = min_prefix
+        self.max_entry_fraction = max_entry_fraction
+        self._entries = OrderedDict()
+        self._n_bytes = 0
+
+    @property
+    def nbytes(self):
+        return self._n_bytes
+
+    def lookup(self, input_ids):
+        """
+        返回(prefix_len, past_key_values)，没有可用前缀时返回(0, None)
+        """
+        best_key, best_len = None, 0
+        ids = np.asarray(input_ids)
+        for key, (key_ids, _, _) in self._entries.items():
+            n = min(len(key_ids), len(ids))
+            diff = np.flatnonzero(key_ids[:n] != ids[:n])
+            common = int(diff[0]) if len(diff) else n
+            if common > best_len:
+                best_key, best_len = key, common
+        if best_key is None or best_len < self.min_prefix:
+            return 0, None
+        self._entries.move_to_end(best_key)
+        _, past, _ = self._entries[best_key]
+        return best_len, tuple((k[:, :, :best_len], v[:, :, :best_len]) for k, v in past)
+
+    def put(self, input_ids, past):
+        if len(input_ids) < self.min_prefix:
+            return
+        nbytes = kv_nbytes(past)
+        if nbytes > self.max_bytes * self.max_entry_fraction:
+            return
+        ids = np.asarray(input_ids)
+        key = ids.tobytes()
+        # 已有条目是新序列的前缀时，新条目可以完全替代它
+        for old_key, (old_ids, _, _) in list(self._entries.items()):
+            if len(old_ids) <= len(ids) and np.array_equal(old_ids, ids[:len(old_ids)]):
+                self._remove(old_key)
+        self._entries[key] = (ids, tuple(past), nbytes)
+        self._n_bytes += nbytes
+        while self._n_bytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        _, _, nbytes = self._entries.pop(key)
+        self._n_bytes -= nbytes
+
+
+class InferenceWorker:
+    """
+    每个加载的模型对应一个推理线程，所有会话的请求都进入同一个队列，由它做continuous batching：
+
+    - 每个decode step之前把队列里的新请求prefill后并入当前batch（KV cache左侧补齐到同一长度）
+    - 每个step所有在跑的请求一起前向一次，生成完的请求立即移出batch，空出的位置留给排队的请求
+
+    - prefill时先从PrefixCache中找最长的已缓存前缀，只对新增的token做prefill
+    - 设置了draft_model时，batch中只有一个请求且没有排队的请求时做投机解码：draft模型先逐个猜num_draft_tokens个token，
+      目标模型一次前向验证；接受率低于min_acceptance或比普通解码还慢的请求回退到普通解码
+
+    只适用于KV cache为[batch, head, seq, dim]布局的decoder-only模型（Qwen1.5等）
+    """
+
+    def __init__(self, model, tokenizer, max_batch_size=8, prefix_cache_bytes=1024 ** 3, draft_model=None,
+                 num_draft_tokens=4, min_acceptance=0.4):
+        self.model = model
+        self.draft_model = draft_model
+        self.num_draft_tokens = num_draft_tokens
+        self.min_acceptance = min_acceptance
+        self.tokenizer = tokenizer
+        self.max_batch_size = max_batch_size
+        self.prefix_cache = PrefixCache(prefix_cache_bytes) if prefix_cache_bytes else None
+        gen_config = model.generation_config
+        eos = gen_config.eos_token_id if gen_config.eos_token_id is not None else tokenizer.eos_token_id
+        self.eos_token_ids = set(eos if isinstance(eos, (list, tuple)) else [eos])
+        self.do_sample = bool(gen_config.do_sample)
+        self.temperature = gen_config.temperature or 1.0
+        self.top_k = gen_config.top_k or 0
+        self.top_p = gen_config.top_p or 1.0
+        self.repetition_penalty = gen_config.repetition_penalty or 1.0
+
+        self._queue = queue.Queue()
+        self._active = []
+        self._past = None
+        self._mask = None
+        self._next_ids = None
+        self._wait_times = deque(maxlen=100)
+        self._n_finished = 0
+        self._prompt_tokens = 0
+        self._prefill_tokens = 0
+        self._draft_req = None
+        self._draft_past = None
+        # batch=1时普通解码每个token的耗时（指数平均），作为投机解码加速比的基准
+        self._plain_token_time = None
+        self._spec_history = deque(maxlen=100)
+        self._closed = False
+        self._thread = threading.Thread(target=self._loop, daemon=True, name="inference-worker")
+        self._thread.start()
+
+    def submit(self, input_ids, max_new_tokens=512):
+        req = GenerationRequest(input_ids, max_new_tokens)
+        self._queue.put(req)
+        if self._closed:
+            # close之后才放进队列的请求推理线程不会再处理
+            self._fail_queued()
+        return req
+
+    def stream_text(self, input_ids, max_new_tokens=512):
+        """
+        提交请求并逐段产出解码后的新文本；调用方提前退出时请求会被取消
+        """
+        req = self.submit(input_ids, max_new_tokens)
+        ids = []
+        text = ""
+        try:
+            for tok in req:
+                ids.append(tok)
+                new_text = self.tokenizer.decode(ids, skip_special_tokens=True)
+                # 多字节字符没解码完整时先不输出
+                if new_text.endswith('�'):
+                    continue
+                if len(new_text) > len(text):
+                    yield new_text[len(text):]
+                text = new_text
+        finally:
+            req.cancel()
+
+    def close(self):
+        """
+        停止推理线程，模型被卸载时调用
+        """
+        self._closed = True
+        self._queue.put(None)
+
+    def _fail_queued(self):
+        while True:
+            try:
+                req = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            if req is not None:
+                req.tokens.put(RuntimeError("inference worker closed"))
+
+    def extra_memory(self):
+        """
+        模型参数以外的占用，按设备类型，计入registry的内存预算；前缀缓存随时可能涨到上限，按上限预留
+        """
+        if self.prefix_cache is None:
+            return {}
+        return {self.model.device.type: self.prefix_cache.max_bytes}
+
+    def stats(self):
+        waits = list(self._wait_times)
+        spec = list(self._spec_history)
+        speedups = [h['speedup'] for h in spec if h['speedup'] is not None]
+        return {
+            'queue_depth': self._queue.qsize(),
+            'batch_size': len(self._active),
+            'max_batch_size': self.max_batch_size,
+            'avg_wait_time': sum(waits) / len(waits) if waits else 0.0,
+            'max_wait_time': max(waits) if waits else 0.0,
+            'finished': self._n_finished,
+            'prompt_tokens': self._prompt_tokens,
+            'prefill_tokens': self._prefill_tokens,
+            'prefix_cache_bytes': self.prefix_cache.nbytes if self.prefix_cache is not None else 0,
+            'spec_requests': len(spec),
+            'spec_acceptance': sum(h['acceptance'] for h in spec) / len(spec) if spec else None,
+            'spec_speedup': sum(speedups) / len(speedups) if speedups else None,
+            'spec_last': spec[-1] if spec else None,
+        }
+
+    def _loop(self):
+        while not self._closed:
+            try:
+                if not self._active:
+                    self._admit(self._queue.get())
+                while len(self._active) < self.max_batch_size:
+                    try:
+                        self._admit(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+                if self._active:
+                    if self._use_speculative():
+                        self._spec_step()
+                    else:
+                        self._step()
+            except Exception as e:
+                logger.exception("inference worker step failed")
+                for req in self._active:
+                    req.tokens.put(e)
+                self._active = []
+                self._past = self._mask = self._next_ids = None
+                self._draft_req = self._draft_past = None
+        for req in self._active:
+            req.tokens.put(RuntimeError("inference worker closed"))
+        self._active = []
+        self._past = self._mask = self._next_ids = None
+        self._draft_req = self._draft_past = None
+        self._fail_queued()
+
+    def _admit(self, req):
+        if req is None:
+            return
+        if req.cancelled:
+            req.tokens.put(None)
+            return
+        try:
+            self._prefill(req)
+        except Exception as e:
+            # prefill失败（比如长prompt显存不够）只影响这一个请求，batch中的其他请求照常继续
+            logger.exception("prefill failed")
+            req.tokens.put(e)
+
+    @torch.inference_mode()
+    def _prefill(self, req):
+        req.start_time = time.perf_counter()
+        self._wait_times.append(req.wait_time)
+        device = self.model.device
+        input_ids = torch.tensor([req.input_ids], device=device)
+        prefix_len, prefix_past = 0, None
+        if self.prefix_cache is not None:
+            prefix_len, prefix_past = self.prefix_cache.lookup(req.input_ids)
+            # 至少留一个token做prefill，用来得到下一个token的logits
+            if prefix_len >= len(req.input_ids):
+                prefix_len = len(req.input_ids) - 1
+                prefix_past = tuple((k[:, :, :prefix_len], v[:, :, :prefix_len]) for k, v in prefix_past)
+        out = self.model(input_ids=input_ids[:, prefix_len:], past_key_values=prefix_past, use_cache=True)
+        req.prefill_tokens = len(req.input_ids) - prefix_len
+        self._prompt_tokens += len(req.input_ids)
+        self._prefill_tokens += req.prefill_tokens
+        if self.prefix_cache is not None:
+            self.prefix_cache.put(req.input_ids, out.past_key_values)
+        next_id = self._sample(out.logits[:, -1, :], [req])
+        if self._push(req, int(next_id)):
+            return
+        past = out.past_key_values
+        mask = torch.ones_like(input_ids)
+        if self._active:
+            length = max(self._mask.shape[1], mask.shape[1])
+            self._past = tuple(
+                (torch.cat([_left_pad(k0, length), _left_pad(k1, length)]),
+                 torch.cat([_left_pad(v0, length), _left_pad(v1, length)]))
+                for (k0, v0), (k1, v1) in zip(self._past, past)
+            )
+            self._mask = torch.cat([_left_pad_mask(self._mask, length), _left_pad_mask(mask, length)])
+            self._next_ids = torch.cat([self._next_ids, next_id])
+        else:
+            self._past, self._mask, self._next_ids = tuple(past), mask, next_id
+        self._active.append(req)
+
+    @torch.inference_mode()
+    def _step(self):
+        start = time.perf_counter()
+        single = len(self._active) == 1
+        position_ids = self._mask.sum(dim=1, keepdim=True)
+        self._mask = torch.cat([self._mask, torch.ones_like(self._next_ids)[:, None]], dim=1)
+        out = self.model(input_ids=self._next_ids[:, None], attention_mask=self._mask,
+                         position_ids=position_ids, past_key_values=self._past, use_cache=True)
+        self._past = tuple(out.past_key_values)
+        self._next_ids = self._sample(out.logits[:, -1, :], self._active)
+        self._emit()
+        if single:
+            cost = time.perf_counter() - start
+            self._plain_token_time = cost if self._plain_token_time is None else \
+                0.9 * self._plain_token_time + 0.1 * cost
+
+    def _use_speculative(self):
+        # 还没有普通解码的耗时基准时先走一步普通解码
+        return (self.draft_model is not None and len(self._active) == 1 and self._active[0].speculative
+                and self._queue.empty() and self._plain_token_time is not None)
+
+    @torch.inference_mode()
+    def _spec_step(self):
+        """
+        对batch中唯一的请求做一轮投机解码
+
+        进入时self._past覆盖序列中除最后一个token（self._next_ids）以外的部分，且没有padding；
+        结束时保持同样的约定，所以随时可以和普通的batch解码互相切换
+        """
+        start = time.perf_counter()
+        req = self._active[0]
+        k = self.num_draft_tokens
+        seq = req.input_ids + req.output_ids
+        if self._draft_req is not req:
+            self._draft_req, self._draft_past = req, None
+        # draft模型先补上还没处理过的token（序列只会追加，之前的KV cache仍然有效），再逐个猜k个token
+        draft_len = self._draft_past[0][0].shape[2] if self._draft_past is not None else 0
+        feed = seq[draft_len:]
+        past = self._draft_past
+        draft_ids, draft_logits = [], []
+        for _ in range(k):
+            out = self.draft_model(input_ids=torch.tensor([feed], device=self.draft_model.device),
+                                   past_key_values=past, use_cache=True)
+            past = out.past_key_values
+            logits = self._warp(out.logits[:, -1, :].to(self.model.device), [seq + draft_ids])
+            tok = int(torch.multinomial(logits.softmax(dim=-1), 1)) if self.do_sample else int(logits.argmax())
+            draft_ids.append(tok)
+            draft_logits.append(logits[0])
+            feed = [tok]
+        # 目标模型一次前向处理next token和k个猜测，得到k+1个位置的分布
+        out = self.model(input_ids=torch.tensor([[seq[-1]] + draft_ids], device=self.model.device),
+                         past_key_values=self._past, use_cache=True)
+        target_logits = self._warp(out.logits[0], [seq + draft_ids[:i] for i in range(k + 1)])
+        n = 0
+        if not self.do_sample:
+            target_ids = target_logits.argmax(dim=-1).tolist()
+            while n < k and draft_ids[n] == target_ids[n]:
+                n += 1
+            next_tok = target_ids[n]
+        else:
+            # 以min(1, p/q)的概率接受draft的token，拒绝时从max(p - q, 0)中重新采样，输出分布和直接采样相同
+            p = target_logits.softmax(dim=-1)
+            q = torch.stack(draft_logits).softmax(dim=-1)
+            while n < k and float(torch.rand(())) * float(q[n, draft_ids[n]]) <= float(p[n, draft_ids[n]]):
+                n += 1
+            dist = p[n]
+            if n < k:
+                residual = (p[n] - q[n]).clamp(min=0)
+                if residual.sum() > 0:
+                    dist = residual / residual.sum()
+            next_tok = int(torch.multinomial(dist, 1))
+
+        length = len(seq) + n
+        self._past = tuple((kk[:, :, :length], v[:, :, :length]) for kk, v in out.past_key_values)
+        self._draft_past = tuple((kk[:, :, :length], v[:, :, :length]) for kk, v in past)
+        self._mask = torch.ones((1, length), dtype=torch.long, device=self.model.device)
+        self._next_ids = torch.tensor([next_tok], device=self.model.device)
+        req.draft_tokens += k
+        req.accepted_tokens += n
+        req.target_steps += 1
+        produced = 0
+        finished = False
+        for tok in draft_ids[:n] + [next_tok]:
+            produced += 1
+            if self._push(req, tok):
+                finished = True
+                break
+        req.spec_time += time.perf_counter() - start
+        req.spec_output_tokens += produced
+        if finished:
+            self._active = []
+            self._past = self._mask = self._next_ids = None
+            self._draft_req = self._draft_past = None
+            return
+        if req.draft_tokens >= 8 * k:
+            speedup = self._spec_speedup(req)
+            if req.acceptance_rate < self.min_acceptance or (speedup is not None and speedup < 1.0):
+                logger.info("speculative decoding fallback: acceptance %.2f, speedup %s", req.acceptance_rate,
+                            speedup)
+                req.speculative = False
+                self._draft_req = self._draft_past = None
+
+    def _spec_speedup(self, req):
+        if self._plain_token_time is None or not req.spec_output_tokens:
+            return None
+        return self._plain_token_time / (req.spec_time / req.spec_output_tokens)
+
+    def _emit(self):
+        """
+        把self._next_ids交给各自的请求，结束/取消的请求移出batch
+        """
+        keep = [i for i, (req, tok) in enumerate(zip(self._active, self._next_ids.tolist()))
+                if not self._push(req, tok)]
+        if len(keep) == len(self._active):
+            return
+        self._active = [self._active[i] for i in keep]
+        if not keep:
+            self._past = self._mask = self._next_ids = None
+            return
+        idx = torch.tensor(keep, device=self._mask.device)
+        mask = self._mask.index_select(0, idx)
+        # 去掉所有行都是padding的前缀列
+        start = int((mask.sum(dim=0) == 0).int().cumprod(dim=0).sum())
+        self._mask = mask[:, start:]
+        self._past = tuple((k.index_select(0, idx)[:, :, start:], v.index_select(0, idx)[:, :, start:])
+                           for k, v in self._past)
+        self._next_ids = self._next_ids.index_select(0, idx)
+
+    def _push(self, req, tok):
+        """
+        把一个新token交给请求，返回请求是否已经结束
+        """
+        finished = req.cancelled or tok in self.eos_token_ids
+        if not finished:
+            req.output_ids.append(tok)
+            req.tokens.put(tok)
+            finished = len(req.output_ids) >= req.max_new_tokens
+        if finished:
+            req.tokens.put(None)
+            self._n_finished += 1
+            if req.draft_tokens:
+                self._spec_history.append({
+                    'acceptance': req.acceptance_rate,
+                    'tokens_per_target_step': req.spec_output_tokens / req.target_steps,
+                    'speedup': self._spec_speedup(req),
+                    'fallback': not req.speculative,
+                })
+        return finished
+
+    def _sample(self, logits, reqs):
+        logits = self._warp(logits, [req.input_ids + req.output_ids for req in reqs])
+        if not self.do_sample:
+            return logits.argmax(dim=-1)
+        return torch.multinomial(logits.softmax(dim=-1), 1)[:, 0]
+
+    def _warp(self, logits, seen_ids):
+        """
+        按generation_config处理logits：重复惩罚，采样时再做temperature/top_k/top_p；seen_ids是每行已有的token
+        """
+        logits = logits.float()
+        if self.repetition_penalty != 1.0:
+            for i, seen in enumerate(seen_ids):
+                seen = torch.tensor(seen, device=logits.device)
+                score = logits[i].gather(0, seen)
+                score = torch.where(score < 0, score * self.repetition_penalty, score / self.repetition_penalty)
+                logits[i].scatter_(0, seen, score)
+        if not self.do_sample:
+            return logits
+        logits = logits / self.temperature
+        if self.top_k > 0:
+            kth = torch.topk(logits, min(self.top_k, logits.shape[-1])).values[:, -1, None]
+            logits = logits.masked_fill(logits < kth, float('-inf'))
+        if self.top_p < 1.0:
+            sorted_logits, sorted_idx = torch.sort(logits, descending=True)
+            cum = sorted_logits.softmax(dim=-1).cumsum(dim=-1)
+            drop = cum - sorted_logits.softmax(dim=-1) > self.top_p
+            sorted_logits = sorted_logits.masked_fill(drop, float('-inf'))
+            logits = torch.full_like(logits, float('-inf')).scatter(1, sorted_idx, sorted_logits)
+        return logits
+
+
+def _left_pad(t, length):
+    return F.pad(t, (0, 0, length - t.shape[2], 0))
+
+
+def _left_pad_mask(mask, length):
+    return F.pad(mask, (length - mask.shape[1], 0))
+
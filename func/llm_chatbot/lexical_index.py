@@ -0,0 +1,308 @@
+import itertools
+import json
+import math
+import re
+import sqlite3
+import threading
+from collections import Counter
+from typing import List
+
+import jieba
+import numpy as np
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from langchain_core.vectorstores import VectorStore
+
+_token_re = re.compile(r"\w", re.UNICODE)
+
+
+def tokenize(text):
+    """
+    jieba搜索引擎模式分词，英文转小写，丢掉纯标点/空白
+    """
+    return [tok.lower() for tok in jieba.lcut_for_search(text) if _token_re.search(tok)]
+
+
+class LexicalIndex:
+    """
+    持久化的BM25倒排索引，存在sqlite中：
+
+    - chunk: 每个chunk的文本、metadata、长度和是否已删除
+    - posting: 倒排表按段存放，每次add写一个新段，每个出现的词一行(term, seg)，doc序号和词频各存成一个int32 blob，
+      不改写已有的段；按(term, seg)聚簇，查询时只读取问题中出现的词的几个段
+
+    段号是段中第一个chunk的序号。段按chunk数分级（以merge_factor为底的对数），末尾攒够merge_factor个同级的段时
+    合并成一段，段数和每条倒排记录被改写的次数都是O(log N)。删除只标记chunk，查询时用alive过滤；已删除的chunk超过compact_ratio时compact，
+    所有段合并成一段并去掉已删除的序号。chunk长度和存活标记常驻内存，增删chunk时同步更新
+    """
+
+    def __init__(self, path, k1=1.5, b=0.75, merge_factor=8, compact_ratio=0.3):
+        self.k1 = k1
+        self.b = b
+        self.merge_factor = merge_factor
+        self.compact_ratio = compact_ratio
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(path), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS chunk ("
+            "idx INTEGER PRIMARY KEY, chunk_id TEXT UNIQUE, text TEXT, metadata TEXT, "
+            "length INTEGER, alive INTEGER)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS posting (term TEXT, seg INTEGER, idxs BLOB, tfs BLOB, "
+                           "PRIMARY KEY (term, seg)) WITHOUT ROWID")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS posting_seg ON posting (seg)")
+        self._conn.commit()
+        self._load()
+
+    def _load(self):
+        """
+        从sqlite读取chunk长度、存活标记和段号到内存；其他进程提交修改后（data_version变化）重新读取
+        """
+        self._data_version = self._conn.execute("PRAGMA data_version").fetchone()[0]
+        rows = self._conn.execute("SELECT idx, length, alive FROM chunk ORDER BY idx").fetchall()
+        self._size = rows[-1][0] + 1 if rows else 0
+        self._lengths = np.zeros(self._size, dtype=np.float32)
+        self._alive = np.zeros(self._size, dtype=bool)
+        for idx, length, alive in rows:
+            self._lengths[idx] = length
+            self._alive[idx] = bool(alive)
+        self._n_dead = sum(1 for _, _, alive in rows if not alive)
+        self._segments = [r[0] for r in self._conn.execute("SELECT DISTINCT seg FROM posting ORDER BY seg")]
+        self._stats = None
+
+    def _sync(self):
+        if self._conn.execute("PRAGMA data_version").fetchone()[0] != self._data_version:
+            self._load()
+
+    def __len__(self):
+        with self._lock:
+            self._sync()
+            return int(self._alive[:self._size].sum())
+
+    def add(self, chunk_ids, docs: List[Document]):
+        """
+        增量加入chunk，已存在的chunk_id会先被删除；本次的倒排表写成新的一段，段号是第一个chunk的序号
+        """
+        self.delete(chunk_ids)
+        with self._lock:
+            self._sync()
+            start = self._size
+            postings = {}
+            rows = []
+            for i, (chunk_id, doc) in enumerate(zip(chunk_ids, docs)):
+                tokens = tokenize(doc.page_content)
+                rows.append((start + i, chunk_id, doc.page_content, json.dumps(doc.metadata, ensure_ascii=False),
+                             len(tokens), 1))
+                for tok, tf in Counter(tokens).items():
+                    postings.setdefault(tok, ([], []))
+                    postings[tok][0].append(start + i)
+                    postings[tok][1].append(tf)
+            if not rows:
+                return
+            self._conn.executemany("INSERT INTO chunk VALUES (?, ?, ?, ?, ?, ?)", rows)
+            self._conn.executemany("INSERT INTO posting VALUES (?, ?, ?, ?)", [
+                (tok, start, np.asarray(idxs, dtype=np.int32).tobytes(), np.asarray(tfs, dtype=np.int32).tobytes())
+                for tok, (idxs, tfs) in postings.items()])
+            self._grow(start + len(rows))
+            self._lengths[start:self._size] = [r[4] for r in rows]
+            self._alive[start:self._size] = True
+            self._stats = None
+            self._segments.append(start)
+            self._maybe_merge()
+            self._conn.commit()
+
+    def _segment_level(self, i):
+        end = self._segments[i + 1] if i + 1 < len(self._segments) else self._size
+        return int(math.log(max(end - self._segments[i], 1), self.merge_factor))
+
+    def _maybe_merge(self):
+        # 末尾有merge_factor个同一级别的段时合并成一段，合并后的段升一级，可能继续触发合并
+        n = self.merge_factor
+        while len(self._segments) >= n and len({self._segment_level(i) for i in
+                                                range(len(self._segments) - n, len(self._segments))}) == 1:
+            self._merge_tail(len(self._segments) - n)
+
+    def _merge_tail(self, i):
+        """
+        第i段及之后的段合并成一段，段号用第i段的；只在一段中出现的词直接改段号，不读出来
+        """
+        first = self._segments[i]
+        multi = "SELECT term FROM posting WHERE seg >= ? GROUP BY term HAVING COUNT(*) > 1"
+        cur = self._conn.execute(f"SELECT term, seg, idxs, tfs FROM posting WHERE seg >= ? AND term IN ({multi}) "
+                                 f"ORDER BY term, seg", (first, first))
+        merged = list(self._merge_rows(cur, first))
+        self._conn.execute(f"DELETE FROM posting WHERE seg >= ? AND term IN ({multi})", (first, first))
+        self._conn.execute("UPDATE posting SET seg = ? WHERE seg > ?", (first, first))
+        self._conn.executemany("INSERT INTO posting VALUES (?, ?, ?, ?)", merged)
+        del self._segments[i + 1:]
+
+    def _merge_rows(self, cur, seg):
+        """
+        cur按(term, seg)有序，同一个词的几段拼成一段，去掉已删除的序号
+        """
+        for term, rows in itertools.groupby(cur, key=lambda row: row[0]):
+            rows = list(rows)
+            idxs = np.concatenate([np.frombuffer(row[2], dtype=np.int32) for row in rows])
+            tfs = np.concatenate([np.frombuffer(row[3], dtype=np.int32) for row in rows])
+            keep = self._alive[idxs]
+            if keep.any():
+                yield term, seg, idxs[keep].tobytes(), tfs[keep].tobytes()
+
+    def _grow(self, size):
+        # 容量按倍数增长，追加的均摊开销和已有chunk数无关；查询时只看前_size个
+        if size > len(self._alive):
+            capacity = max(size, 2 * len(self._alive))
+            self._lengths = np.concatenate([self._lengths[:self._size],
+                                            np.zeros(capacity - self._size, dtype=np.float32)])
+            self._alive = np.concatenate([self._alive[:self._size], np.zeros(capacity - self._size, dtype=bool)])
+        self._size = size
+
+    def delete(self, chunk_ids):
+        with self._lock:
+            self._sync()
+            idxs = []
+            for i in range(0, len(chunk_ids), 500):
+                batch = list(chunk_ids[i:i + 500])
+                idxs.extend(r[0] for r in self._conn.execute(
+                    f"SELECT idx FROM chunk WHERE chunk_id IN ({','.join('?' * len(batch))})", batch))
+            if not idxs:
+                return
+            # 倒排表里保留已删除的序号，查询时用alive过滤，compact时再清掉；chunk_id置空以便重新加入
+            self._conn.executemany("UPDATE chunk SET alive = 0, chunk_id = NULL, text = NULL WHERE idx = ?",
+                                   [(idx,) for idx in idxs])
+            self._conn.commit()
+            self._alive[idxs] = False
+            self._stats = None
+            self._n_dead += len(idxs)
+            if self._n_dead > self.compact_ratio * self._size:
+                self._compact()
+
+    def compact(self):
+        with self._lock:
+            self._sync()
+            self._compact()
+
+    def _compact(self):
+        """
+        所有段合并成第0段并去掉已删除的序号，再删掉已删除的chunk行
+        """
+        cur = self._conn.execute("SELECT term, seg, idxs, tfs FROM posting ORDER BY term, seg")
+        merged = list(self._merge_rows(cur, 0))
+        self._conn.execute("DELETE FROM posting")
+        self._conn.executemany("INSERT INTO posting VALUES (?, ?, ?, ?)", merged)
+        self._conn.execute("DELETE FROM chunk WHERE alive = 0")
+        self._conn.commit()
+        self._n_dead = 0
+        self._segments = [0] if merged else []
+
+    def _doc_stats(self):
+        """
+        (alive, n_docs, norm)，norm是每个chunk的BM25长度归一项k1 * (1 - b + b * len / avgdl)，增删chunk后重新计算
+        """
+        if self._stats is None:
+            alive = self._alive[:self._size]
+            lengths = self._lengths[:self._size]
+            n_docs = int(alive.sum())
+            avgdl = (float(lengths[alive].mean()) if n_docs else 0.0) or 1.0
+            norm = (self.k1 * (1 - self.b + self.b * lengths / avgdl)).astype(np.float32)
+            norm[~alive] = np.inf
+            self._stats = alive, n_docs, norm
+        return self._stats
+
+    def search(self, query, k=4):
+        """
+        返回[(Document, score)]，按BM25分数从高到低
+        """
+        terms = list(set(tokenize(query)))
+        if not terms:
+            return []
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT term, idxs, tfs FROM posting WHERE term IN ({','.join('?' * len(terms))}) ORDER BY term, seg",
+                terms).fetchall()
+            # 读完倒排表之后再同步，状态不会比读到的倒排表旧
+            self._sync()
+            alive, n_docs, norm = self._doc_stats()
+            # 倒排表里还有已删除的序号时才需要按alive重新统计df
+            n_dead = self._n_dead
+        if not n_docs:
+            return []
+        segments = {}
+        for term, idxs_blob, tfs_blob in rows:
+            segments.setdefault(term, ([], []))
+            segments[term][0].append(np.frombuffer(idxs_blob, dtype=np.int32))
+            segments[term][1].append(np.frombuffer(tfs_blob, dtype=np.int32))
+        postings = []
+        for idx_parts, tf_parts in segments.values():
+            # 段按段号有序，拼起来的序号是递增的
+            idxs = np.concatenate(idx_parts)
+            df = int(np.count_nonzero(alive[idxs])) if n_dead else len(idxs)
+            if df:
+                postings.append((math.log(1 + (n_docs - df + 0.5) / (df + 0.5)), idxs, tf_parts))
+        # MaxScore：按idf从高到低累加，一个词的得分不超过idf * (k1 + 1)；剩下的词的上界之和不超过当前第k名时，
+        # 还没出现过的chunk不可能进入前k，之后只更新候选chunk，出现在大多数chunk里的常见词不用整个扫一遍
+        postings.sort(key=lambda p: -p[0])
+        rest = sum(idf for idf, _, _ in postings) * (self.k1 + 1)
+        scores = np.zeros(len(alive), dtype=np.float32)
+        cand = None
+        for idf, idxs, tf_parts in postings:
+            if cand is None:
+                touched = np.flatnonzero(scores)
+                if len(touched) >= k:
+                    theta = np.partition(scores[touched], len(touched) - k)[len(touched) - k]
+                    if rest <= theta:
+                        cand = touched[scores[touched] + rest >= theta]
+            rest -= idf * (self.k1 + 1)
+            tfs = np.concatenate(tf_parts)
+            if cand is not None:
+                pos = np.minimum(np.searchsorted(idxs, cand), len(idxs) - 1)
+                hit = idxs[pos] == cand
+                idxs, tfs = cand[hit], tfs[pos[hit]]
+            tfs = tfs.astype(np.float32)
+            # 同一个词的序号不重复，直接按下标累加；已删除的chunk归一项是inf，得分为0
+            scores[idxs] += np.float32(idf * (self.k1 + 1)) * tfs / (tfs + norm[idxs])
+        k = min(k, int((scores > 0).sum()))
+        if k == 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        with self._lock:
+            found = {idx: (text, metadata) for idx, text, metadata in self._conn.execute(
+                f"SELECT idx, text, metadata FROM chunk WHERE idx IN ({','.join('?' * len(top))})",
+                [int(i) for i in top])}
+        return [(Document(page_content=found[idx][0], metadata=json.loads(found[idx][1])), float(scores[idx]))
+                for idx in top.tolist() if idx in found]
+
+
+def _doc_key(doc):
+    return doc.metadata.get('source'), doc.page_content
+
+
+class HybridRetriever(BaseRetriever):
+    """
+    向量检索 + BM25，用reciprocal-rank fusion合并两路结果: score = sum(1 / (rrf_k + rank))
+    """
+    vectorstore: VectorStore
+    lexical_index: LexicalIndex
+    k: int = 4
+    fetch_k: int = 20
+    rrf_k: int = 60
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def _get_relevant_documents(
+            self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        vector_docs = self.vectorstore.similarity_search(query, k=self.fetch_k)
+        lexical_docs = [doc for doc, _ in self.lexical_index.search(query, k=self.fetch_k)]
+        scores = {}
+        docs = {}
+        for ranked in [vector_docs, lexical_docs]:
+            for rank, doc in enumerate(ranked):
+                key = _doc_key(doc)
+                docs.setdefault(key, doc)
+                scores[key] = scores.get(key, 0.0) + 1.0 / (self.rrf_k + rank + 1)
+        top = sorted(scores, key=scores.get, reverse=True)[:self.k]
+        return [docs[key] for key in top]
@@ -1,40 +1,70 @@
+import logging
+import multiprocessing
 import platform
-import shutil
+import time
 import uuid
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from pathlib import Path
-from typing import Optional, List, Any
+from threading import Event, Thread
+from typing import Optional, List, Any, Iterator
 
+import pandas as pd
 import pynvml
 import streamlit as st
 import torch
-from langchain.chains.conversational_retrieval.base import ConversationalRetrievalChain
 from langchain.memory import ConversationBufferMemory
 from langchain_community.document_loaders.markdown import UnstructuredMarkdownLoader
 from langchain_community.document_loaders.pdf import UnstructuredPDFLoader
 from langchain_community.document_loaders.unstructured import UnstructuredFileLoader
 from langchain_community.document_loaders.word_document import UnstructuredWordDocumentLoader
 from langchain_community.embeddings.huggingface import HuggingFaceEmbeddings
-from langchain_community.llms.ollama import Ollama
 from langchain_community.vectorstores.chroma import Chroma
 from langchain_core.callbacks import BaseCallbackHandler
 from langchain_core.callbacks import CallbackManagerForLLMRun
+from langchain_core.documents import Document
 from langchain_core.language_models import LLM
+from langchain_core.outputs import GenerationChunk
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from tqdm import tqdm
-from transformers import AutoModel, AutoTokenizer, AutoModelForCausalLM
-
-from settings import PERSISTENT_DIRECTORY, KG_DATA_PATH, EMBEDDING_PATH, MODEL_PATH, KG_PROCESSED_DATA_PATH
+from transformers import AutoModel, AutoTokenizer, AutoModelForCausalLM, TextIteratorStreamer, StoppingCriteria, \
+    StoppingCriteriaList
+
+from func.file_lock import file_lock
+from func.llm_chatbot.answer_cache import SemanticAnswerCache
+from func.llm_chatbot.cpu_inference import load_cpu_model, set_cpu_threads, estimate_cpu_model_memory
+from func.llm_chatbot.dedup import ChunkDeduper
+from func.llm_chatbot.embedding_cache import CachedEmbeddings
+from func.llm_chatbot.inference_worker import InferenceWorker
+from func.llm_chatbot.lexical_index import LexicalIndex, HybridRetriever
+from func.llm_chatbot.manifest import IngestManifest, make_chunk_ids, backfill_legacy
+from func.llm_chatbot.memory import TokenBudgetMemory, SessionCache
+from func.llm_chatbot.metrics import MetricsStore
+from func.llm_chatbot.mmap_vectorstore import MmapVectorStore
+from func.llm_chatbot.model_registry import ModelRegistry, estimate_model_memory
+from func.llm_chatbot.ollama_client import PooledOllama
+from func.llm_chatbot.qa_chain import QAChain
+from settings import PERSISTENT_DIRECTORY, KG_DATA_PATH, EMBEDDING_PATH, MODEL_PATH, KG_MANIFEST_PATH, KG_LOAD_WORKERS, \
+    KG_PROCESSED_DATA_PATH, KG_INGEST_LOCK_PATH, EMBEDDING_CACHE_PATH, EMBEDDING_CACHE_MAX_ENTRIES, INFERENCE_MAX_BATCH_SIZE, PREFIX_CACHE_BYTES, MODEL_MEMORY_BUDGET, MODEL_PRELOAD, \
+    ANSWER_CACHE_ENABLED, ANSWER_CACHE_THRESHOLD, ANSWER_CACHE_TTL, ANSWER_CACHE_MAX_ENTRIES, \
+    LEXICAL_INDEX_PATH, RETRIEVER_MODE, KG_CHUNK_SIZE, KG_CHUNK_OVERLAP, METRICS_LOG_PATH, \
+    MEMORY_TOKEN_BUDGET, MEMORY_RECENT_TURNS, MEMORY_PRUNE_TO, SESSION_CACHE_MAX_ENTRIES, SESSION_CACHE_IDLE_TTL, \
+    CONDENSE_SKIP_SELF_CONTAINED, CONDENSE_MODEL, CONDENSE_MAX_NEW_TOKENS, \
+    VECTOR_STORE, MMAP_VECTOR_DIRECTORY, MMAP_VECTOR_DTYPE, MMAP_IVF_NLIST, MMAP_IVF_NPROBE, MMAP_COMPACT_RATIO, \
+    KG_DEDUP_ENABLED, KG_DEDUP_THRESHOLD, MODEL_CPU_MODE, CPU_DEFAULT_MODE, CPU_NUM_THREADS, CPU_INTEROP_THREADS, \
+    QUANTIZED_MODEL_CACHE, SPECULATIVE_DRAFT, SPECULATIVE_DRAFT_TOKENS, SPECULATIVE_MIN_ACCEPTANCE, \
+    OLLAMA_BASE_URL, OLLAMA_KEEP_ALIVE, OLLAMA_WARMUP, OLLAMA_POOL_SIZE, OLLAMA_CONNECT_TIMEOUT, OLLAMA_READ_TIMEOUT, \
+    OLLAMA_MAX_RETRIES
+
+logger = logging.getLogger(__name__)
 
 module_path = Path('').resolve()
-if not PERSISTENT_DIRECTORY.exists():
-    PERSISTENT_DIRECTORY.mkdir()
-if not KG_PROCESSED_DATA_PATH.exists():
-    KG_PROCESSED_DATA_PATH.mkdir()
 
 
 class MyCustomCallbackHandler(BaseCallbackHandler):
     """
-    无法使用在本地LLM是因为没有触发过on_llm_new_token事件
+    打印LLM生成的token，本地LLM通过MyLLM._stream同样会触发on_llm_new_token事件
     """
 
     def on_llm_new_token(
@@ -45,64 +75,245 @@ class MyCustomCallbackHandler(BaseCallbackHandler):
         print(f"model generated: {token}")
 
 
+class StreamlitTokenHandler(BaseCallbackHandler):
+    """
+    把LLM生成的token实时渲染到streamlit容器中，并记录首token时间和总耗时
+
+    每次on_llm_start都会清空容器，最终留下的是回答生成阶段的输出（前面可能有一次question改写的生成）
+    """
+
+    def __init__(self, container):
+        self.container = container
+        self.text = ""
+        self.start_time = time.perf_counter()
+        self.first_token_time = None
+
+    def on_llm_start(self, serialized, prompts, **kwargs: Any) -> None:
+        self.text = ""
+        self.first_token_time = None
+
+    def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        if self.first_token_time is None:
+            self.first_token_time = time.perf_counter()
+        self.text += token
+        self.container.markdown(self.text + "▌")
+
+    @property
+    def ttft(self):
+        if self.first_token_time is None:
+            return None
+        return self.first_token_time - self.start_time
+
+
+class _CancelCriteria(StoppingCriteria):
+    """
+    消费方不再读取时设置event，generate在下一步停止
+    """
+
+    def __init__(self, event):
+        self.event = event
+
+    def __call__(self, input_ids, scores, **kwargs) -> bool:
+        return self.event.is_set()
+
+
+def _stream_generate(model, tok, iids, **kw):
+    """
+    在后台线程中调用model.generate，通过TextIteratorStreamer逐段产出新生成的文本
+
+    generate抛出的异常在这里重新抛出，不会让读取streamer的一方一直等下去；
+    消费方提前停止（关闭生成器）时generate也随之停止，不会继续生成到max_new_tokens
+    """
+    streamer = TextIteratorStreamer(tok, skip_prompt=True, skip_special_tokens=True)
+    cancel = Event()
+    errors = []
+    kw.setdefault('max_new_tokens', 512)
+
+    def run():
+        try:
+            model.generate(
+                inputs=torch.tensor([iids]).to(model.device),
+                streamer=streamer,
+                stopping_criteria=StoppingCriteriaList([_CancelCriteria(cancel)]),
+                **(model.generation_config.to_dict() | kw),
+            )
+        except BaseException as e:
+            errors.append(e)
+            streamer.end()
+
+    thread = Thread(target=run, daemon=True)
+    thread.start()
+    try:
+        for text in streamer:
+            if text:
+                yield text
+    finally:
+        cancel.set()
+        thread.join()
+    if errors:
+        raise errors[0]
+
+
+# 使用共享推理线程（continuous batching、前缀缓存、投机解码）的模型
+WORKER_MODELS = ['Qwen1.5-0.5b-chat', 'Qwen1.5-7b-chat', 'Qwen1.5-1.8b-chat', 'Qwen1.5-14b-chat']
+
+
+def get_cpu_mode(model_name):
+    """
+    模型的CPU推理模式，None表示有GPU时按原方式加载
+    """
+    return MODEL_CPU_MODE.get(model_name) or (None if torch.cuda.is_available() else CPU_DEFAULT_MODE)
+
+
+def _from_pretrained(model_cls, model_name, **kw):
+    mode = get_cpu_mode(model_name)
+    if mode:
+        return load_cpu_model(model_cls, MODEL_PATH[model_name], mode, QUANTIZED_MODEL_CACHE)
+    return model_cls.from_pretrained(MODEL_PATH[model_name], trust_remote_code=True, device_map="auto", **kw).eval()
+
+
+def estimate_memory(model_name):
+    mode = get_cpu_mode(model_name)
+    if mode:
+        estimate = estimate_cpu_model_memory(MODEL_PATH[model_name], mode, QUANTIZED_MODEL_CACHE)
+    else:
+        estimate = estimate_model_memory(MODEL_PATH[model_name])
+    if model_name in WORKER_MODELS and PREFIX_CACHE_BYTES:
+        # 推理线程的前缀缓存和模型放在同一个设备上，按上限预留
+        device = next(iter(estimate))
+        estimate[device] += PREFIX_CACHE_BYTES
+    return estimate
+
+
 @st.cache_resource
-def get_model_tokenizer(model_name):
+def get_tokenizer(model_name):
+    """
+    计数token用的tokenizer，不加载模型权重，常驻内存
+    """
+    return AutoTokenizer.from_pretrained(MODEL_PATH[model_name], trust_remote_code=True)
+
+
+def load_model_tokenizer(model_name):
+    """
+    返回的model上挂载了stream_chat_tokens(tok, ques)，逐段产出生成的文本，供MyLLM流式输出
+
+    不要直接调用，通过get_model_registry()借用模型，由registry控制内存预算
+    """
     tokenizer = AutoTokenizer.from_pretrained(MODEL_PATH[model_name], trust_remote_code=True)
     if model_name in ['chatglm3-6b']:
-        model = AutoModel.from_pretrained(MODEL_PATH[model_name], trust_remote_code=True, load_in_4bit=True,
-                                          device_map="auto").eval()
-    elif model_name in ['Qwen1.5-0.5b-chat', 'Qwen1.5-7b-chat', 'Qwen1.5-1.8b-chat', 'Qwen1.5-14b-chat']:
-        model = AutoModelForCausalLM.from_pretrained(MODEL_PATH[model_name], trust_remote_code=True,
-                                                     device_map="auto").eval()
-
-        def chat(tok, ques, history=[], **kw):
+        # bitsandbytes的4bit量化只能在GPU上用，CPU上按get_cpu_mode加载
+        model = _from_pretrained(AutoModel, model_name, load_in_4bit=True)
+
+        def stream_chat_tokens(tok, ques, **kw):
+            # chatglm3自带的stream_chat每次产出的是累计的回答
+            pos = 0
+            for response, _ in model.stream_chat(tok, ques, history=[], **kw):
+                if len(response) > pos:
+                    yield response[pos:]
+                    pos = len(response)
+
+        model.stream_chat_tokens = stream_chat_tokens
+    elif model_name in WORKER_MODELS:
+        model = _from_pretrained(AutoModelForCausalLM, model_name)
+
+        def stream_chat_tokens(tok, ques, history=None, max_new_tokens=512, **kw):
+            # 所有会话共享同一个推理线程，请求在其中做continuous batching
             iids = tok.apply_chat_template(
-                history + [{'role': 'user', 'content': ques}],
+                (history or []) + [{'role': 'user', 'content': ques}],
                 add_generation_prompt=1,
             )
-            kw['max_new_tokens'] = 512
-            oids = model.generate(
-                inputs=torch.tensor([iids]).to(model.device),
-                **(model.generation_config.to_dict() | kw),
-            )
-            oids = oids[0][len(iids):].tolist()
-            if oids[-1] == tok.eos_token_id:
-                oids = oids[:-1]
-            ans = tok.decode(oids)
-            history.append({'role': 'assistant', 'content': ans})
-            return ans, history
-
-        model.chat = chat
+            yield from model.worker.stream_text(iids, max_new_tokens=max_new_tokens)
+
+        draft_name = SPECULATIVE_DRAFT.get(model_name)
+        # draft模型跟随目标模型加载和卸载，内存计入目标模型
+        model.draft_model = _from_pretrained(AutoModelForCausalLM, draft_name) if draft_name else None
+        model.worker = InferenceWorker(model, tokenizer, max_batch_size=INFERENCE_MAX_BATCH_SIZE,
+                                       prefix_cache_bytes=PREFIX_CACHE_BYTES, draft_model=model.draft_model,
+                                       num_draft_tokens=SPECULATIVE_DRAFT_TOKENS,
+                                       min_acceptance=SPECULATIVE_MIN_ACCEPTANCE)
+        model.stream_chat_tokens = stream_chat_tokens
     else:
-        model = AutoModelForCausalLM.from_pretrained(MODEL_PATH[model_name], trust_remote_code=True,
-                                                     device_map="auto").eval()
+        model = _from_pretrained(AutoModelForCausalLM, model_name)
+
+        def stream_chat_tokens(tok, ques, **kw):
+            # MiniCPM的tokenizer自带<用户>/<AI>的chat_template
+            iids = tok.apply_chat_template([{'role': 'user', 'content': ques}], add_generation_prompt=True)
+            yield from _stream_generate(model, tok, iids, **kw)
+
+        model.stream_chat_tokens = stream_chat_tokens
     return model, tokenizer
 
 
+@st.cache_resource
+def get_model_registry():
+    set_cpu_threads(CPU_NUM_THREADS, CPU_INTEROP_THREADS)
+    registry = ModelRegistry(load_model_tokenizer, MODEL_MEMORY_BUDGET, MODEL_PATH, estimate=estimate_memory)
+    if MODEL_PRELOAD:
+        registry.preload(MODEL_PRELOAD)
+    return registry
+
+
 class MyLLM(LLM):
-    tokenizer: AutoTokenizer = None
-    model: AutoModel = None
+    """
+    不持有模型对象，每次生成时从registry借用，空闲的模型可以被淘汰
+    """
     model_name: str = None
+    max_new_tokens: int = 512
 
-    def __init__(self, model_name: str):
+    def __init__(self, model_name: str, max_new_tokens: int = 512):
         super().__init__()
-        self.model, self.tokenizer = get_model_tokenizer(model_name)
         self.model_name = model_name
+        self.max_new_tokens = max_new_tokens
 
     def _call(self, prompt: str, stop: Optional[List[str]] = None,
               run_manager: Optional[CallbackManagerForLLMRun] = None,
               **kwargs: Any):
-        response, history = self.model.chat(self.tokenizer, prompt)
-        return response
+        return "".join(chunk.text for chunk in self._stream(prompt, stop, run_manager, **kwargs))
+
+    def _stream(self, prompt: str, stop: Optional[List[str]] = None,
+                run_manager: Optional[CallbackManagerForLLMRun] = None,
+                **kwargs: Any) -> Iterator[GenerationChunk]:
+        with get_model_registry().use(self.model_name) as (model, tokenizer):
+            for text in model.stream_chat_tokens(tokenizer, prompt, max_new_tokens=self.max_new_tokens):
+                chunk = GenerationChunk(text=text)
+                if run_manager:
+                    run_manager.on_llm_new_token(text, chunk=chunk)
+                yield chunk
+
+    def get_num_tokens(self, text: str) -> int:
+        # 只用tokenizer计数，不借用模型，被淘汰的模型不会因为计数被重新加载
+        return len(get_tokenizer(self.model_name).encode(text))
 
     @property
     def _llm_type(self) -> str:
         return self.model_name
 
 
+OLLAMA_MODELS = ['qwen:0.5b', 'llama3', 'wizardlm2']
+
+
+@st.cache_resource
+def warm_ollama(model_name):
+    """
+    每个模型只预加载一次，在后台线程中进行，不阻塞页面
+    """
+
+    def run():
+        try:
+            get_llm(model_name).warm()
+        except Exception as e:
+            logger.warning("failed to warm up ollama model %s: %s", model_name, e)
+
+    Thread(target=run, daemon=True, name=f"ollama-warmup-{model_name}").start()
+
+
 def get_llm(model_name):
-    if model_name in ['wizardlm2', 'llama3', 'qwen:0.5b']:
-        return Ollama(model=model_name, callbacks=[MyCustomCallbackHandler()])
+    if model_name in OLLAMA_MODELS:
+        # 所有实例共用同一个base_url的连接池，创建实例没有额外开销
+        return PooledOllama(model=model_name, base_url=OLLAMA_BASE_URL, keep_alive=OLLAMA_KEEP_ALIVE,
+                            pool_size=OLLAMA_POOL_SIZE, connect_timeout=OLLAMA_CONNECT_TIMEOUT,
+                            read_timeout=OLLAMA_READ_TIMEOUT, max_retries=OLLAMA_MAX_RETRIES,
+                            callbacks=[MyCustomCallbackHandler()])
     llm = MyLLM(model_name)
     return llm
 
@@ -112,63 +323,316 @@ def find_kg_files(folder_path):
     for suffix in ["md", "txt", "docx", 'pdf']:
         for fpath in folder_path.glob(f"**/*.{suffix}"):
             files.append(str(fpath))
-    return files
+    return sorted(files)
+
+
+def load_file(one_file):
+    file_type = one_file.split('.')[-1]
+    if file_type == 'md':
+        loader = UnstructuredMarkdownLoader(one_file)
+    elif file_type == 'txt':
+        loader = UnstructuredFileLoader(one_file)
+    elif file_type == 'docx':
+        loader = UnstructuredWordDocumentLoader(one_file)
+    elif file_type == 'pdf':
+        loader = UnstructuredPDFLoader(one_file, strategy="fast")
+    else:
+        return []
+    return loader.load()
+
+
+def _safe_load_file(one_file):
+    try:
+        return one_file, load_file(one_file), None
+    except Exception as e:
+        return one_file, [], f"{type(e).__name__}: {e}"
 
 
-def get_text(dir_path):
-    file_lst = find_kg_files(dir_path)
+def iter_text(file_lst, workers=1):
+    """
+    逐个文件产出(one_file, docs, err)，顺序与file_lst一致；解析失败的文件err不为None，不会中断整批加载
+
+    workers > 1 时用进程池并行解析pdf/docx等CPU密集的文件，加载完一个就产出一个，可以直接流式送给splitter；
+    子进程用spawn启动（streamlit进程里有很多线程，fork不安全），某个文件让解析进程崩溃时只有这个文件失败
+    """
+    if workers <= 1 or len(file_lst) <= 1:
+        for one_file in tqdm(file_lst):
+            yield _safe_load_file(one_file)
+        return
+    ctx = multiprocessing.get_context('spawn')
+    n_workers = min(workers, len(file_lst))
+    executor = ProcessPoolExecutor(max_workers=n_workers, mp_context=ctx)
+    # 最多2*n_workers个文件在解析或者等待产出，解析结果不会在父进程里堆积
+    window = 2 * n_workers
+    pending = deque()
+    n_submitted = 0
+    try:
+        for i, one_file in enumerate(tqdm(file_lst)):
+            while n_submitted < min(len(file_lst), i + window):
+                pending.append(executor.submit(_safe_load_file, file_lst[n_submitted]))
+                n_submitted += 1
+            future = pending.popleft()
+            try:
+                result = future.result()
+            except BrokenProcessPool:
+                # 进程池坏掉后所有未完成的文件都会失败，单独重试当前文件，确认是不是它导致的
+                executor.shutdown(wait=False, cancel_futures=True)
+                result = _load_file_isolated(one_file, ctx)
+                executor = ProcessPoolExecutor(max_workers=n_workers, mp_context=ctx)
+                pending = deque(future if _loaded(future) else executor.submit(_safe_load_file, file_lst[i + 1 + j])
+                                for j, future in enumerate(pending))
+            yield result
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _loaded(future):
+    return future.done() and not future.cancelled() and not isinstance(future.exception(), BrokenProcessPool)
+
+
+def _load_file_isolated(one_file, ctx):
+    with ProcessPoolExecutor(max_workers=1, mp_context=ctx) as executor:
+        try:
+            return executor.submit(_safe_load_file, one_file).result()
+        except BrokenProcessPool:
+            return one_file, [], "解析进程异常退出"
+
+
+def get_text(dir_path, file_lst=None, workers=KG_LOAD_WORKERS):
+    if file_lst is None:
+        file_lst = find_kg_files(dir_path)
     docs = []
-    for one_file in tqdm(file_lst):
-        file_type = one_file.split('.')[-1]
-        if file_type == 'md':
-            loader = UnstructuredMarkdownLoader(one_file)
-        elif file_type == 'txt':
-            loader = UnstructuredFileLoader(one_file)
-        elif file_type == 'docx':
-            loader = UnstructuredWordDocumentLoader(one_file)
-        elif file_type == 'pdf':
-            loader = UnstructuredPDFLoader(one_file, strategy="fast")
-        else:
+    for one_file, file_docs, err in iter_text(file_lst, workers):
+        if err is not None:
+            logger.warning("failed to load %s: %s", one_file, err)
             continue
-        docs.extend(loader.load())
-        shutil.move(one_file, KG_PROCESSED_DATA_PATH)
+        docs.extend(file_docs)
     return docs
 
 
 @st.cache_resource
-def create_vectordb():
-    docs = get_text(KG_DATA_PATH)
-
+def get_embeddings():
     embeddings = HuggingFaceEmbeddings(
         model_name=str(EMBEDDING_PATH))
-    if len(docs) != 0:
-        text_splitter = RecursiveCharacterTextSplitter(chunk_size=500, chunk_overlap=150)  # 分块大小，块重叠长度
-        split_docs = text_splitter.split_documents(docs)
-        vectordb = Chroma.from_documents(documents=split_docs, embedding=embeddings,
-                                         persist_directory=str(PERSISTENT_DIRECTORY))
-        vectordb.persist()
+    return CachedEmbeddings(embeddings, EMBEDDING_PATH, EMBEDDING_CACHE_PATH,
+                            max_entries=EMBEDDING_CACHE_MAX_ENTRIES)
+
+
+@st.cache_resource
+def get_answer_cache():
+    return SemanticAnswerCache(threshold=ANSWER_CACHE_THRESHOLD, ttl=ANSWER_CACHE_TTL,
+                               max_entries=ANSWER_CACHE_MAX_ENTRIES)
+
+
+@st.cache_resource
+def get_lexical_index():
+    return LexicalIndex(LEXICAL_INDEX_PATH)
+
+
+@st.cache_resource
+def get_chunk_deduper():
+    # 和manifest放在一起，切换向量库后端时各自独立
+    manifest_dir = MMAP_VECTOR_DIRECTORY if VECTOR_STORE == 'mmap' else KG_MANIFEST_PATH.parent
+    return ChunkDeduper(manifest_dir / 'kg_dedup.sqlite', threshold=KG_DEDUP_THRESHOLD)
+
+
+@st.cache_resource
+def create_vectordb():
+    """
+    增量重载知识库：manifest记录每个文件的内容hash和chunk id，
+    只对新增/修改过的文件做embedding，删除已移除文件的chunk，未变化的文件不会被加载
+    """
+    KG_DATA_PATH.mkdir(exist_ok=True)
+    # 知识库变化后缓存的回答可能已经过时
+    get_answer_cache().invalidate()
+    embeddings = get_embeddings()
+    if VECTOR_STORE == 'mmap':
+        vectordb = MmapVectorStore(MMAP_VECTOR_DIRECTORY, embeddings, dtype=MMAP_VECTOR_DTYPE,
+                                   nlist=MMAP_IVF_NLIST, nprobe=MMAP_IVF_NPROBE, compact_ratio=MMAP_COMPACT_RATIO)
+        # 每个后端各自记录manifest，切换后端时会完整导入一次
+        manifest_path = MMAP_VECTOR_DIRECTORY / 'kg_manifest.json'
     else:
+        PERSISTENT_DIRECTORY.mkdir(exist_ok=True)
         vectordb = Chroma(persist_directory=str(PERSISTENT_DIRECTORY), embedding_function=embeddings)
+        manifest_path = KG_MANIFEST_PATH
+
+    # streamlit页面和api_server可能同时重载知识库，manifest、去重库、倒排索引和向量库的写入依次进行
+    with file_lock(KG_INGEST_LOCK_PATH):
+        vectordb.ingest_report = _ingest(vectordb, manifest_path)
     return vectordb
 
 
+def _ingest(vectordb, manifest_path):
+    """
+    在ingest锁内执行：manifest在拿到锁之后读取，其他进程刚导入的文件不会重复导入；返回本次导入的统计
+    """
+    manifest = IngestManifest.load(manifest_path)
+    if VECTOR_STORE != 'mmap' and not manifest_path.exists():
+        # 旧版本导入的chunk没有manifest记录，补写一次
+        existing = vectordb.get(include=['metadatas'])
+        if existing['ids']:
+            missing = backfill_legacy(manifest, existing['ids'], existing['metadatas'], KG_DATA_PATH,
+                                      KG_PROCESSED_DATA_PATH)
+            manifest.save()
+            if missing:
+                logger.warning("%d chunks in %s have no source file and will not be updated incrementally; "
+                               "delete the directory to rebuild the knowledge base", len(missing),
+                               PERSISTENT_DIRECTORY)
+    changed, removed = manifest.plan(find_kg_files(KG_DATA_PATH), KG_DATA_PATH)
+    deduper = get_chunk_deduper() if KG_DEDUP_ENABLED else None
+    if deduper is not None and not manifest.entries:
+        deduper.clear()
+    stale_ids = []
+    for rel_path in removed:
+        stale_ids.extend(manifest.chunk_ids(rel_path))
+        manifest.remove(rel_path)
+    for rel_path, _, _ in changed:
+        stale_ids.extend(manifest.chunk_ids(rel_path))
+        manifest.remove(rel_path)
+    if deduper is not None:
+        # 被删除的chunk如果是其他文件中重复chunk保留下来的那一份，这些文件也要重新导入
+        handled = set(removed) | {rel_path for rel_path, _, _ in changed}
+        orphans = deduper.orphans(stale_ids) - handled
+        while orphans:
+            new_ids = []
+            for rel_path in orphans:
+                entry = manifest.entries[rel_path]
+                changed.append((rel_path, str(KG_DATA_PATH / rel_path), entry['sha256']))
+                new_ids.extend(entry['chunk_ids'])
+                manifest.remove(rel_path)
+            handled |= orphans
+            stale_ids.extend(new_ids)
+            orphans = deduper.orphans(new_ids) - handled
+    lexical_index = get_lexical_index()
+    if stale_ids:
+        vectordb.delete(ids=stale_ids)
+        lexical_index.delete(stale_ids)
+        if deduper is not None:
+            deduper.delete(stale_ids)
+    existing = None
+    if len(lexical_index) == 0 and manifest.entries:
+        # 倒排索引是后加的，第一次用已有的向量库补建
+        existing = vectordb.get(include=['documents', 'metadatas'])
+        lexical_index.add(existing['ids'], [Document(page_content=text, metadata=metadata or {})
+                                            for text, metadata in zip(existing['documents'], existing['metadatas'])])
+    if deduper is not None and len(deduper) == 0 and manifest.entries:
+        # 去重是后加的，已有的chunk全部登记为保留，新导入的chunk和它们比较
+        existing = existing or vectordb.get(include=['documents', 'metadatas'])
+        texts = dict(zip(existing['ids'], existing['documents']))
+        for rel_path, entry in manifest.entries.items():
+            chunk_ids = [chunk_id for chunk_id in entry['chunk_ids'] if chunk_id in texts]
+            deduper.add(chunk_ids, [Document(page_content=texts[chunk_id]) for chunk_id in chunk_ids], rel_path,
+                        register_only=True)
+
+    text_splitter = RecursiveCharacterTextSplitter(chunk_size=KG_CHUNK_SIZE, chunk_overlap=KG_CHUNK_OVERLAP)
+    changed_by_path = {fpath: (rel_path, sha) for rel_path, fpath, sha in changed}
+    report = {'files': len(changed), 'chunks': 0, 'dropped_exact': 0, 'dropped_near': 0, 'embedded': 0,
+              'embed_s': 0.0, 'saved_s': 0.0}
+    for fpath, docs, err in iter_text(list(changed_by_path), workers=KG_LOAD_WORKERS):
+        if err is not None:
+            # 不写入manifest，下次重载时会重试
+            logger.warning("failed to load %s: %s", fpath, err)
+            continue
+        rel_path, sha = changed_by_path[fpath]
+        split_docs = text_splitter.split_documents(docs)
+        chunk_ids = make_chunk_ids(rel_path, sha, len(split_docs))
+        # manifest记录全部chunk id，去掉的重复chunk删除时只是不存在于向量库中
+        manifest.record(rel_path, fpath, sha, chunk_ids)
+        report['chunks'] += len(split_docs)
+        all_ids = chunk_ids
+        if deduper is not None:
+            kinds = deduper.add(chunk_ids, split_docs, rel_path)
+            report['dropped_exact'] += kinds.count('exact')
+            report['dropped_near'] += kinds.count('near')
+            kept = [i for i, kind in enumerate(kinds) if kind is None]
+            split_docs = [split_docs[i] for i in kept]
+            chunk_ids = [chunk_ids[i] for i in kept]
+        if split_docs:
+            start = time.perf_counter()
+            try:
+                vectordb.add_documents(split_docs, ids=chunk_ids)
+            except Exception:
+                # 撤销去重登记，否则之后的chunk会被判成和不在向量库里的chunk重复
+                if deduper is not None:
+                    deduper.delete(all_ids)
+                raise
+            report['embed_s'] += time.perf_counter() - start
+            report['embedded'] += len(split_docs)
+            lexical_index.add(chunk_ids, split_docs)
+    if changed or removed:
+        vectordb.persist()
+    manifest.save()
+    dropped = report['dropped_exact'] + report['dropped_near']
+    if report['embedded']:
+        # 按本次每个chunk的平均embedding+写入耗时估算
+        report['saved_s'] = dropped * report['embed_s'] / report['embedded']
+    if report['chunks']:
+        logger.info("knowledge base reloaded: %s", report)
+    return report
+
+
 @st.cache_resource
-def create_memory(session_id):
-    mem = ConversationBufferMemory(memory_key='chat_history', output_key='answer', return_messages=True)
-    return mem
+def get_memory_cache():
+    return SessionCache(max_entries=SESSION_CACHE_MAX_ENTRIES, idle_ttl=SESSION_CACHE_IDLE_TTL)
 
 
 @st.cache_resource
-def create_qa_chain(model_name, session_id, k=4, lambda_mult=0.25):
-    vectordb = create_vectordb()
-    mem = create_memory(session_id)
-    qa_chain = ConversationalRetrievalChain.from_llm(llm=get_llm(model_name),
-                                                     retriever=vectordb.as_retriever(search_type="mmr",
-                                                                                     search_kwargs={'k': k,
-                                                                                                    'lambda_mult': lambda_mult}),
-                                                     return_source_documents=True,
-                                                     memory=mem)
-    return qa_chain, mem
+def get_qa_chain_cache():
+    return SessionCache(max_entries=SESSION_CACHE_MAX_ENTRIES, idle_ttl=SESSION_CACHE_IDLE_TTL)
+
+
+def create_memory(session_id, model_name, llm):
+    def build():
+        if MEMORY_TOKEN_BUDGET:
+            token_counter = llm.get_num_tokens if isinstance(llm, MyLLM) else None
+            return TokenBudgetMemory(llm=llm, max_token_limit=MEMORY_TOKEN_BUDGET, recent_turns=MEMORY_RECENT_TURNS,
+                                     prune_to=MEMORY_PRUNE_TO, token_counter=token_counter,
+                                     metrics_store=get_metrics_store(), metrics_model=model_name,
+                                     memory_key='chat_history', output_key='answer', return_messages=True)
+        return ConversationBufferMemory(memory_key='chat_history', output_key='answer', return_messages=True)
+
+    return get_memory_cache().get((session_id, model_name), build)
+
+
+@st.cache_resource
+def get_metrics_store():
+    return MetricsStore(METRICS_LOG_PATH)
+
+
+def create_retriever(vectordb, k=4, lambda_mult=0.25, mode=RETRIEVER_MODE, lexical_index=None):
+    if mode == 'hybrid':
+        if lexical_index is None:
+            lexical_index = get_lexical_index()
+        return HybridRetriever(vectorstore=vectordb, lexical_index=lexical_index, k=k)
+    return vectordb.as_retriever(search_type="mmr", search_kwargs={'k': k, 'lambda_mult': lambda_mult})
+
+
+def create_qa_chain(model_name, session_id, k=4, lambda_mult=0.25, llm=None):
+    """
+    传入llm时（如压测用的stub LLM）回答和question改写都用它，不通过get_llm创建
+    """
+    def build():
+        vectordb = create_vectordb()
+        retriever = create_retriever(vectordb, k=k, lambda_mult=lambda_mult)
+        chat_llm = llm or get_llm(model_name)
+        mem = create_memory(session_id, model_name, chat_llm)
+        # question改写用更小的模型和更短的输出，减少多轮对话时额外一次生成的耗时
+        condense_llm = MyLLM(CONDENSE_MODEL, max_new_tokens=CONDENSE_MAX_NEW_TOKENS) \
+            if CONDENSE_MODEL and llm is None else None
+        qa_chain = QAChain.from_llm(llm=chat_llm,
+                                    retriever=retriever,
+                                    condense_question_llm=condense_llm,
+                                    skip_self_contained=CONDENSE_SKIP_SELF_CONTAINED,
+                                    return_source_documents=True,
+                                    memory=mem,
+                                    answer_cache=get_answer_cache() if ANSWER_CACHE_ENABLED else None,
+                                    embeddings=get_embeddings(),
+                                    cache_namespace=model_name,
+                                    metrics_store=get_metrics_store(),
+                                    token_counter=chat_llm.get_num_tokens if isinstance(chat_llm, MyLLM) else None)
+        return qa_chain, mem
+
+    return get_qa_chain_cache().get((model_name, session_id, k, lambda_mult), build)
 
 
 def get_gpu_mem_info(gpu_id=0):
@@ -194,17 +658,25 @@ def llm_chatbot_page():
     with col2:
         reload_kg = st.button("重载知识库", type="primary")
     with col3:
-        model_name = st.selectbox("", options=['qwen:0.5b', 'llama3', 'wizardlm2'] + list(MODEL_PATH.keys()),
+        model_name = st.selectbox("", options=OLLAMA_MODELS + list(MODEL_PATH.keys()),
                                   label_visibility="collapsed")
     with col4:
         show_ref = st.checkbox("展示引用")
+    with st.expander("已加载模型"):
+        st.write(get_model_registry().info())
+    with st.expander("性能统计"):
+        summary = get_metrics_store().summary()
+        if summary:
+            st.dataframe(pd.DataFrame(summary), hide_index=True, use_container_width=True)
+        else:
+            st.markdown("暂无记录")
 
     placeholder = st.empty()
     prompt_text = st.chat_input('Chat with LLM', key="chat_input")
 
     if reload_kg:
         create_vectordb.clear()
-        create_qa_chain.clear()
+        get_qa_chain_cache().clear()
 
     if 'session_id' not in st.session_state:
         st.session_state.session_id = uuid.uuid4()
@@ -219,7 +691,15 @@ def llm_chatbot_page():
         last_model_name = model_name
         st.session_state.last_model_name = last_model_name
 
+    if OLLAMA_WARMUP and model_name in OLLAMA_MODELS:
+        warm_ollama(model_name)
     qa_chain, mem = create_qa_chain(model_name, session_id)
+    if reload_kg:
+        report = getattr(create_vectordb(), 'ingest_report', None)
+        if report and report['chunks']:
+            st.info(f"导入 {report['files']} 个文件 / {report['chunks']} 个chunk，去掉重复 "
+                    f"{report['dropped_exact']} 个、近似重复 {report['dropped_near']} 个，"
+                    f"embedding耗时 {report['embed_s']:.1f}s，约节省 {report['saved_s']:.1f}s")
 
     if "chat_history" not in st.session_state:
         st.session_state.chat_history = {}
@@ -248,13 +728,35 @@ def llm_chatbot_page():
                 st.markdown(prompt_text)
             with st.chat_message('assistant'):
                 placeholder = st.empty()
-                with placeholder:
-                    with st.spinner("正在生成输出..."):
-                        res = qa_chain({'question': prompt_text, 'chat_history': [r[:2] for r in history]})
-                        response = res['answer']
-                        history.append((prompt_text, response, res['source_documents']))
-                placeholder.empty()
-                st.markdown(response)
+                token_handler = StreamlitTokenHandler(placeholder)
+                with st.spinner("正在生成输出..."):
+                    # chat_history由qa_chain的memory提供，受MEMORY_TOKEN_BUDGET限制
+                    res = qa_chain({'question': prompt_text}, callbacks=[token_handler])
+                response = res['answer']
+                if KG_DEDUP_ENABLED:
+                    get_chunk_deduper().annotate(res['source_documents'])
+                history.append((prompt_text, response, res['source_documents']))
+                placeholder.markdown(response)
+                total = time.perf_counter() - token_handler.start_time
+                ttft = token_handler.ttft
+                llm_calls = res['metrics']['llm_calls'] if 'metrics' in res else None
+                calls_info = f" / LLM调用 {llm_calls} 次" if llm_calls is not None else ""
+                if res.get('from_cache'):
+                    st.caption(f"命中回答缓存 / 总耗时 {total:.2f}s{calls_info}")
+                elif ttft is not None:
+                    st.caption(f"首token {ttft:.2f}s / 总耗时 {total:.2f}s{calls_info}")
+                else:
+                    st.caption(f"总耗时 {total:.2f}s{calls_info}")
+                worker = getattr(get_model_registry().peek(model_name), 'worker', None)
+                if worker is not None:
+                    stats = worker.stats()
+                    st.caption(f"推理队列 {stats['queue_depth']} / batch {stats['batch_size']}/{stats['max_batch_size']}"
+                               f" / 平均排队 {stats['avg_wait_time']:.2f}s")
+                    spec = stats['spec_last']
+                    if spec is not None:
+                        speedup = f"{spec['speedup']:.2f}x" if spec['speedup'] is not None else "-"
+                        st.caption(f"投机解码 接受率 {spec['acceptance']:.0%} / 每步 {spec['tokens_per_target_step']:.1f} token"
+                                   f" / 加速 {speedup}{' / 已回退' if spec['fallback'] else ''}")
                 if show_ref:
                     st.write(res['source_documents'])
                 st.session_state.chat_history[model_name] = history
@@ -0,0 +1,146 @@
+import hashlib
+import json
+import os
+import shutil
+from collections import Counter
+from pathlib import Path
+
+
+def file_sha256(fpath, buf_size=1 << 20):
+    h = hashlib.sha256()
+    with open(fpath, 'rb') as f:
+        while True:
+            buf = f.read(buf_size)
+            if not buf:
+                break
+            h.update(buf)
+    return h.hexdigest()
+
+
+def make_chunk_ids(rel_path, sha, n):
+    """
+    chunk id由文件相对路径+内容hash+序号决定，相同内容的两个文件不会冲突
+    """
+    return [hashlib.md5(f"{rel_path}|{sha}|{i}".encode('utf-8')).hexdigest() for i in range(n)]
+
+
+class IngestManifest:
+    """
+    记录知识库中每个源文件的内容hash和对应的chunk id，用于增量重载知识库
+
+    {rel_path: {'sha256': ..., 'size': ..., 'mtime': ..., 'chunk_ids': [...]}}
+    """
+
+    def __init__(self, path, entries=None):
+        self.path = Path(path)
+        self.entries = entries or {}
+
+    @classmethod
+    def load(cls, path):
+        path = Path(path)
+        if not path.exists():
+            return cls(path)
+        with open(path, encoding='utf-8') as f:
+            return cls(path, json.load(f))
+
+    def save(self):
+        tmp_path = self.path.with_suffix(self.path.suffix + '.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.entries, f, ensure_ascii=False, indent=1)
+        os.replace(tmp_path, self.path)
+
+    def plan(self, file_lst, base_path):
+        """
+        对比当前文件和manifest，返回(changed, removed)
+
+        changed: [(rel_path, fpath, sha256)], 新增或内容发生变化的文件
+        removed: [rel_path], 已经从知识库目录中删除的文件
+        size和mtime都没变的文件直接跳过，不读取内容；只有mtime变了的文件会重新计算hash再判断
+        """
+        base_path = Path(base_path)
+        changed = []
+        seen = set()
+        for fpath in file_lst:
+            rel_path = Path(fpath).relative_to(base_path).as_posix()
+            seen.add(rel_path)
+            stat = os.stat(fpath)
+            entry = self.entries.get(rel_path)
+            if entry and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime:
+                continue
+            sha = file_sha256(fpath)
+            if entry and entry['sha256'] == sha:
+                entry['mtime'] = stat.st_mtime
+                continue
+            changed.append((rel_path, str(fpath), sha))
+        removed = [rel_path for rel_path in self.entries if rel_path not in seen]
+        return changed, removed
+
+    def chunk_ids(self, rel_path):
+        entry = self.entries.get(rel_path)
+        return list(entry['chunk_ids']) if entry else []
+
+    def record(self, rel_path, fpath, sha, chunk_ids):
+        stat = os.stat(fpath)
+        self.entries[rel_path] = {
+            'sha256': sha,
+            'size': stat.st_size,
+            'mtime': stat.st_mtime,
+            'chunk_ids': list(chunk_ids),
+        }
+
+    def remove(self, rel_path):
+        self.entries.pop(rel_path, None)
+
+
+def backfill_legacy(manifest, ids, metadatas, base_path, legacy_path):
+    """
+    旧版本导入后把文件按文件名平铺移到legacy_path，向量库中的chunk没有manifest记录，增量重载时永远不会被删除或更新。
+    按chunk的metadata['source']找到导入时的那份文件，把chunk id和那份文件的hash记到原来的相对路径下：
+    - base_path中没有这个文件：把它移回原来的相对路径，不需要重新embedding
+    - base_path中又放了一份（比如修改后重新放入）：内容相同时直接复用；不同时plan会判断为变化，删掉旧chunk重新导入
+    平铺时同名的文件会互相覆盖，legacy_path中的那份不能确定属于哪个源文件，和找不到导入时的文件一样，
+    只要base_path中有这个文件就重新导入
+
+    返回找不到任何源文件的chunk id，这些chunk只能删除向量库后重建才能清掉
+    """
+    base_path, legacy_path = Path(base_path), Path(legacy_path)
+    by_source = {}
+    for chunk_id, metadata in zip(ids, metadatas):
+        by_source.setdefault((metadata or {}).get('source'), []).append(chunk_id)
+    names = Counter(Path(source).name for source in by_source if source)
+    missing = []
+    for source, chunk_ids in by_source.items():
+        if not source:
+            missing.extend(chunk_ids)
+            continue
+        source = Path(source)
+        try:
+            rel_path = source.relative_to(base_path).as_posix()
+        except ValueError:
+            rel_path = source.name
+        fpath = base_path / rel_path
+        candidates = [legacy_path / rel_path] if rel_path != source.name else []
+        if names[source.name] == 1:
+            candidates.append(legacy_path / source.name)
+        legacy = next((path for path in candidates if path.exists()), None)
+        if legacy is None:
+            if fpath.exists():
+                _record_stale(manifest, rel_path, None, chunk_ids)
+            else:
+                missing.extend(chunk_ids)
+            continue
+        sha = file_sha256(legacy)
+        if not fpath.exists():
+            fpath.parent.mkdir(parents=True, exist_ok=True)
+            shutil.move(str(legacy), str(fpath))
+            manifest.record(rel_path, fpath, sha, chunk_ids)
+        elif file_sha256(fpath) == sha:
+            manifest.record(rel_path, fpath, sha, chunk_ids)
+        else:
+            _record_stale(manifest, rel_path, sha, chunk_ids)
+    return missing
+
+
+def _record_stale(manifest, rel_path, sha, chunk_ids):
+    # size为-1，plan一定会重新计算hash，和sha不同时判断为变化，删掉这些chunk再重新导入
+    manifest.entries[rel_path] = {'sha256': sha, 'size': -1, 'mtime': None, 'chunk_ids': list(chunk_ids)}
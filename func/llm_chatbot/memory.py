@@ -0,0 +1,126 @@
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, List, Optional
+
+from langchain.memory import ConversationSummaryBufferMemory
+from langchain_core.messages import BaseMessage, get_buffer_string
+
+_cjk_re = re.compile(r"[\u3000-\u303f\u4e00-\u9fff\uff00-\uffef]")
+_word_re = re.compile(r"[A-Za-z0-9_]+|[^\sA-Za-z0-9_\u3000-\u303f\u4e00-\u9fff\uff00-\uffef]")
+
+
+def approx_num_tokens(text):
+    """
+    没有tokenizer时（如Ollama模型）的粗略估计：中文每个字算一个token，其余按单词/符号计数
+    """
+    return len(_cjk_re.findall(text)) + len(_word_re.findall(text))
+
+
+class TokenBudgetMemory(ConversationSummaryBufferMemory):
+    """
+    对话记忆保持在预算以内：最近的recent_turns轮原样保留，更早的轮次被压缩进摘要
+
+    token数用token_counter计算（本地模型传tokenizer计数，否则用approx_num_tokens），不依赖llm.get_num_tokens。
+    max_token_limit只限制原样保留的对话，超出时一次压缩到max_token_limit * prune_to以下，不会每轮都生成一次摘要；
+    摘要不计入这个触发条件（否则摘要本身超过目标后每轮都会重新摘要），而是单独截到summary_max_tokens以内，
+    默认max_token_limit * (1 - prune_to)，保留较新的部分。
+    每次生成摘要记入summary_calls，设置了metrics_store时同时记一条summary记录
+    """
+    token_counter: Optional[Callable[[str], int]] = None
+    recent_turns: int = 2
+    prune_to: float = 0.6
+    summary_max_tokens: Optional[int] = None
+    metrics_store: Optional[Any] = None
+    metrics_model: Optional[str] = None
+    summary_calls: int = 0
+
+    def _count(self, text):
+        return (self.token_counter or approx_num_tokens)(text)
+
+    def _num_tokens(self, messages: List[BaseMessage]) -> int:
+        return self._count(get_buffer_string(messages, human_prefix=self.human_prefix, ai_prefix=self.ai_prefix))
+
+    def _cap_summary(self, summary):
+        limit = self.summary_max_tokens
+        if limit is None:
+            limit = int(self.max_token_limit * (1 - self.prune_to))
+        n = self._count(summary)
+        while n > limit:
+            # 按比例截掉开头（较早的内容），token数和字符数不严格成比例，多截几次直到不超过上限
+            keep = min(int(len(summary) * limit / n), len(summary) - 1)
+            summary = summary[len(summary) - keep:] if keep > 0 else ""
+            n = self._count(summary)
+        return summary
+
+    def prune(self) -> None:
+        buffer = self.chat_memory.messages
+        # 每轮对话是human+ai两条消息，至少保留最近recent_turns轮
+        if len(buffer) <= 2 * self.recent_turns or self._num_tokens(buffer) <= self.max_token_limit:
+            return
+        target = self.max_token_limit * self.prune_to
+        pruned_memory = []
+        while len(buffer) > 2 * self.recent_turns and self._num_tokens(buffer) > target:
+            pruned_memory.extend(buffer[:2])
+            del buffer[:2]
+        if not pruned_memory:
+            return
+        start = time.perf_counter()
+        self.moving_summary_buffer = self._cap_summary(
+            self.predict_new_summary(pruned_memory, self.moving_summary_buffer))
+        self.summary_calls += 1
+        if self.metrics_store is not None:
+            self.metrics_store.add({
+                'ts': time.time(),
+                'model': self.metrics_model,
+                'kind': 'summary',
+                'turns': len(pruned_memory) // 2,
+                'llm_calls': 1,
+                'stages': {'summary': time.perf_counter() - start},
+            })
+
+
+class SessionCache:
+    """
+    按会话缓存对象（问答链、记忆），空闲超过idle_ttl秒或超过max_entries个时按LRU淘汰
+
+    st.cache_resource的ttl从写入时开始计时，会把正在对话的会话也淘汰掉，所以这里按最近访问时间计算
+    """
+
+    def __init__(self, max_entries=100, idle_ttl=3600):
+        self.max_entries = max_entries
+        self.idle_ttl = idle_ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key, factory: Callable[[], Any]):
+        now = time.time()
+        with self._lock:
+            self._evict(now)
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries[key] = (now, entry[1])
+                self._entries.move_to_end(key)
+                return entry[1]
+        value = factory()
+        with self._lock:
+            entry = self._entries.setdefault(key, (now, value))
+            self._entries.move_to_end(key)
+            self._evict(now)
+            return entry[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _evict(self, now):
+        while self._entries:
+            key, (last_used, _) = next(iter(self._entries.items()))
+            if len(self._entries) > self.max_entries or now - last_used > self.idle_ttl:
+                del self._entries[key]
+            else:
+                break
@@ -0,0 +1,118 @@
+import json
+import threading
+import time
+from collections import deque
+from typing import Any, Dict, List
+
+import numpy as np
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.outputs import LLMResult
+
+# summary是对话记忆超出预算时生成摘要的耗时，单独记录，不属于某一轮问答
+STAGES = ['condense', 'embed_query', 'retrieval', 'prompt', 'generation', 'total', 'summary']
+
+
+class LLMCallRecorder(BaseCallbackHandler):
+    """
+    记录一轮对话中每次LLM调用的开始/首token/结束时间、prompt和输出，MyLLM和Ollama都会触发这些事件
+    """
+
+    def __init__(self):
+        self.calls = []
+        self._by_run = {}
+
+    def on_llm_start(self, serialized: Dict[str, Any], prompts: List[str], *, run_id, **kwargs: Any) -> None:
+        call = {'start': time.perf_counter(), 'first_token': None, 'end': None, 'prompt': prompts[0],
+                'chunks': 0, 'text': "", 'generation_info': {}}
+        self._by_run[run_id] = call
+        self.calls.append(call)
+
+    def on_llm_new_token(self, token: str, *, run_id, **kwargs: Any) -> None:
+        call = self._by_run.get(run_id)
+        if call is None:
+            return
+        if call['first_token'] is None:
+            call['first_token'] = time.perf_counter()
+        call['chunks'] += 1
+
+    def on_llm_end(self, response: LLMResult, *, run_id, **kwargs: Any) -> None:
+        call = self._by_run.get(run_id)
+        if call is None:
+            return
+        call['end'] = time.perf_counter()
+        generation = response.generations[0][0]
+        call['text'] = generation.text
+        call['generation_info'] = generation.generation_info or {}
+
+
+def count_call_tokens(call, token_counter=None):
+    """
+    返回(tokens_in, tokens_out)；Ollama的generation_info里带有精确计数，本地模型用tokenizer计数，
+    都没有时输出用流式chunk数近似，输入为None
+    """
+    info = call['generation_info']
+    if 'prompt_eval_count' in info or 'eval_count' in info:
+        return info.get('prompt_eval_count'), info.get('eval_count')
+    if token_counter is not None:
+        return token_counter(call['prompt']), token_counter(call['text'])
+    return None, call['chunks'] or None
+
+
+class MetricsStore:
+    """
+    每轮对话的性能记录：内存中保留最近max_records条，同时追加写入jsonl日志
+    """
+
+    def __init__(self, log_path, max_records=2000):
+        self.log_path = log_path
+        self._lock = threading.Lock()
+        self._records = deque(maxlen=max_records)
+        if log_path.exists():
+            with open(log_path, encoding='utf-8') as f:
+                for line in deque(f, maxlen=max_records):
+                    try:
+                        self._records.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        continue
+
+    def add(self, record):
+        line = json.dumps(record, ensure_ascii=False)
+        with self._lock:
+            self._records.append(record)
+            with open(self.log_path, 'a', encoding='utf-8') as f:
+                f.write(line + '\n')
+
+    def records(self):
+        with self._lock:
+            return list(self._records)
+
+    def summary(self):
+        """
+        按模型统计各阶段和首token时间的p50/p95（毫秒），以及tokens/s（p95取最慢的5%）
+        """
+        by_model = {}
+        for record in self.records():
+            by_model.setdefault(record['model'], []).append(record)
+        rows = []
+        for model, records in by_model.items():
+            metrics = {stage: [r['stages'][stage] for r in records if r['stages'].get(stage) is not None]
+                       for stage in STAGES}
+            metrics['ttft'] = [r['ttft'] for r in records if r.get('ttft') is not None]
+            for name, values in metrics.items():
+                if values:
+                    rows.append(_summary_row(model, name, 'ms', [v * 1000 for v in values], 95))
+            tps = [r['tokens_per_s'] for r in records if r.get('tokens_per_s')]
+            if tps:
+                rows.append(_summary_row(model, 'generation', 'tokens/s', tps, 5))
+        return rows
+
+
+def _summary_row(model, metric, unit, values, tail):
+    return {
+        'model': model,
+        'metric': metric,
+        'unit': unit,
+        'n': len(values),
+        'p50': round(float(np.percentile(values, 50)), 1),
+        'p95': round(float(np.percentile(values, tail)), 1),
+    }
@@ -0,0 +1,480 @@
+import json
+import os
+import shutil
+import threading
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Iterable, List, Optional, Tuple
+
+import numpy as np
+from langchain_community.vectorstores.utils import maximal_marginal_relevance
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+
+from func.file_lock import file_lock
+
+ID_BYTES = 64
+BLOCK_ROWS = 65536
+
+
+class _Snapshot:
+    """
+    检索用到的全部状态，写入后整体替换为新的snapshot，读者只读取一次self._state，不会看到行数不一致的数组
+
+    alive是写入方缓冲区的视图，删除时原地标记为False；ivf_count之后追加的行还没有排进IVF的倒排表，检索时单独扫描
+    """
+
+    def __init__(self, data_dir, count, dim, vectors, offsets, alive, centroids=None, assign=None, lists=None,
+                 ivf_count=0):
+        self.data_dir = data_dir
+        self.count = count
+        self.dim = dim
+        self.vectors = vectors
+        self.offsets = offsets
+        self.alive = alive
+        self.centroids = centroids
+        self.assign = assign
+        self.lists = lists
+        self.ivf_count = ivf_count
+
+
+class MmapVectorStore(VectorStore):
+    """
+    基于内存映射矩阵的向量库，向量归一化后存成float16/float32，用NumPy做余弦检索
+
+    目录结构（除meta.json外都是只追加写）：
+    - meta.json: dim/dtype/count/gen，count是提交点，读者只看前count行；gen>0时数据文件在gen{gen}/子目录中
+    - vectors.bin: N x dim 的向量矩阵，只读memmap打开，多个进程共享操作系统的页缓存
+    - docs.jsonl + offsets.bin: 文本和metadata，按偏移量随机读取，不需要整体加载
+    - ids.bin: 每行定长（ID_BYTES）的chunk id；deleted.bin: 已删除的行号
+    - centroids.npy + assign.bin: 可选的IVF分区，nlist > 0 且向量足够多时训练，检索时只扫描nprobe个分区
+
+    写入时持有write.lock文件锁，多个进程的写入依次进行，写入方增量更新内存中的状态；其他进程在每次检索前检查meta.json的
+    修改时间，变化时重新映射。写入方拿到锁后先把数据文件截断到count，丢掉上次失败的写入留下的没有提交的行。
+    已删除的行超过compact_ratio时把存活的行复制到新的gen目录（compact），再切换meta.json
+    """
+
+    def __init__(self, path, embedding: Embeddings, dtype='float16', nlist=0, nprobe=8, compact_ratio=0.3):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.embedding = embedding
+        self.dtype = np.dtype(dtype)
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.compact_ratio = compact_ratio
+        self._lock = threading.RLock()
+        self._meta_mtime = None
+        self._id_to_row = None
+        self._write_depth = 0
+        self._open()
+        with self._writing():
+            pass
+
+    @property
+    def embeddings(self) -> Optional[Embeddings]:
+        return self.embedding
+
+    @property
+    def count(self):
+        return self._state.count
+
+    @property
+    def dim(self):
+        return self._state.dim
+
+    def __len__(self):
+        return int(self._current().alive.sum())
+
+    # 读取
+
+    def _data_dir(self, gen):
+        return self.path / f'gen{gen}' if gen else self.path
+
+    def _open(self):
+        meta_path = self.path / 'meta.json'
+        if meta_path.exists():
+            meta = json.loads(meta_path.read_text())
+            self._meta_mtime = meta_path.stat().st_mtime_ns
+        else:
+            meta = {'dim': 0, 'dtype': self.dtype.name, 'count': 0}
+        self.dtype = np.dtype(meta['dtype'])
+        self._gen = meta.get('gen', 0)
+        data_dir = self._data_dir(self._gen)
+        count = meta['count']
+        self._alive_buf = np.ones(count, dtype=bool)
+        deleted = self._fromfile(data_dir / 'deleted.bin', np.int64)
+        self._alive_buf[deleted[deleted < count]] = False
+        self._n_deleted = count - int(self._alive_buf.sum())
+        self._id_to_row = None
+        centroids = None
+        if (data_dir / 'centroids.npy').exists():
+            centroids = np.load(data_dir / 'centroids.npy')
+        self._state = self._snapshot(data_dir, count, meta['dim'], centroids)
+
+    def _snapshot(self, data_dir, count, dim, centroids=None, lists=None, ivf_count=0):
+        """
+        按count重新映射各个文件（memmap只建立映射，和行数无关），IVF倒排表没有传入时重新排序
+        """
+        assign = None
+        if centroids is not None:
+            assign = self._memmap(data_dir / 'assign.bin', np.int32, (count,))
+            # 新追加的行不超过已排序行数的1/4时不重新排序，均摊到每行是O(log N)
+            if lists is None or count - ivf_count > max(ivf_count // 4, 1024):
+                lists, ivf_count = _ivf_lists(assign, len(centroids)), count
+        return _Snapshot(data_dir, count, dim,
+                         self._memmap(data_dir / 'vectors.bin', self.dtype, (count, dim)),
+                         self._memmap(data_dir / 'offsets.bin', np.int64, (count + 1,) if count else (0,)),
+                         self._alive_buf[:count], centroids, assign, lists, ivf_count)
+
+    @staticmethod
+    def _memmap(fpath, dtype, shape):
+        if not shape or not np.prod(shape) or not fpath.exists():
+            return np.zeros(shape, dtype=dtype)
+        return np.memmap(fpath, dtype=dtype, mode='r', shape=shape)
+
+    @staticmethod
+    def _fromfile(fpath, dtype):
+        return np.fromfile(fpath, dtype=dtype) if fpath.exists() else np.zeros(0, dtype=dtype)
+
+    def _current(self) -> _Snapshot:
+        meta_path = self.path / 'meta.json'
+        if meta_path.exists() and meta_path.stat().st_mtime_ns != self._meta_mtime:
+            with self._lock:
+                if meta_path.stat().st_mtime_ns != self._meta_mtime:
+                    self._open()
+        return self._state
+
+    def _read_docs(self, state, rows):
+        docs = []
+        if not len(rows):
+            return docs
+        with open(state.data_dir / 'docs.jsonl', 'rb') as f:
+            for row in rows:
+                start, end = int(state.offsets[row]), int(state.offsets[row + 1])
+                f.seek(start)
+                item = json.loads(f.read(end - start))
+                docs.append(Document(page_content=item['text'], metadata=item['metadata']))
+        return docs
+
+    @staticmethod
+    def _raw_ids(state):
+        fpath = state.data_dir / 'ids.bin'
+        if not fpath.exists() or not state.count:
+            return np.zeros(0, dtype=f'S{ID_BYTES}')
+        return np.memmap(fpath, dtype=f'S{ID_BYTES}', mode='r', shape=(state.count,))
+
+    def _ids(self, state):
+        return [i.decode('utf-8') for i in self._raw_ids(state)]
+
+    # 写入
+
+    @contextmanager
+    def _writing(self):
+        """
+        写入时持有线程锁和write.lock文件锁；最外层拿到锁后刷新状态，并截掉没有提交的数据
+        """
+        with self._lock:
+            if self._write_depth:
+                # add_vectors里调用delete、compact等，已经持有锁
+                self._write_depth += 1
+                try:
+                    yield
+                finally:
+                    self._write_depth -= 1
+                return
+            with file_lock(self.path / 'write.lock'):
+                self._write_depth = 1
+                try:
+                    self._truncate(self._current())
+                    yield
+                finally:
+                    self._write_depth = 0
+
+    def _truncate(self, state):
+        """
+        把数据文件截断到meta.json提交的count：写入在提交meta.json之前失败时，文件末尾会留下没有提交的行，
+        不截掉的话下一次追加的行号和文件中的位置就对不上了
+        """
+        count = state.count
+        sizes = {
+            'vectors.bin': count * state.dim * self.dtype.itemsize,
+            'offsets.bin': (count + 1) * 8 if count else 0,
+            'ids.bin': count * ID_BYTES,
+            'assign.bin': count * 4,
+            'docs.jsonl': int(state.offsets[count]) if count else 0,
+        }
+        for name, size in sizes.items():
+            fpath = state.data_dir / name
+            if fpath.exists() and fpath.stat().st_size > size:
+                os.truncate(fpath, size)
+
+    def add_vectors(self, vectors, texts: List[str], metadatas: Optional[List[dict]] = None,
+                    ids: Optional[List[str]] = None) -> List[str]:
+        vectors = _normalize(np.asarray(vectors, dtype=np.float32))
+        metadatas = metadatas or [{} for _ in texts]
+        ids = ids or [str(uuid.uuid4()) for _ in texts]
+        raw_ids = [i.encode('utf-8') for i in ids]
+        if any(len(i) > ID_BYTES for i in raw_ids):
+            raise ValueError(f"chunk id longer than {ID_BYTES} bytes")
+        with self._writing():
+            state = self._current()
+            if state.dim and vectors.shape[1] != state.dim:
+                raise ValueError(f"embedding dim {vectors.shape[1]} != index dim {state.dim}")
+            self.delete(ids)
+            # delete可能触发了compact，换到新的目录
+            state = self._state
+            data_dir = state.data_dir
+            docs_path = data_dir / 'docs.jsonl'
+            base = docs_path.stat().st_size if docs_path.exists() else 0
+            offsets = [] if state.count else [base]
+            with open(docs_path, 'ab') as f:
+                for text, metadata, id_ in zip(texts, metadatas, ids):
+                    f.write(json.dumps({'id': id_, 'text': text, 'metadata': metadata}, ensure_ascii=False)
+                            .encode('utf-8') + b'\n')
+                    offsets.append(f.tell())
+            self._append(data_dir / 'offsets.bin', np.asarray(offsets, dtype=np.int64))
+            self._append(data_dir / 'ids.bin', np.asarray(raw_ids, dtype=f'S{ID_BYTES}'))
+            self._append(data_dir / 'vectors.bin', vectors.astype(self.dtype))
+            if state.centroids is not None:
+                self._append(data_dir / 'assign.bin', _nearest(state.centroids, vectors).astype(np.int32))
+            start, count = state.count, state.count + len(ids)
+            self._grow_alive(count)
+            self._write_meta(count, vectors.shape[1])
+            self._state = self._snapshot(data_dir, count, vectors.shape[1], state.centroids, state.lists,
+                                         state.ivf_count)
+            if self._id_to_row is not None:
+                self._id_to_row.update((id_, start + i) for i, id_ in enumerate(ids))
+            if state.centroids is None and self.nlist and count >= self.nlist * 39:
+                self.build_ivf()
+        return ids
+
+    def _grow_alive(self, count):
+        # 容量按倍数增长，追加的均摊开销和已有行数无关；旧snapshot仍然引用旧的缓冲区
+        if count > len(self._alive_buf):
+            buf = np.ones(max(count, 2 * len(self._alive_buf)), dtype=bool)
+            n = self._state.count
+            buf[:n] = self._alive_buf[:n]
+            self._alive_buf = buf
+
+    def add_texts(self, texts: Iterable[str], metadatas: Optional[List[dict]] = None,
+                  ids: Optional[List[str]] = None, **kwargs: Any) -> List[str]:
+        texts = list(texts)
+        if not texts:
+            return []
+        return self.add_vectors(self.embedding.embed_documents(texts), texts, metadatas, ids)
+
+    def delete(self, ids: Optional[List[str]] = None, **kwargs: Any) -> Optional[bool]:
+        if not ids:
+            return True
+        with self._writing():
+            state = self._current()
+            if self._id_to_row is None:
+                self._id_to_row = {id_: row for row, id_ in enumerate(self._ids(state))}
+            rows = [self._id_to_row.pop(id_) for id_ in ids if id_ in self._id_to_row]
+            rows = [row for row in rows if state.alive[row]]
+            if rows:
+                self._append(state.data_dir / 'deleted.bin', np.asarray(rows, dtype=np.int64))
+                self._alive_buf[rows] = False
+                self._n_deleted += len(rows)
+                self._write_meta(state.count, state.dim)
+                if self.compact_ratio and self._n_deleted > self.compact_ratio * state.count:
+                    self.compact()
+        return True
+
+    def compact(self):
+        """
+        把存活的行复制到新的gen目录，切换meta.json后删除更早的目录；
+        上一个gen目录保留，其他进程还没重新映射时仍然可以读取
+        """
+        with self._writing():
+            state = self._current()
+            rows = np.flatnonzero(state.alive)
+            gen = self._gen + 1
+            new_dir = self._data_dir(gen)
+            shutil.rmtree(new_dir, ignore_errors=True)
+            new_dir.mkdir()
+            with open(new_dir / 'vectors.bin', 'wb') as f:
+                for i in range(0, len(rows), BLOCK_ROWS):
+                    f.write(np.ascontiguousarray(state.vectors[rows[i:i + BLOCK_ROWS]]).tobytes())
+            self._raw_ids(state)[rows].tofile(new_dir / 'ids.bin')
+            offsets = [0] if len(rows) else []
+            with open(state.data_dir / 'docs.jsonl', 'rb') as src, open(new_dir / 'docs.jsonl', 'wb') as dst:
+                for row in rows:
+                    start, end = int(state.offsets[row]), int(state.offsets[row + 1])
+                    src.seek(start)
+                    dst.write(src.read(end - start))
+                    offsets.append(dst.tell())
+            np.asarray(offsets, dtype=np.int64).tofile(new_dir / 'offsets.bin')
+            if state.centroids is not None:
+                np.asarray(state.assign[rows]).tofile(new_dir / 'assign.bin')
+                np.save(new_dir / 'centroids.npy', state.centroids)
+            self._write_meta(len(rows), state.dim, gen)
+            self._open()
+            if gen >= 2:
+                self._remove_gen(gen - 2)
+
+    def _remove_gen(self, gen):
+        if gen:
+            shutil.rmtree(self._data_dir(gen), ignore_errors=True)
+            return
+        for name in ['vectors.bin', 'offsets.bin', 'docs.jsonl', 'ids.bin', 'deleted.bin', 'assign.bin',
+                     'centroids.npy']:
+            (self.path / name).unlink(missing_ok=True)
+
+    def build_ivf(self, nlist=None, n_iter=10, sample=50000, seed=0):
+        """
+        用k-means训练IVF的聚类中心，并重写所有向量的分区
+        """
+        nlist = nlist or self.nlist
+        with self._writing():
+            state = self._current()
+            rng = np.random.default_rng(seed)
+            rows = np.flatnonzero(state.alive)
+            if len(rows) < nlist:
+                return
+            train = np.asarray(state.vectors[np.sort(rng.choice(rows, min(sample, len(rows)), replace=False))],
+                               dtype=np.float32)
+            centroids = train[rng.choice(len(train), nlist, replace=False)]
+            for _ in range(n_iter):
+                assign = _nearest(centroids, train)
+                for c in range(nlist):
+                    members = train[assign == c]
+                    if len(members):
+                        centroids[c] = members.mean(axis=0)
+                centroids = _normalize(centroids)
+            assign = np.concatenate([_nearest(centroids, np.asarray(state.vectors[i:i + BLOCK_ROWS], np.float32))
+                                     for i in range(0, state.count, BLOCK_ROWS)]).astype(np.int32)
+            # 先写临时文件再替换，其他进程已经映射的旧文件不受影响
+            tmp_path = state.data_dir / 'assign.bin.tmp'
+            assign.tofile(tmp_path)
+            os.replace(tmp_path, state.data_dir / 'assign.bin')
+            np.save(state.data_dir / 'centroids.npy', centroids)
+            self._write_meta(state.count, state.dim)
+            self._state = self._snapshot(state.data_dir, state.count, state.dim, centroids)
+
+    def persist(self):
+        """
+        每次写入都已落盘，保留这个接口和Chroma一致
+        """
+
+    @staticmethod
+    def _append(fpath, arr):
+        with open(fpath, 'ab') as f:
+            f.write(arr.tobytes())
+
+    def _write_meta(self, count, dim, gen=None):
+        self._gen = self._gen if gen is None else gen
+        meta_path = self.path / 'meta.json'
+        tmp_path = self.path / 'meta.json.tmp'
+        tmp_path.write_text(json.dumps({'dim': int(dim), 'dtype': self.dtype.name, 'count': int(count),
+                                        'gen': self._gen}))
+        os.replace(tmp_path, meta_path)
+        # 自己写入时由调用方增量更新状态，不需要重新打开
+        self._meta_mtime = meta_path.stat().st_mtime_ns
+
+    # 检索
+
+    def _search(self, query_vec, k) -> Tuple[_Snapshot, np.ndarray, np.ndarray]:
+        """
+        返回检索用的snapshot、得分最高的k行及其余弦相似度
+        """
+        state = self._current()
+        empty = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        if not state.count:
+            return (state,) + empty
+        q = _normalize(np.asarray(query_vec, dtype=np.float32))
+        if state.lists is not None:
+            order, bounds = state.lists
+            probes = np.argsort(-(state.centroids @ q))[:self.nprobe]
+            parts = [order[bounds[c]:bounds[c + 1]] for c in probes]
+            if state.count > state.ivf_count:
+                tail = np.asarray(state.assign[state.ivf_count:state.count])
+                parts.append(state.ivf_count + np.flatnonzero(np.isin(tail, probes)))
+            rows = np.sort(np.concatenate(parts))
+            rows = rows[state.alive[rows]]
+            scores = np.asarray(state.vectors[rows], dtype=np.float32) @ q
+        else:
+            scores = np.concatenate([np.asarray(state.vectors[i:i + BLOCK_ROWS], dtype=np.float32) @ q
+                                     for i in range(0, state.count, BLOCK_ROWS)])
+            scores[~state.alive] = -np.inf
+            rows = np.arange(state.count)
+        k = min(k, int(np.isfinite(scores).sum()))
+        if k <= 0:
+            return (state,) + empty
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return state, rows[top], scores[top]
+
+    def similarity_search_with_score(self, query: str, k: int = 4, **kwargs: Any) -> List[Tuple[Document, float]]:
+        return self.similarity_search_by_vector_with_score(self.embedding.embed_query(query), k)
+
+    def similarity_search_by_vector_with_score(self, embedding: List[float], k: int = 4
+                                               ) -> List[Tuple[Document, float]]:
+        state, rows, scores = self._search(embedding, k)
+        return list(zip(self._read_docs(state, rows), scores.tolist()))
+
+    def similarity_search(self, query: str, k: int = 4, **kwargs: Any) -> List[Document]:
+        return [doc for doc, _ in self.similarity_search_with_score(query, k)]
+
+    def similarity_search_by_vector(self, embedding: List[float], k: int = 4, **kwargs: Any) -> List[Document]:
+        return [doc for doc, _ in self.similarity_search_by_vector_with_score(embedding, k)]
+
+    def _select_relevance_score_fn(self):
+        return lambda score: score
+
+    def max_marginal_relevance_search(self, query: str, k: int = 4, fetch_k: int = 20, lambda_mult: float = 0.5,
+                                      **kwargs: Any) -> List[Document]:
+        return self.max_marginal_relevance_search_by_vector(self.embedding.embed_query(query), k, fetch_k,
+                                                            lambda_mult)
+
+    def max_marginal_relevance_search_by_vector(self, embedding: List[float], k: int = 4, fetch_k: int = 20,
+                                                lambda_mult: float = 0.5, **kwargs: Any) -> List[Document]:
+        state, rows, _ = self._search(embedding, fetch_k)
+        if not len(rows):
+            return []
+        rows = np.sort(rows)
+        candidates = np.asarray(state.vectors[rows], dtype=np.float32)
+        selected = maximal_marginal_relevance(np.asarray(embedding, dtype=np.float32), candidates,
+                                              lambda_mult=lambda_mult, k=k)
+        return self._read_docs(state, rows[selected])
+
+    def get(self, include: Optional[List[str]] = None):
+        """
+        和Chroma.get()相同的返回格式，用于从向量库补建其他索引
+        """
+        state = self._current()
+        rows = np.flatnonzero(state.alive)
+        ids = self._ids(state)
+        docs = self._read_docs(state, rows)
+        return {
+            'ids': [ids[row] for row in rows],
+            'documents': [doc.page_content for doc in docs],
+            'metadatas': [doc.metadata for doc in docs],
+        }
+
+    @classmethod
+    def from_texts(cls, texts: List[str], embedding: Embeddings, metadatas: Optional[List[dict]] = None,
+                   ids: Optional[List[str]] = None, path=None, **kwargs: Any) -> "MmapVectorStore":
+        store = cls(path, embedding, **kwargs)
+        store.add_texts(texts, metadatas, ids)
+        return store
+
+
+def _normalize(vecs):
+    norm = np.linalg.norm(vecs, axis=-1, keepdims=True)
+    return vecs / np.where(norm > 0, norm, 1)
+
+
+def _ivf_lists(assign, nlist):
+    """
+    按分区排序的行号和每个分区的边界
+    """
+    order = np.argsort(assign, kind='stable')
+    bounds = np.searchsorted(np.asarray(assign)[order], np.arange(nlist + 1))
+    return order, bounds
+
+
+def _nearest(centroids, vecs):
+    return np.argmax(vecs @ centroids.T, axis=1)
@@ -0,0 +1,240 @@
+import gc
+import logging
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+def model_memory(model):
+    """
+    按设备类型统计模型参数和buffer占用的字节数，如 {'cuda': ..., 'cpu': ...}
+    """
+    usage = {}
+    tensors = list(model.parameters()) + list(model.buffers())
+    for module in model.modules():
+        # 动态量化后的Linear把权重打包存放，不在parameters()中
+        if isinstance(module, torch.ao.nn.quantized.dynamic.Linear):
+            tensors.extend(t for t in module._weight_bias() if t is not None)
+    for t in tensors:
+        usage[t.device.type] = usage.get(t.device.type, 0) + t.numel() * t.element_size()
+    return usage
+
+
+def estimate_model_memory(model_path):
+    """
+    加载前用权重文件大小估算模型占用，放在cuda（可用时）或cpu上
+    """
+    model_path = Path(model_path)
+    size = sum(f.stat().st_size for suffix in ['safetensors', 'bin'] for f in model_path.glob(f"*.{suffix}"))
+    return {'cuda' if torch.cuda.is_available() else 'cpu': size}
+
+
+class LoadedModel:
+    def __init__(self, name, model, tokenizer):
+        self.name = name
+        self.model = model
+        self.tokenizer = tokenizer
+        self.memory = model_memory(model)
+        draft_model = getattr(model, 'draft_model', None)
+        if draft_model is not None:
+            for device, n in model_memory(draft_model).items():
+                self.memory[device] = self.memory.get(device, 0) + n
+        # 推理线程的前缀KV缓存等
+        worker = getattr(model, 'worker', None)
+        if worker is not None:
+            for device, n in worker.extra_memory().items():
+                self.memory[device] = self.memory.get(device, 0) + n
+        self.refcount = 0
+        self.load_time = time.time()
+        self.last_used = time.time()
+
+
+class ModelRegistry:
+    """
+    管理已加载的本地模型，每种设备各有一个内存预算（字节），超出预算时按LRU淘汰空闲的模型
+
+    正在生成的模型（refcount > 0）不会被淘汰；会话不持有模型对象，每次调用时通过use()借用。
+    加载前按预估的占用预留内存，几个线程同时加载不同的模型时依次腾出空间
+    """
+
+    def __init__(self, loader, budget, model_paths=None, estimate=None, wait_timeout=60):
+        self.loader = loader
+        self.budget = budget
+        # 空间不够时最多等这么多秒，等其他线程加载完成或者用完模型，之后超出预算加载
+        self.wait_timeout = wait_timeout
+        self.model_paths = model_paths or {}
+        # estimate(name)返回加载前预估的占用，默认按权重文件大小估算
+        self.estimate = estimate
+        self._models = OrderedDict()
+        self._lock = threading.RLock()
+        # 加载完成、模型用完或者淘汰完成时通知等待预留内存的线程
+        self._changed = threading.Condition(self._lock)
+        self._loading = {}
+        # 正在加载的模型预留的内存、正在淘汰还没释放的内存 {name: {device: bytes}}
+        self._reserved = {}
+        self._evicting = {}
+
+    @contextmanager
+    def use(self, name):
+        entry = self.acquire(name)
+        try:
+            yield entry.model, entry.tokenizer
+        finally:
+            self.release(name)
+
+    def acquire(self, name):
+        while True:
+            with self._lock:
+                entry = self._models.get(name)
+                if entry is not None:
+                    entry.refcount += 1
+                    entry.last_used = time.time()
+                    self._models.move_to_end(name)
+                    return entry
+                event = self._loading.get(name)
+                if event is None:
+                    event = self._loading[name] = threading.Event()
+                    break
+            # 其他线程正在加载同一个模型，等它加载完再取
+            event.wait()
+        try:
+            if self.estimate is not None:
+                extra = self.estimate(name)
+            elif name in self.model_paths:
+                extra = estimate_model_memory(self.model_paths[name])
+            else:
+                extra = {}
+            self._reserve(name, extra)
+            model, tokenizer = self.loader(name)
+            entry = LoadedModel(name, model, tokenizer)
+            with self._lock:
+                entry.refcount += 1
+                self._models[name] = entry
+                # 预留的内存换成实际的占用
+                self._reserved.pop(name, None)
+            self._make_room({})
+            return entry
+        finally:
+            with self._lock:
+                self._reserved.pop(name, None)
+                self._loading.pop(name).set()
+                self._changed.notify_all()
+
+    def release(self, name):
+        with self._lock:
+            entry = self._models.get(name)
+            if entry is not None:
+                entry.refcount -= 1
+                entry.last_used = time.time()
+                self._changed.notify_all()
+
+    def peek(self, name):
+        """
+        不增加引用计数地返回已加载的模型，未加载时返回None
+        """
+        with self._lock:
+            entry = self._models.get(name)
+            return entry.model if entry is not None else None
+
+    def preload(self, name):
+        """
+        在后台线程中加载模型，加载完成后不占引用
+        """
+
+        def run():
+            try:
+                self.acquire(name)
+                self.release(name)
+            except Exception:
+                logger.exception("failed to preload %s", name)
+
+        thread = threading.Thread(target=run, daemon=True, name=f"preload-{name}")
+        thread.start()
+        return thread
+
+    def evict(self, name):
+        with self._lock:
+            entry = self._models.get(name)
+            if entry is None or entry.refcount > 0:
+                return False
+            del self._models[name]
+            # 释放之前仍然计入占用，其他线程不会抢先加载
+            self._evicting[name] = entry.memory
+        try:
+            worker = getattr(entry.model, 'worker', None)
+            if worker is not None:
+                worker.close()
+            del entry
+            gc.collect()
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+        finally:
+            with self._lock:
+                self._evicting.pop(name, None)
+                self._changed.notify_all()
+        logger.info("evicted model %s", name)
+        return True
+
+    def usage(self):
+        total = {}
+        with self._lock:
+            for entry in self._models.values():
+                for device, n in entry.memory.items():
+                    total[device] = total.get(device, 0) + n
+        return total
+
+    def info(self):
+        with self._lock:
+            return [{
+                'name': entry.name,
+                'memory_gb': {device: round(n / 1024 ** 3, 2) for device, n in entry.memory.items()},
+                'refcount': entry.refcount,
+                'idle_seconds': round(time.time() - entry.last_used, 1),
+            } for entry in self._models.values()]
+
+    def _over_budget(self, extra):
+        usage = self.usage()
+        with self._lock:
+            for reserved in list(self._reserved.values()) + list(self._evicting.values()):
+                for device, n in reserved.items():
+                    usage[device] = usage.get(device, 0) + n
+        return [device for device, limit in self.budget.items()
+                if usage.get(device, 0) + extra.get(device, 0) > limit]
+
+    def _reserve(self, name, extra):
+        """
+        腾出extra的空间并记为name的预留，其他线程正在加载的模型的预留也算作占用，同时加载不同的模型时不会一起超出预算。
+        空间不够而且没有空闲的模型时，等其他线程加载完成、淘汰完成或者用完模型，最多等wait_timeout秒
+        """
+        deadline = time.monotonic() + self.wait_timeout
+        while True:
+            with self._lock:
+                over = self._over_budget(extra)
+                idle = [n for n, entry in self._models.items()
+                        if entry.refcount == 0 and any(device in entry.memory for device in over)]
+                if not idle:
+                    remaining = deadline - time.monotonic()
+                    if over and remaining > 0 and (self._reserved or self._evicting or self._models):
+                        self._changed.wait(remaining)
+                        continue
+                    if over:
+                        logger.warning("model memory over budget but all loaded models are in use")
+                    self._reserved[name] = extra
+                    return
+            self.evict(idle[0])
+
+    def _make_room(self, extra):
+        while over := self._over_budget(extra):
+            with self._lock:
+                idle = [name for name, entry in self._models.items()
+                        if entry.refcount == 0 and any(device in entry.memory for device in over)]
+            if not idle:
+                logger.warning("model memory over budget but all loaded models are in use")
+                return
+            self.evict(idle[0])
@@ -0,0 +1,260 @@
+import asyncio
+import json
+import logging
+import threading
+import time
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional
+
+import aiohttp
+import requests
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain_core.language_models.llms import BaseLLM
+from langchain_core.outputs import Generation, GenerationChunk, LLMResult
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+
+class OllamaError(Exception):
+    pass
+
+
+class _Retryable(Exception):
+    pass
+
+
+class OllamaClient:
+    """
+    Ollama的HTTP客户端，同一个base_url和设置共用一个连接池（keep-alive），同步用requests，异步用aiohttp
+
+    - connect_timeout: 建立连接的超时；read_timeout: 两个流式chunk之间的最长间隔（模型加载也算在第一个chunk里）
+    - 连接失败、超时和5xx在收到第一个chunk之前最多重试max_retries次，指数退避；已经开始输出后不再重试
+    """
+
+    def __init__(self, base_url="http://localhost:11434", pool_size=8, connect_timeout=5, read_timeout=120,
+                 max_retries=2, backoff=0.5):
+        self.base_url = base_url.rstrip("/")
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+        # aiohttp的session绑定在创建它的事件循环上，每个循环一个
+        self._async_sessions = {}
+        self._lock = threading.Lock()
+
+    def _sleep_time(self, attempt):
+        return self.backoff * 2 ** attempt
+
+    def stream_generate(self, payload: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+        """
+        POST /api/generate，逐个产出Ollama返回的json；调用方提前退出时关闭响应
+        """
+        payload = {**payload, 'stream': True}
+        for attempt in range(self.max_retries + 1):
+            try:
+                resp = self._session.post(f"{self.base_url}/api/generate", json=payload, stream=True,
+                                          timeout=(self.connect_timeout, self.read_timeout))
+                if resp.status_code >= 500:
+                    detail = resp.text
+                    resp.close()
+                    raise _Retryable(f"status {resp.status_code}: {detail}")
+                break
+            except (requests.ConnectionError, requests.Timeout, _Retryable) as e:
+                if attempt == self.max_retries:
+                    raise OllamaError(f"Ollama request failed after {attempt + 1} attempts: {e}") from e
+                logger.warning("Ollama request failed (%s), retrying", e)
+                time.sleep(self._sleep_time(attempt))
+        try:
+            _check_status(resp.status_code, payload['model'], lambda: resp.text)
+            for line in resp.iter_lines():
+                if line:
+                    yield _parse_line(line)
+        finally:
+            resp.close()
+
+    def _get_async_session(self):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            session = self._async_sessions.get(loop)
+            if session is None or session.closed:
+                # 每个asyncio.run都是新的循环，去掉已关闭的循环留下的session，不然字典一直增长；
+                # 循环关闭后这些session已经没法await close()，只能丢掉引用
+                for old_loop in [l for l, s in self._async_sessions.items() if l.is_closed() or s.closed]:
+                    del self._async_sessions[old_loop]
+                connector = aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=60)
+                session = self._async_sessions[loop] = aiohttp.ClientSession(connector=connector)
+            return session
+
+    async def astream_generate(self, payload: Dict[str, Any]) -> AsyncIterator[Dict[str, Any]]:
+        payload = {**payload, 'stream': True}
+        session = self._get_async_session()
+        timeout = aiohttp.ClientTimeout(connect=self.connect_timeout, sock_read=self.read_timeout)
+        for attempt in range(self.max_retries + 1):
+            try:
+                resp = await session.post(f"{self.base_url}/api/generate", json=payload, timeout=timeout)
+                if resp.status >= 500:
+                    detail = await resp.text()
+                    resp.release()
+                    raise _Retryable(f"status {resp.status}: {detail}")
+                break
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError, _Retryable) as e:
+                if attempt == self.max_retries:
+                    raise OllamaError(f"Ollama request failed after {attempt + 1} attempts: {e}") from e
+                logger.warning("Ollama request failed (%s), retrying", e)
+                await asyncio.sleep(self._sleep_time(attempt))
+        try:
+            if resp.status != 200:
+                detail = await resp.text()
+                _check_status(resp.status, payload['model'], lambda: detail)
+            async for line in resp.content:
+                if line.strip():
+                    yield _parse_line(line)
+        finally:
+            resp.release()
+
+    def warm(self, model, keep_alive=None):
+        """
+        只发送模型名不带prompt，让Ollama提前加载模型；keep_alive控制空闲多久后卸载
+        """
+        payload = {'model': model}
+        if keep_alive is not None:
+            payload['keep_alive'] = keep_alive
+        for _ in self.stream_generate(payload):
+            pass
+
+    async def aclose(self):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            session = self._async_sessions.pop(loop, None)
+        if session is not None:
+            await session.close()
+
+    def close(self):
+        self._session.close()
+
+
+def _check_status(status, model, get_text):
+    if status == 404:
+        raise OllamaError(f"model {model} not found, pull it with `ollama pull {model}`")
+    if status != 200:
+        raise OllamaError(f"Ollama call failed with status code {status}: {get_text()}")
+
+
+def _parse_line(line):
+    data = json.loads(line)
+    if 'error' in data:
+        raise OllamaError(data['error'])
+    return data
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_ollama_client(base_url, **kwargs):
+    """
+    base_url和连接池大小、超时、重试次数都相同的PooledOllama共用一个客户端和连接池，设置不同时各用各的
+    """
+    key = (base_url, tuple(sorted(kwargs.items())))
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            client = _clients[key] = OllamaClient(base_url, **kwargs)
+        return client
+
+
+class PooledOllama(BaseLLM):
+    """
+    流式调用Ollama的LLM，和langchain自带的Ollama相比：
+
+    - 复用连接池，不再每次请求新建连接，异步调用也共用session
+    - 每个chunk都触发on_llm_new_token，最后一个chunk的统计信息（eval_count等）放进generation_info
+    - 连接失败/5xx自动重试，有连接和读取超时
+    - keep_alive随每个请求发送，避免对话间隙模型被Ollama卸载
+    """
+    model: str = "qwen:0.5b"
+    base_url: str = "http://localhost:11434"
+    keep_alive: Optional[str] = None
+    options: Dict[str, Any] = {}
+    pool_size: int = 8
+    connect_timeout: float = 5
+    read_timeout: float = 120
+    max_retries: int = 2
+
+    @property
+    def client(self) -> OllamaClient:
+        return get_ollama_client(self.base_url, pool_size=self.pool_size, connect_timeout=self.connect_timeout,
+                                 read_timeout=self.read_timeout, max_retries=self.max_retries)
+
+    @property
+    def _llm_type(self) -> str:
+        return "ollama-pooled"
+
+    @property
+    def _identifying_params(self) -> Dict[str, Any]:
+        return {'model': self.model, 'base_url': self.base_url, 'options': self.options}
+
+    def _payload(self, prompt, stop, **kwargs):
+        options = {**self.options, **kwargs.get('options', {})}
+        if stop:
+            options['stop'] = stop
+        payload = {'model': self.model, 'prompt': prompt, 'options': options}
+        if self.keep_alive is not None:
+            payload['keep_alive'] = self.keep_alive
+        return payload
+
+    def warm(self):
+        self.client.warm(self.model, self.keep_alive)
+
+    def _stream(self, prompt: str, stop: Optional[List[str]] = None,
+                run_manager: Optional[CallbackManagerForLLMRun] = None,
+                **kwargs: Any) -> Iterator[GenerationChunk]:
+        for data in self.client.stream_generate(self._payload(prompt, stop, **kwargs)):
+            chunk = _to_chunk(data)
+            if run_manager and chunk.text:
+                run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+            yield chunk
+
+    async def _astream(self, prompt: str, stop: Optional[List[str]] = None,
+                       run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+                       **kwargs: Any) -> AsyncIterator[GenerationChunk]:
+        async for data in self.client.astream_generate(self._payload(prompt, stop, **kwargs)):
+            chunk = _to_chunk(data)
+            if run_manager and chunk.text:
+                await run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+            yield chunk
+
+    def _generate(self, prompts: List[str], stop: Optional[List[str]] = None,
+                  run_manager: Optional[CallbackManagerForLLMRun] = None,
+                  **kwargs: Any) -> LLMResult:
+        generations = []
+        for prompt in prompts:
+            final = None
+            for chunk in self._stream(prompt, stop, run_manager, **kwargs):
+                final = chunk if final is None else final + chunk
+            if final is None:
+                raise OllamaError("no data received from Ollama stream")
+            generations.append([Generation(text=final.text, generation_info=final.generation_info)])
+        return LLMResult(generations=generations)
+
+    async def _agenerate(self, prompts: List[str], stop: Optional[List[str]] = None,
+                         run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+                         **kwargs: Any) -> LLMResult:
+        generations = []
+        for prompt in prompts:
+            final = None
+            async for chunk in self._astream(prompt, stop, run_manager, **kwargs):
+                final = chunk if final is None else final + chunk
+            if final is None:
+                raise OllamaError("no data received from Ollama stream")
+            generations.append([Generation(text=final.text, generation_info=final.generation_info)])
+        return LLMResult(generations=generations)
+
+
+def _to_chunk(data):
+    return GenerationChunk(text=data.get('response', ""), generation_info=data if data.get('done') else None)
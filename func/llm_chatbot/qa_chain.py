@@ -0,0 +1,156 @@
+import re
+import time
+from typing import Any, Dict, Optional
+
+from langchain.chains.conversational_retrieval.base import ConversationalRetrievalChain, _get_chat_history
+from langchain_core.callbacks import AsyncCallbackManagerForChainRun, CallbackManagerForChainRun
+from langchain_core.runnables.config import run_in_executor
+
+from func.llm_chatbot.metrics import LLMCallRecorder, count_call_tokens
+
+
+# 出现指代词/省略时问题依赖上下文，需要改写
+_context_words_re = re.compile(
+    r"(它|他|她|这|那|其|该|上面|上述|前面|刚才|之前|继续|然后呢|为什么|怎么办|还有|呢[?？]?$)"
+    r"|\b(it|its|this|that|these|those|they|them|he|she|above|previous|again|more|why)\b",
+    re.IGNORECASE)
+
+
+def is_self_contained(question, min_length=8):
+    """
+    粗略判断问题是否不依赖对话上下文：足够长且不含指代词
+    """
+    question = question.strip()
+    return len(question) >= min_length and not _context_words_re.search(question)
+
+
+class QAChain(ConversationalRetrievalChain):
+    """
+    在ConversationalRetrievalChain的基础上：
+
+    - skip_self_contained为True时，自包含的问题不做question改写，少一次LLM调用
+    - question改写完成后先查回答缓存，命中时跳过检索和生成
+    - 设置了metrics_store时，记录每轮各阶段耗时、token数、首token时间和检索到的chunk数
+    - ainvoke/acall在线程池中执行同一个_call，和同步调用的行为一致
+    """
+    answer_cache: Optional[Any] = None
+    embeddings: Optional[Any] = None
+    cache_namespace: str = ""
+    metrics_store: Optional[Any] = None
+    token_counter: Optional[Any] = None
+    skip_self_contained: bool = False
+
+    def _call(
+            self,
+            inputs: Dict[str, Any],
+            run_manager: Optional[CallbackManagerForChainRun] = None,
+    ) -> Dict[str, Any]:
+        turn_start = time.perf_counter()
+        _run_manager = run_manager or CallbackManagerForChainRun.get_noop_manager()
+        recorder = LLMCallRecorder() if self.metrics_store is not None else None
+        stages = {}
+
+        def child_callbacks():
+            callbacks = _run_manager.get_child()
+            if recorder is not None:
+                callbacks.add_handler(recorder)
+            return callbacks
+
+        # 生成期间知识库重载了的话，这一轮的回答不再写入缓存
+        cache_generation = self.answer_cache.generation if self.answer_cache is not None else None
+        question = inputs["question"]
+        get_chat_history = self.get_chat_history or _get_chat_history
+        chat_history_str = get_chat_history(inputs["chat_history"])
+
+        if chat_history_str and not (self.skip_self_contained and is_self_contained(question)):
+            start = time.perf_counter()
+            new_question = self.question_generator.run(
+                question=question, chat_history=chat_history_str, callbacks=child_callbacks()
+            )
+            stages['condense'] = time.perf_counter() - start
+        else:
+            new_question = question
+
+        question_vec = None
+        if self.answer_cache is not None or recorder is not None:
+            # 检索时embed_query会命中embedding的LRU缓存，这里单独统计embedding耗时
+            start = time.perf_counter()
+            question_vec = self.embeddings.embed_query(new_question)
+            stages['embed_query'] = time.perf_counter() - start
+        if self.answer_cache is not None:
+            hit = self.answer_cache.lookup(self.cache_namespace, question_vec)
+            if hit is not None:
+                answer, docs = hit
+                output = self._make_output(answer, docs, new_question, from_cache=True)
+                self._record(output, stages, recorder, turn_start, docs)
+                return output
+
+        start = time.perf_counter()
+        docs = self._get_docs(new_question, inputs, run_manager=_run_manager)
+        stages['retrieval'] = time.perf_counter() - start
+        if self.response_if_no_docs_found is not None and len(docs) == 0:
+            output = self._make_output(self.response_if_no_docs_found, docs, new_question)
+            self._record(output, stages, recorder, turn_start, docs)
+            return output
+        new_inputs = inputs.copy()
+        if self.rephrase_question:
+            new_inputs["question"] = new_question
+        new_inputs["chat_history"] = chat_history_str
+        start = time.perf_counter()
+        answer = self.combine_docs_chain.run(
+            input_documents=docs, callbacks=child_callbacks(), **new_inputs
+        )
+        stages['combine'] = time.perf_counter() - start
+        if self.answer_cache is not None:
+            self.answer_cache.put(self.cache_namespace, question_vec, answer, docs, generation=cache_generation)
+        output = self._make_output(answer, docs, new_question)
+        self._record(output, stages, recorder, turn_start, docs)
+        return output
+
+    async def _acall(
+            self,
+            inputs: Dict[str, Any],
+            run_manager: Optional[AsyncCallbackManagerForChainRun] = None,
+    ) -> Dict[str, Any]:
+        # 父类的_acall是另一套流程，没有回答缓存、跳过改写和性能记录；和Chain的默认实现一样放到线程池里执行_call
+        return await run_in_executor(None, self._call, inputs, run_manager.get_sync() if run_manager else None)
+
+    def _make_output(self, answer, docs, new_question, from_cache=False):
+        output = {self.output_key: answer, 'from_cache': from_cache}
+        if self.return_source_documents:
+            output["source_documents"] = docs
+        if self.return_generated_question:
+            output["generated_question"] = new_question
+        return output
+
+    def _record(self, output, stages, recorder, turn_start, docs):
+        if recorder is None:
+            return
+        record = {
+            'ts': time.time(),
+            'model': self.cache_namespace,
+            'from_cache': output['from_cache'],
+            'chunks': len(docs),
+            'llm_calls': len(recorder.calls),
+            'ttft': None,
+            'tokens_in': None,
+            'tokens_out': None,
+            'tokens_per_s': None,
+        }
+        combine = stages.pop('combine', None)
+        if combine is not None and recorder.calls:
+            # 最后一次LLM调用是回答生成，combine阶段中除去生成的部分就是prompt拼装
+            call = recorder.calls[-1]
+            stages['generation'] = call['end'] - call['start']
+            stages['prompt'] = max(combine - stages['generation'], 0.0)
+            if call['first_token'] is not None:
+                record['ttft'] = call['first_token'] - turn_start
+            tokens_in, tokens_out = count_call_tokens(call, self.token_counter)
+            record['tokens_in'], record['tokens_out'] = tokens_in, tokens_out
+            decode_time = call['end'] - (call['first_token'] or call['start'])
+            if tokens_out and decode_time > 0:
+                record['tokens_per_s'] = tokens_out / decode_time
+        stages['total'] = time.perf_counter() - turn_start
+        record['stages'] = stages
+        output['metrics'] = record
+        self.metrics_store.add(record)
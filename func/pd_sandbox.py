@@ -0,0 +1,287 @@
+"""
+在预先启动的子进程中执行PD测试器里用户写的solve(df1, df2, df3)，不在streamlit进程里exec
+
+    pool = SandboxPool(n_workers=2, cpu_limit=5, wall_limit=10, memory_limit=1024 ** 3)
+    res = pool.run(code, dataset_key, frames)    # res['ok'], res['result'], res['elapsed'], res['peak_mb'] ...
+
+- 数据集按dataset_key放进共享内存，pickle protocol 5，数值列的buffer不经过pickle直接拷贝；worker按key缓存，
+  同一个数据集每个worker只反序列化一次，每次执行时拷贝一份交给用户代码，用户代码改了也不影响下一次
+- 每次执行前设置RLIMIT_CPU和RLIMIT_AS：超过CPU时间收到SIGXCPU，超过内存抛出MemoryError，worker继续可用；
+  sleep等不占CPU的情况由父进程的wall_limit兜底，超时kill掉worker换新的
+- 结果按(代码的sha256, dataset_key)缓存，页面因为别的控件重新运行时不再执行
+- 执行时间和峰值内存（执行前通过/proc/self/clear_refs重置VmHWM，只支持Linux）一起返回
+"""
+import contextlib
+import hashlib
+import io
+import multiprocessing
+import pickle
+import queue
+import resource
+import signal
+import threading
+import time
+import traceback
+from collections import OrderedDict
+from multiprocessing import shared_memory
+
+import pandas as pd
+
+
+class CpuTimeExceeded(Exception):
+    pass
+
+
+class SandboxTimeout(Exception):
+    pass
+
+
+def _pack_frames(frames):
+    """
+    把DataFrame序列化进一块共享内存，返回(SharedMemory, meta)，meta很小，通过pipe发给worker
+    """
+    buffers = []
+    payload = pickle.dumps(frames, protocol=5, buffer_callback=buffers.append)
+    raws = [buf.raw() for buf in buffers]
+    size = len(payload) + sum(raw.nbytes for raw in raws)
+    shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+    shm.buf[:len(payload)] = payload
+    offsets = []
+    pos = len(payload)
+    for raw in raws:
+        shm.buf[pos:pos + raw.nbytes] = raw
+        offsets.append((pos, raw.nbytes))
+        pos += raw.nbytes
+    return shm, (shm.name, len(payload), offsets)
+
+
+def _unpack_frames(meta):
+    name, payload_len, offsets = meta
+    shm = shared_memory.SharedMemory(name=name)
+    # 只读，worker缓存的这一份不会被改掉
+    buf = shm.buf.toreadonly()
+    frames = pickle.loads(buf[:payload_len], buffers=[buf[pos:pos + n] for pos, n in offsets])
+    return shm, frames
+
+
+def _status_kb(key):
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(key):
+                return int(line.split()[1])
+
+
+def _reset_peak_rss():
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def _on_sigxcpu(signum, frame):
+    raise CpuTimeExceeded()
+
+
+def _shrink_result(result, max_rows):
+    if isinstance(result, (pd.DataFrame, pd.Series)) and len(result) > max_rows:
+        return result.head(max_rows), f"{type(result).__name__}{result.shape}，只显示前{max_rows}行"
+    return result, None
+
+
+def _execute(code, frames, cpu_limit, memory_limit, max_rows):
+    out = io.StringIO()
+    res = {'ok': False, 'result': None, 'note': None, 'error': None}
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    cpu_used = usage.ru_utime + usage.ru_stime
+    resource.setrlimit(resource.RLIMIT_CPU, (int(cpu_used + cpu_limit) + 1, resource.RLIM_INFINITY))
+    if memory_limit:
+        vm_size = _status_kb('VmSize:') * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (vm_size + memory_limit, resource.RLIM_INFINITY))
+    rss_before = _status_kb('VmRSS:')
+    _reset_peak_rss()
+    start = time.perf_counter()
+    try:
+        with contextlib.redirect_stdout(out):
+            glo = {'pd': pd}
+            exec(code, glo)
+            if 'solve' not in glo:
+                raise NameError("没有定义solve(df1, df2, df3)")
+            result = glo['solve'](*[df.copy() for df in frames])
+        res['result'], res['note'] = _shrink_result(result, max_rows)
+        res['ok'] = True
+    except CpuTimeExceeded:
+        res['error'] = f"CPU时间超过{cpu_limit}秒"
+        res['limit'] = True
+    except MemoryError:
+        res['error'] = f"内存超过{memory_limit / 1024 ** 2:.0f}MB"
+        res['limit'] = True
+    except BaseException:
+        res['error'] = traceback.format_exc(limit=-3)
+    finally:
+        res['elapsed'] = time.perf_counter() - start
+        resource.setrlimit(resource.RLIMIT_CPU, (resource.RLIM_INFINITY, resource.RLIM_INFINITY))
+        resource.setrlimit(resource.RLIMIT_AS, (resource.RLIM_INFINITY, resource.RLIM_INFINITY))
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    res['cpu_time'] = usage.ru_utime + usage.ru_stime - cpu_used
+    res['peak_mb'] = _status_kb('VmHWM:') / 1024
+    res['peak_delta_mb'] = res['peak_mb'] - rss_before / 1024
+    res['stdout'] = out.getvalue()[-10000:]
+    return res
+
+
+def _worker_main(conn):
+    signal.signal(signal.SIGXCPU, _on_sigxcpu)
+    conn.send(('ready', None))
+    dataset_key, shm, frames = None, None, None
+    while True:
+        msg = conn.recv()
+        if msg is None:
+            break
+        code, key, meta, cpu_limit, memory_limit, max_rows = msg
+        if key != dataset_key:
+            # 只缓存最近的一个数据集
+            frames = None
+            if shm is not None:
+                try:
+                    shm.close()
+                except BufferError:
+                    # 还有对象引用着旧数据，留给进程退出时释放
+                    pass
+            dataset_key, shm = None, None
+            try:
+                shm, frames = _unpack_frames(meta)
+            except FileNotFoundError:
+                # 数据集刚好被父进程淘汰
+                conn.send(('ok', {'ok': False, 'error': "数据集已失效，请重试", 'limit': True, 'elapsed': None}))
+                continue
+            dataset_key = key
+            # 大数据集反序列化比较慢，单独通知父进程，不计入执行的时间限制
+            conn.send(('loaded', None))
+        res = _execute(code, frames, cpu_limit, memory_limit, max_rows)
+        try:
+            conn.send(('ok', res))
+        except Exception:
+            # 结果无法pickle时退化成repr
+            res['result'] = repr(res['result'])[:10000]
+            conn.send(('ok', res))
+    frames = None
+    if shm is not None:
+        try:
+            shm.close()
+        except BufferError:
+            pass
+
+
+class _Worker:
+    def __init__(self, ctx):
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(target=_worker_main, args=(child_conn,), daemon=True, name="pd-sandbox")
+        self.process.start()
+        child_conn.close()
+        self.ready = False
+        self.dataset_key = None
+
+    def wait_ready(self, timeout=60):
+        if not self.ready:
+            if not self.conn.poll(timeout):
+                raise RuntimeError("sandbox进程启动超时")
+            self.conn.recv()
+            self.ready = True
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+
+class SandboxPool:
+    def __init__(self, n_workers=2, cpu_limit=5, wall_limit=10, memory_limit=1024 ** 3, max_rows=1000,
+                 cache_size=64, max_datasets=2, load_timeout=120):
+        self.n_workers = n_workers
+        self.cpu_limit = cpu_limit
+        self.wall_limit = wall_limit
+        self.memory_limit = memory_limit
+        self.max_rows = max_rows
+        self.cache_size = cache_size
+        self.max_datasets = max_datasets
+        self.load_timeout = load_timeout
+        self._ctx = multiprocessing.get_context('spawn')
+        self._idle = queue.Queue()
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()
+        # dataset_key -> (SharedMemory, meta)
+        self._datasets = OrderedDict()
+        for _ in range(n_workers):
+            self._idle.put(_Worker(self._ctx))
+
+    def _dataset_meta(self, key, frames):
+        with self._lock:
+            if key in self._datasets:
+                self._datasets.move_to_end(key)
+                return self._datasets[key][1]
+            shm, meta = _pack_frames(frames)
+            self._datasets[key] = (shm, meta)
+            while len(self._datasets) > self.max_datasets:
+                # unlink之后已经映射的worker仍然可以用，新的worker会拿到新的数据集
+                old, _ = self._datasets.popitem(last=False)[1]
+                old.close()
+                old.unlink()
+            return meta
+
+    def run(self, code, dataset_key, frames):
+        """
+        frames: [df1, df2, df3]；dataset_key相同时frames必须相同
+        返回dict: ok, result, note, error, stdout, elapsed, cpu_time, peak_mb, peak_delta_mb, cached
+        """
+        key = (hashlib.sha256(code.encode('utf-8')).hexdigest(), dataset_key)
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return {**self._cache[key], 'cached': True}
+        meta = self._dataset_meta(dataset_key, frames)
+        worker = self._idle.get()
+        try:
+            worker.wait_ready()
+            worker.conn.send((code, dataset_key, meta, self.cpu_limit, self.memory_limit, self.max_rows))
+            status = 'loaded'
+            if worker.dataset_key != dataset_key:
+                if not worker.conn.poll(self.load_timeout):
+                    raise SandboxTimeout(f"加载数据集超过{self.load_timeout}秒")
+                status, res = worker.conn.recv()
+                worker.dataset_key = dataset_key if status == 'loaded' else None
+            if status == 'loaded':
+                if not worker.conn.poll(self.wall_limit):
+                    raise SandboxTimeout(f"执行超过{self.wall_limit}秒")
+                _, res = worker.conn.recv()
+        except SandboxTimeout as e:
+            worker.kill()
+            worker = _Worker(self._ctx)
+            return {'ok': False, 'error': str(e), 'elapsed': self.wall_limit, 'cached': False}
+        except (EOFError, OSError):
+            # 比如内存超限时在C代码里直接崩溃
+            worker.kill()
+            worker = _Worker(self._ctx)
+            return {'ok': False, 'error': "执行进程异常退出", 'elapsed': None, 'cached': False}
+        finally:
+            self._idle.put(worker)
+        if res.get('limit'):
+            # 超出限制和机器负载有关，不缓存
+            return {**res, 'cached': False}
+        with self._lock:
+            self._cache[key] = res
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return {**res, 'cached': False}
+
+    def close(self):
+        for _ in range(self.n_workers):
+            worker = self._idle.get()
+            worker.conn.send(None)
+            worker.process.join(1)
+            worker.kill()
+        with self._lock:
+            for shm, _ in self._datasets.values():
+                shm.close()
+                shm.unlink()
+            self._datasets.clear()
@@ -1,57 +1,78 @@
-import random
-
-import pandas as pd
 import streamlit as st
-from faker import Faker
 from streamlit_ace import st_ace
 
+from func.pd_sandbox import SandboxPool
+from func.pd_toy_data import load_or_generate
+from settings import PD_TOY_WORKERS, PD_TOY_CPU_LIMIT, PD_TOY_WALL_LIMIT, PD_TOY_MEMORY_LIMIT, PD_TOY_MAX_RESULT_ROWS, \
+    PD_TOY_DATA_FORMAT, PD_TOY_DATA_DIR, PD_TOY_VOCAB_SIZE, PD_TOY_PREVIEW_ROWS
+
+
+@st.cache_resource
+def get_sandbox_pool():
+    return SandboxPool(PD_TOY_WORKERS, PD_TOY_CPU_LIMIT, PD_TOY_WALL_LIMIT, PD_TOY_MEMORY_LIMIT,
+                       PD_TOY_MAX_RESULT_ROWS)
+
+
+@st.cache_resource(max_entries=2)
+def get_dataset(n_users, n_posts, n_follows, seed):
+    """
+    按(规模, 种子)缓存，同一个数据集所有会话共用，不会在每次重新运行页面时重新生成
+    """
+    return load_or_generate(n_users, n_posts, n_follows, seed, PD_TOY_VOCAB_SIZE, PD_TOY_DATA_FORMAT,
+                            PD_TOY_DATA_DIR)
+
+
+def _preview(name, df):
+    st.markdown(f"#### {name}")
+    if len(df) > PD_TOY_PREVIEW_ROWS:
+        st.caption(f"{df.shape}，只显示前{PD_TOY_PREVIEW_ROWS}行")
+        df = df.head(PD_TOY_PREVIEW_ROWS)
+    st.write(df)
+
 
 def pd_toy_page():
     st.title("PD测试器")
-    N = 10
-    M = 5
-    random.seed(12)
-    Faker.seed(0)
-    fake = Faker("zh_CN")
-    names = [fake.name() for _ in range(N)]
+    col1, col2, col3, col4 = st.columns(4)
+    N = col1.number_input("用户数", 1, 100_000_000, 10)
+    n_posts = col2.number_input("帖子数", 0, 100_000_000, N * 2)
+    n_follows = col3.number_input("关注数", 0, 1_000_000_000, N * 5)
+    seed = col4.number_input("随机种子", 0, 2 ** 31 - 1, 12)
+    with st.spinner("正在生成数据"):
+        (df1, df2, df3), info = get_dataset(N, n_posts, n_follows, seed)
+    memory = "，".join(f"{name} {mb:.2f}MB" for name, mb in info['memory_mb'].items())
+    st.caption(f"{'生成' if info['source'] == 'generated' else '读取' + info['source']}耗时{info['seconds']:.2f}s，"
+               f"内存：{memory}")
     # 个人信息
-    st.markdown("#### df1")
-    df1 = pd.DataFrame({
-        'uid': [i for i in range(N)],
-        "姓名": names,
-        "头像": [fake.emoji() for _ in range(N)],
-        "年龄": [random.randint(0, 99) for _ in range(N)],
-        "工作": [fake.job() for _ in range(N)],
-        "工资": [random.random() * 100000 for _ in range(N)],
-        "专业": [random.choice(list('ABCDEFG')) for _ in range(N)],
-        "住址": [fake.address() for _ in range(N)],
-    })
-    st.write(df1)
+    _preview("df1", df1)
     col1, col2 = st.columns([5, 2])
     # posts
     with col1:
-        st.markdown("#### df2")
-        df2 = pd.DataFrame({
-            'pid': [i for i in range(N*2)],
-            "uid": [random.randint(0, N-1) for _ in range(N*2)],
-            "Post": [fake.text() for _ in range(N*2)],
-        })
-        st.write(df2)
+        _preview("df2", df2)
     with col2:
         # friends
-        st.markdown("#### df3")
-        df3 = pd.DataFrame({
-            "follower": [random.randint(0, N-1) for _ in range(N*5)],
-            "followed": [random.randint(0, N-1) for _ in range(N*5)],
-        })
-        st.write(df3)
+        _preview("df3", df3)
     content = st_ace(value="""def solve(df1, df2, df3):
     pass""", language="python", keybinding="emacs")
-    loc = {}
-    glo = {'pd': pd}
-    # glo传入全局变量
-    # loc收集局部变量
-    exec(content, glo, loc)
-    st.write(loc['solve'](df1, df2, df3))
+    if not content:
+        return
+    # 用户代码在sandbox子进程中执行，数据集由规模和种子唯一确定
+    res = get_sandbox_pool().run(content, (N, n_posts, n_follows, seed, PD_TOY_VOCAB_SIZE), [df1, df2, df3])
+    if res['ok']:
+        if res['note']:
+            st.caption(res['note'])
+        st.write(res['result'])
+    else:
+        st.error("执行失败")
+        st.code(res['error'], language=None)
+    if res.get('stdout'):
+        st.code(res['stdout'], language=None)
+    if res['elapsed'] is not None:
+        info = f"执行耗时{res['elapsed'] * 1000:.1f}ms"
+        if 'peak_mb' in res:
+            info += f"，CPU时间{res['cpu_time'] * 1000:.1f}ms，峰值内存{res['peak_mb']:.0f}MB" \
+                    f"（比执行前增加{res['peak_delta_mb']:.1f}MB）"
+        if res['cached']:
+            info += "，代码未改动，使用缓存的结果"
+        st.caption(info)
 
 
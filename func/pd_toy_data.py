@@ -0,0 +1,166 @@
+"""
+PD测试器的数据集生成：先用Faker生成一批姓名、工作、地址、帖子等词表，再用NumPy一次性按下标采样，
+百万用户、千万关注关系也只要几秒
+
+    frames, info = load_or_generate(n_users=1000000, n_posts=2000000, n_follows=10000000, seed=12)
+
+- 字符串列先生成下标（codes），再vocab[codes]得到object列，各行共用词表里的字符串对象
+- fmt='parquet': 每个DataFrame存一个parquet文件；fmt='mmap': 每列存一个.npy，字符串列只存codes和词表，
+  读取时数值列直接np.load(mmap_mode='r')，不拷贝
+"""
+import importlib.util
+import json
+import os
+import shutil
+import time
+from functools import lru_cache
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from faker import Faker
+
+FRAMES = ['df1', 'df2', 'df3']
+
+
+@lru_cache(maxsize=4)
+def build_vocab(seed, size=1000):
+    """
+    每种字符串预先生成size个，返回{名称: object数组}
+    """
+    Faker.seed(seed)
+    fake = Faker("zh_CN")
+    vocab = {
+        'name': [fake.name() for _ in range(size)],
+        'emoji': [fake.emoji() for _ in range(size)],
+        'job': [fake.job() for _ in range(size)],
+        'address': [fake.address() for _ in range(size)],
+        'text': [fake.text() for _ in range(size)],
+        'major': list('ABCDEFG'),
+    }
+    return {key: np.array(values, dtype=object) for key, values in vocab.items()}
+
+
+def generate_columns(n_users, n_posts, n_follows, seed, vocab_size=1000):
+    """
+    返回{frame: {列名: ndarray 或 (codes, 词表)}}，字符串列保持codes形式，方便按列存盘
+    """
+    vocab = build_vocab(seed, vocab_size)
+    rng = np.random.default_rng(seed)
+
+    def pick(key, n):
+        return rng.integers(0, len(vocab[key]), n, dtype=np.int32), vocab[key]
+
+    return {
+        # 个人信息
+        'df1': {
+            'uid': np.arange(n_users, dtype=np.int64),
+            "姓名": pick('name', n_users),
+            "头像": pick('emoji', n_users),
+            "年龄": rng.integers(0, 100, n_users, dtype=np.int64),
+            "工作": pick('job', n_users),
+            "工资": rng.random(n_users) * 100000,
+            "专业": pick('major', n_users),
+            "住址": pick('address', n_users),
+        },
+        # posts
+        'df2': {
+            'pid': np.arange(n_posts, dtype=np.int64),
+            "uid": rng.integers(0, n_users, n_posts, dtype=np.int64),
+            "Post": pick('text', n_posts),
+        },
+        # friends
+        'df3': {
+            "follower": rng.integers(0, n_users, n_follows, dtype=np.int64),
+            "followed": rng.integers(0, n_users, n_follows, dtype=np.int64),
+        },
+    }
+
+
+def columns_to_frames(columns):
+    frames = []
+    for name in FRAMES:
+        data = {col: values[1][values[0]] if isinstance(values, tuple) else values
+                for col, values in columns[name].items()}
+        frames.append(pd.DataFrame(data, copy=False))
+    return frames
+
+
+def _save_mmap(columns, path):
+    meta = {}
+    for name in FRAMES:
+        meta[name] = []
+        for i, (col, values) in enumerate(columns[name].items()):
+            entry = {'name': col, 'file': f"{name}_{i}.npy"}
+            if isinstance(values, tuple):
+                codes, vocab = values
+                np.save(path / entry['file'], codes)
+                entry['vocab'] = vocab.tolist()
+            else:
+                np.save(path / entry['file'], values)
+            meta[name].append(entry)
+    (path / 'meta.json').write_text(json.dumps(meta, ensure_ascii=False), encoding='utf-8')
+
+
+def _load_mmap(path):
+    meta = json.loads((path / 'meta.json').read_text(encoding='utf-8'))
+    columns = {}
+    for name in FRAMES:
+        columns[name] = {}
+        for entry in meta[name]:
+            values = np.load(path / entry['file'], mmap_mode='r')
+            if 'vocab' in entry:
+                values = (np.asarray(values), np.array(entry['vocab'], dtype=object))
+            columns[name][entry['name']] = values
+    return columns_to_frames(columns)
+
+
+def _save_parquet(frames, path):
+    for name, df in zip(FRAMES, frames):
+        df.to_parquet(path / f"{name}.parquet", index=False)
+
+
+def _load_parquet(path):
+    return [pd.read_parquet(path / f"{name}.parquet") for name in FRAMES]
+
+
+def dataset_dir(data_dir, fmt, n_users, n_posts, n_follows, seed, vocab_size):
+    return Path(data_dir) / f"{fmt}_{seed}_{n_users}_{n_posts}_{n_follows}_{vocab_size}"
+
+
+def load_or_generate(n_users, n_posts, n_follows, seed, vocab_size=1000, fmt=None, data_dir=None):
+    """
+    fmt为None时只生成不存盘；返回([df1, df2, df3], info)，info里有耗时、来源和每个DataFrame的内存
+    """
+    if fmt == 'parquet' and not any(importlib.util.find_spec(m) for m in ('pyarrow', 'fastparquet')):
+        # pandas读写parquet需要pyarrow或fastparquet，不在这里报错的话要等生成完数据、写文件时才失败
+        raise ImportError("PD_TOY_DATA_FORMAT='parquet'需要安装pyarrow（pip install pyarrow），或改用'mmap'")
+    start = time.perf_counter()
+    path = dataset_dir(data_dir, fmt, n_users, n_posts, n_follows, seed, vocab_size) if fmt else None
+    if path is not None and path.exists():
+        frames = _load_mmap(path) if fmt == 'mmap' else _load_parquet(path)
+        source = fmt
+    else:
+        columns = generate_columns(n_users, n_posts, n_follows, seed, vocab_size)
+        frames = columns_to_frames(columns)
+        source = 'generated'
+        if path is not None:
+            # 先写到临时目录再改名，多个会话同时生成时不会读到一半的文件
+            tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+            tmp_path.mkdir(parents=True, exist_ok=True)
+            if fmt == 'mmap':
+                _save_mmap(columns, tmp_path)
+            else:
+                _save_parquet(frames, tmp_path)
+            try:
+                tmp_path.rename(path)
+            except OSError:
+                shutil.rmtree(tmp_path, ignore_errors=True)
+    info = {
+        'source': source,
+        'seconds': time.perf_counter() - start,
+        # deep=True会把共用的字符串重复计算，这里只算列本身（object列是指针）
+        'memory_mb': {name: df.memory_usage(index=True).sum() / 1024 ** 2 for name, df in zip(FRAMES, frames)},
+        'shapes': {name: df.shape for name, df in zip(FRAMES, frames)},
+    }
+    return frames, info
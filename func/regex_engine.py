@@ -0,0 +1,207 @@
+"""
+在独立的进程中执行用户输入的正则，超时直接kill掉进程，灾难性回溯的正则不会卡住streamlit
+
+    engine = RegexEngine(n_workers=2, timeout=1.0)
+    res = engine.run(r"(a+)+$", text)    # 超时抛出RegexTimeout，正则有语法错误抛出re.error
+
+- worker进程预先启动，编译好的正则在worker里按(pattern, flags)缓存
+- 同一段文本只发给worker一次，之后只发正则
+- 结果按(文本摘要, pattern, flags)缓存，翻页等重新运行页面时不会再匹配一次；超时的组合也记下来，再次运行时直接报超时
+"""
+import hashlib
+import html
+import multiprocessing
+import queue
+import re
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+from functools import lru_cache
+
+
+class RegexTimeout(Exception):
+    pass
+
+
+@lru_cache(maxsize=256)
+def _compile(pattern, flags):
+    return re.compile(pattern, flags)
+
+
+def _worker_main(conn):
+    conn.send(('ready', None))
+    text = None
+    while True:
+        msg = conn.recv()
+        if msg is None:
+            return
+        msg_text, pattern, flags, max_spans = msg
+        if msg_text is not None:
+            text = msg_text
+        start = time.perf_counter()
+        try:
+            compiled = _compile(pattern, flags)
+        except re.error as e:
+            conn.send(('error', (e.msg, e.pattern, e.pos)))
+            continue
+        count = 0
+        spans = array('q')
+        for match in compiled.finditer(text):
+            count += 1
+            if count <= max_spans:
+                spans.extend(match.span())
+        conn.send(('ok', (count, spans.tobytes(), time.perf_counter() - start)))
+
+
+class RegexResult:
+    """
+    count: 匹配总数；spans: 前max_spans个匹配的(start, end)，按start有序；elapsed: worker中编译+匹配的秒数
+    """
+
+    def __init__(self, count, spans, elapsed):
+        self.count = count
+        self.spans = spans
+        self.elapsed = elapsed
+        self._starts = spans[0::2]
+
+    @property
+    def truncated(self):
+        return self.count > len(self)
+
+    def __len__(self):
+        return len(self.spans) // 2
+
+    def span(self, i):
+        return self.spans[2 * i], self.spans[2 * i + 1]
+
+    def overlapping(self, lo, hi):
+        """
+        和[lo, hi)有重叠的匹配的序号范围
+        """
+        i = bisect_left(self._starts, lo)
+        # 前一个匹配可能跨过lo
+        if i > 0 and self.spans[2 * i - 1] > lo:
+            i -= 1
+        j = bisect_left(self._starts, hi, lo=i)
+        return range(i, j)
+
+
+class _Worker:
+    def __init__(self, ctx):
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(target=_worker_main, args=(child_conn,), daemon=True, name="regex-worker")
+        self.process.start()
+        child_conn.close()
+        self.digest = None
+        self.ready = False
+
+    def wait_ready(self, timeout=60):
+        # spawn的子进程启动要导入主模块，不计入匹配的时间
+        if not self.ready:
+            if not self.conn.poll(timeout):
+                raise RuntimeError("正则worker进程启动超时")
+            self.conn.recv()
+            self.ready = True
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+
+class RegexEngine:
+    def __init__(self, n_workers=2, timeout=1.0, max_spans=100000, cache_size=32):
+        self.n_workers = n_workers
+        self.timeout = timeout
+        self.max_spans = max_spans
+        self.cache_size = cache_size
+        # spawn: streamlit进程里有很多线程，fork不安全
+        self._ctx = multiprocessing.get_context('spawn')
+        self._idle = queue.Queue()
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()
+        # 超时过的(文本摘要, pattern, flags)
+        self._timeouts = OrderedDict()
+        for _ in range(n_workers):
+            self._idle.put(self._start_worker())
+
+    def _start_worker(self):
+        return _Worker(self._ctx)
+
+    def _call(self, worker, digest, text, pattern, flags):
+        worker.wait_ready()
+        worker.conn.send((text if worker.digest != digest else None, pattern, flags, self.max_spans))
+        worker.digest = digest
+        if not worker.conn.poll(self.timeout):
+            raise RegexTimeout(f"匹配超过{self.timeout}秒")
+        return worker.conn.recv()
+
+    def run(self, pattern, text, flags=0):
+        digest = hashlib.sha1(text.encode('utf-8', 'surrogatepass')).hexdigest()
+        key = (digest, pattern, flags)
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+            if key in self._timeouts:
+                # 已知会超时，不再占用worker跑满时间、也不用再换一个worker
+                self._timeouts.move_to_end(key)
+                raise RegexTimeout(self._timeouts[key])
+        worker = self._idle.get()
+        try:
+            status, payload = self._call(worker, digest, text, pattern, flags)
+        except RegexTimeout as e:
+            # 正在执行的匹配无法中断，只能kill掉换一个新的worker
+            worker.kill()
+            worker = self._start_worker()
+            with self._lock:
+                self._timeouts[key] = str(e)
+                while len(self._timeouts) > self.cache_size:
+                    self._timeouts.popitem(last=False)
+            raise
+        except (EOFError, OSError) as e:
+            worker.kill()
+            worker = self._start_worker()
+            raise RuntimeError("正则worker进程异常退出") from e
+        finally:
+            self._idle.put(worker)
+        if status == 'error':
+            raise re.error(*payload)
+        count, spans, elapsed = payload
+        spans_array = array('q')
+        spans_array.frombytes(spans)
+        result = RegexResult(count, spans_array, elapsed)
+        with self._lock:
+            self._cache[key] = result
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return result
+
+    def close(self):
+        for _ in range(self.n_workers):
+            worker = self._idle.get()
+            worker.conn.send(None)
+            worker.process.join(1)
+            worker.kill()
+
+
+def highlight(text, result: RegexResult, lo=0, hi=None, style="background:red"):
+    """
+    把text[lo:hi]中的匹配用span标出来，返回html；各段拼到list里最后join，和长度成线性
+    """
+    hi = len(text) if hi is None else hi
+    parts = []
+    pos = lo
+    for i in result.overlapping(lo, hi):
+        s, e = result.span(i)
+        s, e = max(s, lo), min(e, hi)
+        if s == e:
+            continue
+        parts.append(html.escape(text[pos:s]))
+        parts.append(f'<span style="{style}">{html.escape(text[s:e])}</span>')
+        pos = e
+    parts.append(html.escape(text[pos:hi]))
+    # markdown会把空行当成html块的结束，换行统一换成<br>
+    return "".join(parts).replace("\n", "<br>")
@@ -1,7 +1,25 @@
+import math
 import re
 
+import pandas as pd
 import streamlit as st
 
+from func.regex_engine import RegexEngine, RegexTimeout, highlight
+from settings import REGEX_WORKERS, REGEX_TIMEOUT, REGEX_MAX_MATCHES, REGEX_PAGE_CHARS, REGEX_MATCHES_PER_PAGE
+
+
+@st.cache_resource
+def get_regex_engine():
+    return RegexEngine(REGEX_WORKERS, REGEX_TIMEOUT, REGEX_MAX_MATCHES)
+
+
+def _page_number(label, n_pages, key):
+    if n_pages <= 1:
+        return 1
+    if st.session_state.get(key, 1) > n_pages:
+        st.session_state[key] = n_pages
+    return st.number_input(f"{label}（共{n_pages}页）", 1, n_pages, key=key)
+
 
 def regex_test_page():
     st.title("正则表达式")
@@ -13,15 +31,30 @@ def regex_test_page():
     placeholder = st.empty()
     re_exp = st.text_input(label="输入正则表达式", value="\w+@(\w+\.)+\w+")
     if re_exp:
-        matcher = re.compile(re_exp)
-        matches = matcher.finditer(data)
-        final_str = ""
-        pos = 0
-        for match in matches:
-            s, e = match.span()
-            final_str += data[pos:s]
-            final_str += '<span style="background:red">' + data[s:e] + '</span>'
-            pos = e
-        final_str += data[pos:]
-        placeholder.markdown(final_str, unsafe_allow_html=True)
+        try:
+            res = get_regex_engine().run(re_exp, data)
+        except RegexTimeout:
+            st.error(f"匹配超过{REGEX_TIMEOUT}秒，已中止，可能是正则的回溯太多")
+            return
+        except re.error as e:
+            st.error(f"正则表达式有误：{e}")
+            return
+        info = f"{res.count}个匹配，耗时{res.elapsed * 1000:.1f}ms"
+        if res.truncated:
+            info += f"，只显示前{len(res)}个"
+        st.caption(info)
+
+        # 长文本分页高亮，每页只处理当前窗口内的字符和匹配
+        page = _page_number("文本页码", math.ceil(len(data) / REGEX_PAGE_CHARS), 'regex_text_page')
+        lo = (page - 1) * REGEX_PAGE_CHARS
+        placeholder.markdown(
+            f'<div style="white-space: pre-wrap">{highlight(data, res, lo, lo + REGEX_PAGE_CHARS)}</div>',
+            unsafe_allow_html=True)
 
+        if len(res):
+            page = _page_number("匹配页码", math.ceil(len(res) / REGEX_MATCHES_PER_PAGE), 'regex_match_page')
+            rows = []
+            for i in range((page - 1) * REGEX_MATCHES_PER_PAGE, min(len(res), page * REGEX_MATCHES_PER_PAGE)):
+                s, e = res.span(i)
+                rows.append({'#': i, 'start': s, 'end': e, 'match': data[s:min(e, s + 200)]})
+            st.dataframe(pd.DataFrame(rows), hide_index=True, use_container_width=True)
@@ -1,61 +1,123 @@
 import datetime
+import math
+import sqlite3
+import threading
 
 import pandas as pd
 import streamlit as st
 
-from settings import TODOCSV_PATH
+from settings import TODOCSV_PATH, TODO_DB_PATH, TODO_PAGE_SIZE
+
+
+class TodoStore:
+    """
+    待办列表存在sqlite里，每次只改一行、只读当前页
+
+    - (status, due)和(status, finished_date)上有索引，分页查询和计数不扫全表
+    - WAL模式，多个会话/进程同时写时由sqlite串行化，不会互相覆盖
+    - 勾选时按id更新，并且只在状态确实变化时更新，别人已经改过的行不会被改回去
+    """
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(path), check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS todo ("
+            "id INTEGER PRIMARY KEY, task TEXT NOT NULL, due TEXT, status TEXT NOT NULL, finished_date TEXT)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS todo_status_due ON todo(status, due, id)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS todo_status_finished ON todo(status, finished_date, id)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self._conn.commit()
+
+    def import_csv(self, csv_path):
+        """
+        导入旧版的CSV，只导入一次（meta表里记录），返回导入的行数
+        """
+        if not csv_path.exists():
+            return 0
+        with self._lock, self._conn:
+            # BEGIN IMMEDIATE拿到写锁，多个进程同时启动时只有一个会导入
+            self._conn.execute("BEGIN IMMEDIATE")
+            key = f"imported:{csv_path}"
+            if self._conn.execute("SELECT 1 FROM meta WHERE key = ?", (key,)).fetchone():
+                return 0
+            df = pd.read_csv(csv_path)
+            rows = [tuple(None if pd.isna(v) else str(v) for v in row)
+                    for row in df[['task', 'due', 'status', 'finished_date']].itertuples(index=False)]
+            self._conn.executemany("INSERT INTO todo (task, due, status, finished_date) VALUES (?, ?, ?, ?)", rows)
+            self._conn.execute("INSERT INTO meta VALUES (?, ?)", (key, datetime.datetime.now().isoformat()))
+            return len(rows)
+
+    def add(self, task, due):
+        with self._lock, self._conn:
+            cur = self._conn.execute("INSERT INTO todo (task, due, status) VALUES (?, ?, 'todo')",
+                                     (task, str(due)))
+            return cur.lastrowid
+
+    def set_status(self, task_id, status):
+        """
+        返回是否真的更新了，已经是目标状态（比如别人刚勾过）时返回False
+        """
+        finished = datetime.datetime.now().isoformat(sep=' ', timespec='seconds') if status == 'done' else None
+        with self._lock, self._conn:
+            cur = self._conn.execute("UPDATE todo SET status = ?, finished_date = ? WHERE id = ? AND status != ?",
+                                     (status, finished, task_id, status))
+            return cur.rowcount > 0
+
+    def count(self, status):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM todo WHERE status = ?", (status,)).fetchone()[0]
+
+    def page(self, status, offset, limit):
+        """
+        todo按截止日期升序，done按完成时间倒序，返回[(id, task, due, finished_date)]
+        """
+        order = "due, id" if status == 'todo' else "finished_date DESC, id DESC"
+        with self._lock:
+            return self._conn.execute(
+                f"SELECT id, task, due, finished_date FROM todo WHERE status = ? ORDER BY {order} LIMIT ? OFFSET ?",
+                (status, limit, offset)).fetchall()
+
+
+@st.cache_resource
+def get_todo_store():
+    store = TodoStore(TODO_DB_PATH)
+    store.import_csv(TODOCSV_PATH)
+    return store
+
+
+def _task_list(store, status):
+    total = store.count(status)
+    pages = max(1, math.ceil(total / TODO_PAGE_SIZE))
+    page_key = f'{status}_page'
+    # 别人删除/勾选后总页数可能变少
+    if st.session_state.get(page_key, 1) > pages:
+        st.session_state[page_key] = pages
+    page = st.number_input(f"页码（共{pages}页，{total}条）", 1, pages, key=page_key)
+    for task_id, task, due, finished_date in store.page(status, (page - 1) * TODO_PAGE_SIZE, TODO_PAGE_SIZE):
+        if status == 'todo':
+            # key用行id而不是位置，on_change在下一次运行前更新这一行
+            st.checkbox(f"{task} / {due}", key=f'todo-{task_id}',
+                        on_change=store.set_status, args=(task_id, 'done'))
+        else:
+            st.checkbox(f"{task} / {finished_date}", value=True, key=f'done-{task_id}',
+                        on_change=store.set_status, args=(task_id, 'todo'))
 
 
 def todolist_page():
     st.title("待办列表")
+    store = get_todo_store()
     with st.form('todolist', clear_on_submit=True):
         task = st.text_input('task')
         due = st.date_input('due')
         submit = st.form_submit_button()
-        if submit:
-            if not TODOCSV_PATH.exists():
-                data = {
-                    'task': [task],
-                    'due': [due],
-                    'status': ['todo'],
-                    'finished_date': [None]
-                }
-                df = pd.DataFrame(data)
-                df.to_csv(TODOCSV_PATH, index=False)
-            else:
-                data = {
-                    'task': task,
-                    'due': due,
-                    'status': 'todo',
-                    'finished_date': None,
-                }
-                df = pd.read_csv(TODOCSV_PATH)
-                df.loc[len(df)] = data
-                df.to_csv(TODOCSV_PATH, index=False)
+        if submit and task:
+            store.add(task, due)
     col1, col2 = st.columns(2)
     with col1:
         st.markdown("### TODO")
-        if TODOCSV_PATH.exists():
-            df = pd.read_csv(TODOCSV_PATH)
-            df = df.sort_values('due')
-            for i in range(len(df)):
-                if df.iloc[i, 2] == 'todo':
-                    checked = st.checkbox(f"{df.iloc[i, 0]} / {df.iloc[i, 1]}", key=f'{i + 10}')
-                    if checked:
-                        df.iloc[i, 2] = 'done'
-                        df.iloc[i, 3] = datetime.datetime.now()
-                        df.to_csv(TODOCSV_PATH, index=False)
-                        st.rerun()
+        _task_list(store, 'todo')
     with col2:
         st.markdown("### DONE")
-        if TODOCSV_PATH.exists():
-            df = pd.read_csv(TODOCSV_PATH)
-            df = df.sort_values('finished_date')
-            for i in range(min(len(df), 10)):
-                if df.iloc[i, 2] == 'done':
-                    checked = st.checkbox(f"{df.iloc[i, 0]} / {df.iloc[i, 3]}", value=True, key=f'{i}')
-                    if not checked:
-                        df.iloc[i, 2] = 'todo'
-                        df.iloc[i, 3] = None
-                        df.to_csv(TODOCSV_PATH, index=False)
-                        st.rerun()
+        _task_list(store, 'done')
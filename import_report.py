@@ -0,0 +1,34 @@
+"""
+统计每个页面模块的导入耗时，用法: python import_report.py [top_n]
+
+每个页面在独立的子进程中用 python -X importtime 导入，互不影响缓存
+"""
+import re
+import subprocess
+import sys
+
+from main import pages
+
+top_n = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+line_re = re.compile(r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)$")
+
+for name, page in pages.items():
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', f"import {page['module']}"],
+                          capture_output=True, text=True)
+    total = 0
+    costs = []
+    for line in proc.stderr.splitlines():
+        ma = line_re.match(line)
+        if not ma:
+            continue
+        self_us, cumulative_us, indent, module = ma.groups()
+        if module == page['module']:
+            total = int(cumulative_us)
+        elif len(indent) == 3:
+            # 页面模块直接导入的依赖
+            costs.append((int(cumulative_us), module))
+    costs.sort(reverse=True)
+    status = "ok" if proc.returncode == 0 else "import failed"
+    print(f"{name} ({page['module']}): {total / 1e6:.2f}s [{status}]")
+    for cost, module in costs[:top_n]:
+        print(f"    {cost / 1e6:8.3f}s  {module}")
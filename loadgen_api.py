@@ -0,0 +1,173 @@
+"""
+api_server的压测脚本：多个并发客户端连续提问，统计吞吐、首token时间和总耗时的分位数，结果以JSON输出
+
+    python api_server.py --stub-llm &
+    python loadgen_api.py --concurrency 16 --requests 200
+    python loadgen_api.py --start-server --concurrency 16 --duration 30 --turns 3
+
+--start-server会用stub LLM启动一个api_server子进程，压测结束后关闭。
+被拒绝（429/503/409）的请求单独计数，不计入延迟统计
+"""
+import argparse
+import asyncio
+import json
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import aiohttp
+
+QUESTIONS = ["如何配置服务的超时时间？", "部署时出现E1024错误怎么办？", "向量检索的原理是什么？", "缓存命中率怎么统计？",
+             "模型推理很慢应该怎么排查？", "知识库支持哪些文件格式？", "如何更新网关的配置？", "日志保存在哪里？"]
+
+
+def percentiles(samples):
+    if not samples:
+        return None
+    samples = sorted(samples)
+    qs = statistics.quantiles(samples, n=100, method='inclusive') if len(samples) > 1 else samples * 99
+    return {
+        'n': len(samples),
+        'mean_ms': statistics.fmean(samples) * 1000,
+        'p50_ms': qs[49] * 1000,
+        'p95_ms': qs[94] * 1000,
+        'p99_ms': qs[98] * 1000,
+        'max_ms': samples[-1] * 1000,
+    }
+
+
+async def ask(session, url, model, session_id, question):
+    """
+    返回(status, ttft, total, tokens)，ttft是最后一次LLM调用（回答生成）的第一个token
+    """
+    start = time.perf_counter()
+    ttft, tokens = None, 0
+    async with session.post(f"{url}/v1/chat", json={'question': question, 'model': model,
+                                                     'session_id': session_id}) as resp:
+        if resp.status != 200:
+            await resp.read()
+            return resp.status, None, time.perf_counter() - start, 0
+        async for line in resp.content:
+            event = json.loads(line)
+            if event['type'] == 'llm_start':
+                ttft, tokens = None, 0
+            elif event['type'] == 'token':
+                if ttft is None:
+                    ttft = time.perf_counter() - start
+                tokens += 1
+            elif event['type'] == 'error':
+                return 'error', None, time.perf_counter() - start, 0
+    return 200, ttft, time.perf_counter() - start, tokens
+
+
+async def client(idx, args, http, deadline, counter, results):
+    rng = random.Random(args.seed + idx)
+    session_id, turn = None, 0
+    while time.perf_counter() < deadline:
+        if args.requests and counter['sent'] >= args.requests:
+            return
+        counter['sent'] += 1
+        if session_id is None or turn >= args.turns:
+            session_id, turn = f"loadgen-{idx}-{counter['sent']}", 0
+        # 加上随机后缀，避免全部命中回答缓存
+        question = f"{rng.choice(QUESTIONS)}（{rng.randrange(10 ** 6)}）"
+        try:
+            result = await ask(http, args.url, args.model, session_id, question)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            # 超时不是ClientError，不捕获的话一个请求超时会让整个gather失败
+            result = ('error', None, 0.0, 0)
+            print(f"request failed: {e}", file=sys.stderr)
+        results.append(result)
+        if result[0] in (429, 503):
+            # 被限流时等一会再发，和正常客户端遵守Retry-After的行为一致
+            await asyncio.sleep(args.backoff)
+        turn += 1
+
+
+async def wait_ready(url, timeout):
+    deadline = time.perf_counter() + timeout
+    async with aiohttp.ClientSession() as http:
+        while time.perf_counter() < deadline:
+            try:
+                async with http.get(f"{url}/healthz") as resp:
+                    if resp.status == 200 and (await resp.json())['ok']:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.5)
+    raise TimeoutError(f"api server at {url} not ready after {timeout}s")
+
+
+async def run(args):
+    await wait_ready(args.url, args.ready_timeout)
+    results = []
+    counter = {'sent': 0}
+    deadline = time.perf_counter() + (args.duration or float('inf'))
+    connector = aiohttp.TCPConnector(limit=args.concurrency)
+    timeout = aiohttp.ClientTimeout(total=args.request_timeout)
+    start = time.perf_counter()
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as http:
+        await asyncio.gather(*[client(i, args, http, deadline, counter, results) for i in range(args.concurrency)])
+        elapsed = time.perf_counter() - start
+        async with http.get(f"{args.url}/v1/stats") as resp:
+            server_stats = await resp.json()
+    ok = [r for r in results if r[0] == 200]
+    status_counts = {}
+    for r in results:
+        status_counts[str(r[0])] = status_counts.get(str(r[0]), 0) + 1
+    return {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'platform': platform.platform(),
+        'params': vars(args),
+        'elapsed_s': elapsed,
+        'status': status_counts,
+        'throughput_rps': len(ok) / elapsed,
+        'tokens_per_s': sum(r[3] for r in ok) / elapsed,
+        'ttft': percentiles([r[1] for r in ok if r[1] is not None]),
+        'latency': percentiles([r[2] for r in ok]),
+        'server': {key: server_stats[key] for key in ['max_concurrency', 'max_queue', 'metrics']},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--url', default="http://127.0.0.1:8000")
+    parser.add_argument('--model', default='qwen:0.5b')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=100, help="总请求数，0表示只按--duration")
+    parser.add_argument('--duration', type=float, default=0, help="压测时长（秒），0表示只按--requests")
+    parser.add_argument('--turns', type=int, default=1, help="每个会话连续提问的轮数")
+    parser.add_argument('--request-timeout', type=float, default=300)
+    parser.add_argument('--backoff', type=float, default=1.0, help="请求被429/503拒绝后等待的秒数")
+    parser.add_argument('--ready-timeout', type=float, default=300)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--start-server', action='store_true', help="用stub LLM启动api_server子进程")
+    parser.add_argument('--server-args', default="", help="传给api_server的其他参数，如 \"--max-concurrency 4\"")
+    parser.add_argument('--output', help="结果JSON文件，默认输出到stdout")
+    args = parser.parse_args()
+    if not args.requests and not args.duration:
+        parser.error("--requests and --duration cannot both be 0")
+
+    server = None
+    if args.start_server:
+        port = args.url.rsplit(":", 1)[-1].strip("/")
+        server = subprocess.Popen([sys.executable, str(Path(__file__).parent / 'api_server.py'), '--stub-llm',
+                                   '--host', '127.0.0.1', '--port', port] + args.server_args.split())
+    try:
+        result = asyncio.run(run(args))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+    out = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.output:
+        Path(args.output).write_text(out, encoding='utf-8')
+    print(out)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,43 @@
+import importlib
 import os
 
 import streamlit as st
 from streamlit_option_menu import option_menu
 
 import settings
-from func.demo import demo_page
-from func.gather_info import gather_info_page
-from func.llm_chatbot.llm_chatbot import llm_chatbot_page
-from func.pd_toy import pd_toy_page
-from func.regex_test import regex_test_page
-from func.todolist import todolist_page
+
+# 页面模块在第一次被选中时才导入，避免llm_chatbot等页面的torch/transformers拖慢启动
+pages = {
+    "组件工厂": {
+        "module": "func.demo",
+        "func": "demo_page",
+    },
+    "待办列表": {
+        "module": "func.todolist",
+        "func": "todolist_page",
+    },
+    "信息填报": {
+        "module": "func.gather_info",
+        "func": "gather_info_page",
+    },
+    "正则测试器": {
+        "module": "func.regex_test",
+        "func": "regex_test_page",
+    },
+    "PD测试器": {
+        "module": "func.pd_toy",
+        "func": "pd_toy_page",
+    },
+    "LLM Chatbot": {
+        "module": "func.llm_chatbot.llm_chatbot",
+        "func": "llm_chatbot_page",
+    }
+}
+
+
+def load_page(page):
+    return getattr(importlib.import_module(page['module']), page['func'])
+
 
 if __name__ == "__main__":
     st.set_page_config(
@@ -29,27 +57,6 @@ if __name__ == "__main__":
 
     """, unsafe_allow_html=True)
 
-    pages = {
-        "组件工厂": {
-            "func": demo_page,
-        },
-        "待办列表": {
-            "func": todolist_page
-        },
-        "信息填报": {
-            "func": gather_info_page,
-        },
-        "正则测试器": {
-            "func": regex_test_page,
-        },
-        "PD测试器": {
-            "func": pd_toy_page,
-        },
-        "LLM Chatbot": {
-            "func": llm_chatbot_page,
-        }
-    }
-
     with st.sidebar:
         st.image(
             os.path.join(
@@ -71,4 +78,4 @@ if __name__ == "__main__":
         """)
 
     if selected_page in pages:
-        pages[selected_page]['func']()
+        load_page(pages[selected_page])()
@@ -6,9 +6,29 @@ if not DATA_BASE_PATH.exists():
 MODEL_BASE_PATH = Path.home().resolve()
 
 PERSISTENT_DIRECTORY = DATA_BASE_PATH / 'vectordb'
+# 向量库后端：'chroma'; 'mmap': 内存映射的向量矩阵+NumPy检索，打开快，多进程共享页缓存
+VECTOR_STORE = 'chroma'
+MMAP_VECTOR_DIRECTORY = DATA_BASE_PATH / 'vectordb_mmap'
+MMAP_VECTOR_DTYPE = 'float16'
+MMAP_IVF_NLIST = 0  # >0时启用IVF分区，向量数达到nlist*39后训练聚类中心
+MMAP_IVF_NPROBE = 8  # IVF检索时扫描的分区数
+MMAP_COMPACT_RATIO = 0.3  # 已删除的行超过这个比例时压缩向量库，0表示不压缩
 EMBEDDING_PATH = MODEL_BASE_PATH / 'm3e-base'
+LEXICAL_INDEX_PATH = DATA_BASE_PATH / 'lexical_index.sqlite'
+RETRIEVER_MODE = 'mmr'  # 'mmr': 向量MMR检索; 'hybrid': 向量+BM25倒排索引，RRF融合
+EMBEDDING_CACHE_PATH = DATA_BASE_PATH / 'embedding_cache.sqlite'
+EMBEDDING_CACHE_MAX_ENTRIES = 500000
 KG_DATA_PATH = DATA_BASE_PATH / 'kg_data'
+KG_MANIFEST_PATH = DATA_BASE_PATH / 'kg_manifest.json'
+# 旧版本导入后把文件移到这里；第一次增量重载时移回KG_DATA_PATH，并补写manifest
 KG_PROCESSED_DATA_PATH = DATA_BASE_PATH / 'kg_processed_data'
+KG_INGEST_LOCK_PATH = DATA_BASE_PATH / 'kg_ingest.lock'  # 多个进程（streamlit、api_server）重载知识库时依次进行
+KG_CHUNK_SIZE = 500  # 分块大小
+KG_CHUNK_OVERLAP = 150  # 块重叠长度
+KG_LOAD_WORKERS = 1  # 解析知识库文件的进程数，>1时启用多进程加载
+# 分块后去掉完全相同和MinHash相似度不低于阈值的chunk，只embedding保留下来的那一份
+KG_DEDUP_ENABLED = True
+KG_DEDUP_THRESHOLD = 0.85
 MODEL_PATH = {
     'Qwen1.5-0.5b-chat': MODEL_BASE_PATH.resolve() / 'Qwen1.5-0.5B-Chat',
     'Qwen1.5-1.8b-chat': MODEL_BASE_PATH.resolve() / 'Qwen1.5-1.8B-Chat',
@@ -17,7 +37,79 @@ MODEL_PATH = {
     'minicpm-2b-dpo-fp16': MODEL_BASE_PATH.resolve() / 'MiniCPM-2B-dpo-fp16',
     'chatglm3-6b': MODEL_BASE_PATH.resolve() / 'chatglm3-6b',
 }
+# 本地模型的内存预算（字节），超出时按LRU卸载空闲模型
+MODEL_MEMORY_BUDGET = {
+    'cpu': 32 * 1024 ** 3,
+    'cuda': 20 * 1024 ** 3,
+}
+# CPU推理模式：模型名 -> 'fp32'/'bf16'/'int8'(Linear动态int8量化)；未配置的模型有GPU时按原方式加载，没有GPU时用CPU_DEFAULT_MODE
+# int8会改变输出，只对在这里配置了的模型启用
+MODEL_CPU_MODE = {}
+CPU_DEFAULT_MODE = None  # None为按原方式加载
+CPU_NUM_THREADS = None  # torch计算线程数，None为默认（物理核数）
+CPU_INTEROP_THREADS = None
+QUANTIZED_MODEL_CACHE = DATA_BASE_PATH / 'quantized_models'  # int8量化后的模型缓存，之后加载跳过量化
+MODEL_PRELOAD = None  # 启动时后台预加载的模型，如 'Qwen1.5-0.5b-chat'
+INFERENCE_MAX_BATCH_SIZE = 8  # 本地Qwen模型共享推理线程的最大batch大小
+PREFIX_CACHE_BYTES = 1024 ** 3  # 每个模型缓存的prompt前缀KV的字节上限（按KV张量实际大小），计入MODEL_MEMORY_BUDGET，0表示关闭
+# 投机解码：目标模型 -> draft模型（需共用tokenizer），如 {'Qwen1.5-7b-chat': 'Qwen1.5-0.5b-chat'}
+SPECULATIVE_DRAFT = {}
+SPECULATIVE_DRAFT_TOKENS = 4  # draft每轮猜测的token数
+SPECULATIVE_MIN_ACCEPTANCE = 0.4  # 接受率低于该值的请求回退到普通解码
+# Ollama：共用连接池，流式输出；keep_alive随每个请求发送，避免对话间隙模型被卸载（None则用Ollama默认的5分钟）
+OLLAMA_BASE_URL = 'http://localhost:11434'
+OLLAMA_KEEP_ALIVE = '30m'
+OLLAMA_WARMUP = True  # 第一次选中模型时在后台预加载
+OLLAMA_POOL_SIZE = 8
+OLLAMA_CONNECT_TIMEOUT = 5
+OLLAMA_READ_TIMEOUT = 120  # 两个流式chunk之间的最长间隔（秒）
+OLLAMA_MAX_RETRIES = 2
+# 回答缓存：standalone question的embedding余弦相似度超过阈值时直接复用回答
+ANSWER_CACHE_ENABLED = True
+ANSWER_CACHE_THRESHOLD = 0.95
+ANSWER_CACHE_TTL = 3600  # 秒
+ANSWER_CACHE_MAX_ENTRIES = 1000  # 每个模型
+# 对话记忆的token预算，超出时把较早的轮次压缩成摘要，最近MEMORY_RECENT_TURNS轮原样保留；设为None则不限制
+MEMORY_TOKEN_BUDGET = 1500
+MEMORY_RECENT_TURNS = 2
+MEMORY_PRUNE_TO = 0.6  # 超出预算时一次压缩到预算的这个比例以下，之后几轮不用再生成摘要
+# 每个会话的问答链和记忆，空闲超过TTL（秒）或超过数量上限时按LRU淘汰
+SESSION_CACHE_IDLE_TTL = 3600
+SESSION_CACHE_MAX_ENTRIES = 100
+# 多轮对话时question改写的策略：跳过自包含的问题；可以指定更小的本地模型做改写（None则用对话模型）
+CONDENSE_SKIP_SELF_CONTAINED = True
+CONDENSE_MODEL = None  # 如 'Qwen1.5-0.5b-chat'
+CONDENSE_MAX_NEW_TOKENS = 64
+METRICS_LOG_PATH = DATA_BASE_PATH / 'qa_metrics.jsonl'  # 问答链每轮的性能记录
+# api_server.py：同时运行的问答链数，排队上限（超出返回429）和排队超时（秒，超出返回503）
+API_HOST = '0.0.0.0'
+API_PORT = 8000
+API_MAX_CONCURRENCY = 4
+API_MAX_QUEUE = 32
+API_QUEUE_TIMEOUT = 30
+API_MAX_K = 20  # /v1/chat的k上限
 LOG_PATH = DATA_BASE_PATH / 'demo_log.csv'
-TABLE_PATH = DATA_BASE_PATH / 'demo_table.csv'
-TODOCSV_PATH = DATA_BASE_PATH / 'demo_todolist.csv'
-
+TABLE_PATH = DATA_BASE_PATH / 'demo_table.csv'  # 信息填报记录，只追加写
+TABLE_EXCEL_PATH = DATA_BASE_PATH / 'demo_table.xlsx'
+GATHER_INFO_TAIL_ROWS = 100  # 页面上显示的最近记录数
+GATHER_INFO_EXPORT_MAX_BYTES = 50 * 1024 * 1024  # 超过这个大小的导出文件不经页面下载，只提示服务器上的路径
+TODOCSV_PATH = DATA_BASE_PATH / 'demo_todolist.csv'  # 旧版待办列表，第一次打开时导入TODO_DB_PATH
+TODO_DB_PATH = DATA_BASE_PATH / 'demo_todolist.sqlite'
+TODO_PAGE_SIZE = 20
+# 正则测试器：在REGEX_WORKERS个子进程中匹配，超过REGEX_TIMEOUT秒kill掉
+REGEX_WORKERS = 2
+REGEX_TIMEOUT = 1.0
+REGEX_MAX_MATCHES = 100000  # 最多保留的匹配位置数，总数照常统计
+REGEX_PAGE_CHARS = 20000  # 高亮显示时每页的字符数
+REGEX_MATCHES_PER_PAGE = 50
+# PD测试器：用户代码在PD_TOY_WORKERS个子进程中执行，每次执行的CPU时间、总时间和内存上限
+PD_TOY_WORKERS = 2
+PD_TOY_CPU_LIMIT = 10
+PD_TOY_WALL_LIMIT = 20
+PD_TOY_MEMORY_LIMIT = 4 * 1024 ** 3
+PD_TOY_MAX_RESULT_ROWS = 1000
+# PD测试器的数据集：NumPy按下标从Faker词表中采样；PD_TOY_DATA_FORMAT为'parquet'或'mmap'时存到PD_TOY_DATA_DIR，下次直接读取
+PD_TOY_DATA_FORMAT = None
+PD_TOY_DATA_DIR = DATA_BASE_PATH / 'pd_toy_data'
+PD_TOY_VOCAB_SIZE = 1000
+PD_TOY_PREVIEW_ROWS = 100
@@ -0,0 +1,101 @@
+"""
+用随机权重的小Qwen2模型在CPU上测试InferenceWorker
+"""
+import threading
+
+import numpy as np
+import pytest
+import torch
+from transformers import Qwen2Config, Qwen2ForCausalLM
+
+from func.llm_chatbot.inference_worker import InferenceWorker
+
+CONFIG = Qwen2Config(vocab_size=1000, hidden_size=64, intermediate_size=128, num_hidden_layers=2,
+                     num_attention_heads=4, num_key_value_heads=4)
+
+
+PROMPTS = [np.random.default_rng(0).integers(1, 1000, size=n).tolist() for n in [5, 17, 33, 9, 64, 3, 21, 40]]
+
+
+@pytest.fixture(scope='module')
+def model():
+    torch.manual_seed(0)
+    model = Qwen2ForCausalLM(CONFIG).eval()
+    model.generation_config.do_sample = False
+    model.generation_config.eos_token_id = 0
+    return model
+
+
+@pytest.fixture
+def worker(model):
+    worker = InferenceWorker(model, None, max_batch_size=4)
+    yield worker
+    worker.close()
+
+
+def greedy(model, ids, max_new_tokens):
+    ref = model.generate(torch.tensor([ids]), max_new_tokens=max_new_tokens, do_sample=False)[0][len(ids):].tolist()
+    return ref[:-1] if ref and ref[-1] == 0 else ref
+
+
+def test_batched_equals_sequential(model, worker):
+    # 并发请求经过continuous batching后的结果和逐个greedy generate一致
+    results = {}
+
+    def run(i, ids):
+        results[i] = list(worker.submit(ids, max_new_tokens=16))
+
+    threads = [threading.Thread(target=run, args=(i, ids)) for i, ids in enumerate(PROMPTS)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    for i, ids in enumerate(PROMPTS):
+        assert results[i] == greedy(model, ids, 16)
+
+
+def test_prefill_error_fails_only_that_request(model, worker):
+    # prefill失败（这里用超出词表的token id）只让这个请求报错，同时在跑的请求不受影响
+    ok_req = worker.submit(PROMPTS[1], max_new_tokens=16)
+    bad_req = worker.submit([5, 1000000, 7], max_new_tokens=16)
+    with pytest.raises(IndexError):
+        list(bad_req)
+    assert list(ok_req) == greedy(model, PROMPTS[1], 16)
+
+
+def test_submit_after_close_raises(worker):
+    # close之后提交的请求会收到错误，而不是一直阻塞
+    worker.close()
+    with pytest.raises(RuntimeError):
+        list(worker.submit(PROMPTS[0], max_new_tokens=4))
+
+
+def test_speculative_equals_greedy(model):
+    # draft就是目标模型本身时全部接受；随机的draft模型接受率低，自动回退，结果都和greedy一致
+    torch.manual_seed(1)
+    bad_draft = Qwen2ForCausalLM(CONFIG).eval()
+    for draft, acceptance in [(model, 1.0), (bad_draft, None)]:
+        worker = InferenceWorker(model, None, max_batch_size=4, prefix_cache_bytes=0, draft_model=draft,
+                                 num_draft_tokens=4)
+        try:
+            for ids in PROMPTS[:3]:
+                assert list(worker.submit(ids, max_new_tokens=48)) == greedy(model, ids, 48)
+            if acceptance is not None:
+                assert worker.stats()['spec_acceptance'] == pytest.approx(acceptance)
+        finally:
+            worker.close()
+
+
+def test_prefix_cache_cuts_prefill(worker):
+    # 多轮对话中后续轮次命中前缀缓存，只需要prefill新增的部分
+    rng = np.random.default_rng(0)
+    history = rng.integers(1, 1000, size=100).tolist()
+    prefilled = []
+    for turn in range(3):
+        history += rng.integers(1, 1000, size=10).tolist()
+        req = worker.submit(history, max_new_tokens=8)
+        history += list(req)
+        prefilled.append((len(history), req.prefill_tokens))
+    assert prefilled[0][1] == 110
+    for prompt_len, prefill_tokens in prefilled[1:]:
+        assert prefill_tokens < prompt_len / 4